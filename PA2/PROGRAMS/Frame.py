@@ -1,3 +1,4 @@
+import numpy as np
 import scipy.linalg as scialg
 
 class Frame:
@@ -40,3 +41,97 @@ class Frame:
         :rtype: Frame
         """
         return Frame(self.r.dot(f.r), self.r.dot(f.p) + self.p)
+
+
+class FrameArray:
+    """
+    Class for representing a stack of rigid coordinate frame transformations, stored as one array of rotations and one
+    array of translations rather than one Frame per transformation.
+    """
+    def __init__(self, r, p):
+        """
+        Initialize F_k = [r_k, p_k] for k = 0 ... K - 1
+
+        :param r: The rotation matrix of each frame transformation
+        :param p: The translation vector of each frame transformation
+
+        :type r: numpy.array([numpy.float64][][]), K x 3 x 3
+        :type p: numpy.array([numpy.float64][]), K x 3
+        """
+        self.r = r
+        self.p = p
+
+    def __len__(self):
+        """
+        :return: The number of frame transformations
+        :rtype: int
+        """
+        return self.r.shape[0]
+
+    def __getitem__(self, k):
+        """
+        Extracts a single frame transformation.
+
+        :param k: Index of the frame transformation
+        :type k: int
+
+        :return: The frame transformation F_k
+        :rtype: Frame
+        """
+        return Frame(self.r[k], self.p[k].reshape((3, 1)))
+
+    @property
+    def inv(self):
+        """
+        The inverse of each transformation, found by transposing the rotations
+        :return: A FrameArray with components [r_k, p_k] corresponding to the inverse of each transformation
+        :rtype: FrameArray
+        """
+        r_inv = self.r.transpose((0, 2, 1))
+        return FrameArray(r_inv, -np.einsum('kij,kj->ki', r_inv, self.p))
+
+    def compose(self, f):
+        """
+        Frame composition of each transformation with another set of frames f. Either side may hold a single
+        transformation, which is then composed with every transformation on the other side.
+
+        :param f: The frames to compose with
+        :type f: FrameArray or Frame
+
+        :return: A FrameArray with components corresponding to the composition of each transformation with the matching
+                 transformation of f
+        :rtype: FrameArray
+        """
+        if isinstance(f, Frame):
+            f = FrameArray(f.r[np.newaxis], f.p.reshape((1, 3)))
+        return FrameArray(np.matmul(self.r, f.r), np.einsum('kij,kj->ki', self.r, f.p) + self.p)
+
+    def apply(self, v):
+        """
+        Applies each transformation to a point, either the same point for every transformation or one point each.
+
+        :param v: The point to transform, or one point per transformation
+        :type v: numpy.array([numpy.float64]), 3 x 1, 3 or K x 3
+
+        :return: The transformed point for each transformation
+        :rtype: numpy.array([numpy.float64][]), K x 3
+        """
+        v = np.asarray(v, dtype=np.float64)
+        if v.ndim == 1 or v.shape == (3, 1):
+            return np.einsum('kij,j->ki', self.r, v.reshape(3)) + self.p
+        return np.einsum('kij,kj->ki', self.r, v) + self.p
+
+    def transform(self, data):
+        """
+        Applies each transformation to a point cloud, either the same cloud for every transformation or one cloud each.
+
+        :param data: Column vectors of the cloud to transform, or one such cloud per transformation
+        :type data: numpy.array([numpy.float64][]), 3 x N or K x 3 x N
+
+        :return: The transformed cloud for each transformation
+        :rtype: numpy.array([numpy.float64][][]), K x 3 x N
+        """
+        data = np.asarray(data, dtype=np.float64)
+        if data.ndim == 2:
+            return np.einsum('kij,jn->kin', self.r, data) + self.p[:, :, np.newaxis]
+        return np.einsum('kij,kjn->kin', self.r, data) + self.p[:, :, np.newaxis]
@@ -20,11 +20,11 @@ def c_expected(calbody_file, calreadings_file):
 
     object_frame = pc.fromfile(calbody_file)
 
-    c_exp = []
-    for frame in tracker_frames:
-        f_d = object_frame[0][0].register(frame[0])
-        f_a = object_frame[0][1].register(frame[1])
+    f_ds = pc.register_many(object_frame[0][0].data, pc.stack([frame[0] for frame in tracker_frames]))
+    f_as = pc.register_many(object_frame[0][1].data, pc.stack([frame[1] for frame in tracker_frames]))
 
-        c_exp.append(object_frame[0][2].transform(f_d.inv.compose(f_a)))
+    c_exps = f_ds.inv.compose(f_as).transform(object_frame[0][2].data)
+
+    c_exp = [pc.PointCloud(c) for c in c_exps]
 
     return c_exp
@@ -3,6 +3,7 @@ import PA2_Prob4 as p4
 import distortion as d
 import PA2_Prob5 as p5
 import PA2_Prob6 as p6
+import pivot_cal as piv
 import test
 
 
@@ -29,17 +30,25 @@ def main():
         if len(sys.argv) == 4:
             tolerance = float(sys.argv[3])
             test.test_reg(tolerance)
+            test.test_register_many(tolerance)
             test.test_pivot_cal(empivot, tolerance)
             test.test_normalize()
             test.test_f()
+            test.test_f_bernstein()
             test.test_solve_fcu(tolerance)
+            test.test_distortion_model(empivot.replace('empivot', 'calbody'), empivot.replace('empivot', 'calreadings'),
+                                       empivot)
 
         else:
             test.test_reg()
+            test.test_register_many()
             test.test_pivot_cal(empivot)
             test.test_normalize()
             test.test_f()
+            test.test_f_bernstein()
             test.test_solve_fcu()
+            test.test_distortion_model(empivot.replace('empivot', 'calbody'), empivot.replace('empivot', 'calreadings'),
+                                       empivot)
 
         sys.exit(0)
 
@@ -66,7 +75,8 @@ def main():
 
 def tofile(outfile, calbody, calreadings, empivot, ctfiducials, emfiducialss, emnav):
     """
-    Runs methods for questions 4-6 and writes output file with solutions.
+    Runs methods for questions 4-6 and writes output file with solutions. The distortion correction is fitted once per
+    pair of calibration files and saved alongside them, so later runs with the same calibration load it instead.
     :param outfile: File name/path for output file
     :param calbody: File name/path for the calibration object data file
     :param calreadings: File name/path for the readings from the trackers
@@ -87,13 +97,15 @@ def tofile(outfile, calbody, calreadings, empivot, ctfiducials, emfiducialss, em
 
     :return: None
     """
-    p_ans, C, qmi, qma, qmis, qmas = d.distcal(calbody, calreadings, empivot)
+    model = d.load_model(calbody, calreadings)
 
-    Cs = p4.tip_in_EM(empivot, emfiducialss, p_ans[0], C, qmi, qma, qmis, qmas)
+    p_ans = piv.pivot(model.apply(empivot), 0)
+
+    Cs = p4.tip_in_EM(empivot, emfiducialss, p_ans[0], model)
 
     F = p5.find_freg(ctfiducials, Cs)
 
-    CT = p6.tip_in_CT(empivot, emnav, p_ans[0], F, C, qmi, qma, qmis, qmas)
+    CT = p6.tip_in_CT(empivot, emnav, p_ans[0], F, model)
 
     f = open(outfile, 'w')
     h, t = os.path.split(outfile)
@@ -2,8 +2,174 @@ import PointCloud as pc
 import pivot_cal as piv
 import PA2_Prob1 as p1
 import numpy as np
-import scipy.misc as spmisc
+import scipy.special as spspecial
+import hashlib
 import math
+import os
+
+
+class DistortionModel:
+    """
+    Class representing a fitted distortion correction: the Bernstein coefficient matrix together with the bounds used
+    to scale data in and out of the unit cube. A model can be saved to and loaded from a binary file, and remembers the
+    files it has already corrected so that each is only read and dewarped once.
+    """
+    def __init__(self, coeffs=None, q_min=None, q_max=None, q_star_min=None, q_star_max=None, deg=5, key=None):
+        """
+        Initializes the model, either unfitted or with known coefficients and bounds.
+
+        :param coeffs: coefficient matrix for distortion correction
+        :param q_min: vector of minimum value for each coordinate in experimental data set
+        :param q_max: vector of maximum value for each coordinate in experimental data set
+        :param q_star_min: vector of minimim value for each coordinate in expected data set
+        :param q_star_max: vector of maximum value for each coordinate in expected data set
+        :param deg: degree of Bernstein polynomial
+        :param key: hash of the calibration files the model was fitted to (see input_key)
+
+        :type coeffs: numpy.array([numpy.float64][]) (deg + 1)**3 x 3
+        :type q_min: numpy.array(numpy.float64) shape (3,) or (, 3)
+        :type q_max: numpy.array(numpy.float64) shape (3,) or (, 3)
+        :type q_star_min: numpy.array(numpy.float64) shape (3,) or (, 3)
+        :type q_star_max: numpy.array(numpy.float64) shape (3,) or (, 3)
+        :type deg: Integer
+        :type key: str
+        """
+        self.coeffs = coeffs
+        self.q_min = q_min
+        self.q_max = q_max
+        self.q_star_min = q_star_min
+        self.q_star_max = q_star_max
+        self.deg = deg
+        self.key = key
+        self._corrected = {}
+
+    def fit(self, calbody_file, calreadings_file):
+        """
+        Fits the correction to the EM marker readings on the calibration object and their expected positions.
+
+        :param calbody_file: File name/path for the calibration object data file
+        :param calreadings_file: File name/path for the readings from the trackers
+
+        :type calbody_file: str
+        :type calreadings_file: str
+
+        :return: The fitted model (self)
+        :rtype: DistortionModel
+        """
+        tracker_frames = pc.fromfile(calreadings_file)
+        c_exp = p1.c_expected(calbody_file, calreadings_file)
+
+        concatc = np.concatenate([frame[2].data for frame in tracker_frames], axis=1)
+        concatc_exp = np.concatenate([cloud.data for cloud in c_exp], axis=1)
+        nPoints = concatc.shape[1]
+
+        self.q_min, self.q_max, self.q_star_min, self.q_star_max = calc_q(concatc, concatc_exp)
+        u_s_star = normalize(nPoints, concatc_exp, self.q_star_min, self.q_star_max)
+        u_s = normalize(nPoints, concatc, self.q_min, self.q_max)
+
+        self.coeffs = solve_fcu(f_matrix(u_s, self.deg), u_s_star)
+        self.key = input_key(calbody_file, calreadings_file)
+        self._corrected = {}
+
+        return self
+
+    def apply(self, inputs):
+        """
+        Performs dewarping on PointClouds extracted from a given input file. The result for each file is kept, and
+        returned again if the same, unchanged file is corrected later, so it should not be modified by the caller.
+
+        :param inputs: file with point clouds to be dewarped
+        :type inputs: str
+
+        :return: dewarped set of point clouds extracted from input file
+        :rtype [PointCloud.PointCloud][]
+        """
+        name = (os.path.abspath(inputs), os.path.getmtime(inputs))
+        if name not in self._corrected:
+            self._corrected[name] = correct(inputs, self.coeffs, self.q_min, self.q_max, self.q_star_min,
+                                            self.q_star_max, self.deg)
+        return self._corrected[name]
+
+    def save(self, fpath):
+        """
+        Writes the model to a binary (.npz) file.
+
+        :param fpath: File name/path to write to
+        :type fpath: str
+
+        :return: None
+        """
+        with open(fpath, 'wb') as f:
+            np.savez(f, coeffs=self.coeffs, q_min=self.q_min, q_max=self.q_max, q_star_min=self.q_star_min,
+                     q_star_max=self.q_star_max, deg=self.deg, key=str(self.key))
+
+    @classmethod
+    def load(cls, fpath):
+        """
+        Reads a model written by save.
+
+        :param fpath: File name/path to read from
+        :type fpath: str
+
+        :return: The saved model
+        :rtype: DistortionModel
+        """
+        # Each array read from the archive is a copy, so the model stays valid once the file is closed
+        with np.load(fpath) as data:
+            return cls(data['coeffs'], data['q_min'], data['q_max'], data['q_star_min'], data['q_star_max'],
+                       int(data['deg']), str(data['key']))
+
+
+def input_key(calbody_file, calreadings_file):
+    """
+    Computes a hash identifying a pair of calibration files by their contents.
+
+    :param calbody_file: File name/path for the calibration object data file
+    :param calreadings_file: File name/path for the readings from the trackers
+
+    :type calbody_file: str
+    :type calreadings_file: str
+
+    :return: hexadecimal SHA-1 digest of both files
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    for fpath in (calbody_file, calreadings_file):
+        with open(fpath, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def load_model(calbody_file, calreadings_file, cache_dir=None):
+    """
+    Returns the distortion model for a pair of calibration files, loading it from the cache directory if it has been
+    fitted to the same files before, and otherwise fitting it and saving it there.
+
+    :param calbody_file: File name/path for the calibration object data file
+    :param calreadings_file: File name/path for the readings from the trackers
+    :param cache_dir: Directory holding saved models (the directory of calreadings_file by default)
+
+    :type calbody_file: str
+    :type calreadings_file: str
+    :type cache_dir: str
+
+    :return: The fitted distortion model
+    :rtype: DistortionModel
+    """
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(calreadings_file))
+
+    key = input_key(calbody_file, calreadings_file)
+    fpath = os.path.join(cache_dir, 'distortion-' + key[0:16] + '.npz')
+
+    if os.path.exists(fpath):
+        model = DistortionModel.load(fpath)
+        if model.key == key:
+            return model
+
+    model = DistortionModel().fit(calbody_file, calreadings_file)
+    model.save(fpath)
+    return model
 
 
 def distcal(calbody_file, calreadings_file, empivot_file):
@@ -33,39 +199,14 @@ def distcal(calbody_file, calreadings_file, empivot_file):
     :rtype q_star_max: numpy.array(numpy.float64) shape (3,) or (, 3)
     """
 
-    tracker_frames = pc.fromfile(calreadings_file)
+    model = DistortionModel().fit(calbody_file, calreadings_file)
 
-    c = []
-    for k in range(len(tracker_frames)):
-        c.append(tracker_frames[k][2])
+    pivotanswer = piv.pivot(model.apply(empivot_file), 0)
 
-    c_exp = p1.c_expected(calbody_file, calreadings_file)
+    return pivotanswer, model.coeffs, model.q_min, model.q_max, model.q_star_min, model.q_star_max
 
-    pPerFrame = np.shape(c[0].data)[1]    #points per frame
-    nFrames = np.shape(c)[0]
 
-    concatc = c[0].data
-    concatc_exp = c_exp[0].data
-    for i in range(1, nFrames):
-        concatc = np.concatenate((concatc, c[i].data), axis=1)
-        concatc_exp = np.concatenate((concatc_exp, c_exp[i].data), axis=1)
-
-    q_min, q_max, q_star_min, q_star_max = calc_q(concatc, concatc_exp)
-    u_s_star = normalize(pPerFrame*nFrames, concatc_exp, q_star_min, q_star_max)
-    u_s = normalize(pPerFrame*nFrames, concatc, q_min, q_max)
-
-    F_mat = f_matrix(u_s, 5)
-
-    coeff_mat = solve_fcu(F_mat, u_s_star)
-
-    EMcorrect = correct(empivot_file, coeff_mat, q_min, q_max, q_star_min, q_star_max)
-
-    pivotanswer = piv.pivot(EMcorrect, 0)
-
-    return pivotanswer, coeff_mat, q_min, q_max, q_star_min, q_star_max
-
-
-def correct(inputs, coeffs, q_min, q_max, q_star_min, q_star_max):
+def correct(inputs, coeffs, q_min, q_max, q_star_min, q_star_max, deg=5):
     """
     Performs dewarping on PointClouds extracted from a given input file.
 
@@ -75,6 +216,7 @@ def correct(inputs, coeffs, q_min, q_max, q_star_min, q_star_max):
     :param q_max: vector of maximum value for each coordinate in experimental data set
     :param q_star_min: vector of minimim value for each coordinate in expected data set
     :param q_star_max: vector of maximum value for each coordinate in expected data set
+    :param deg: degree of Bernstein polynomial the coefficients were fitted with
 
     :type inputs: str
     :type coeffs: numpy.array([numpy.float64][]) degree**3 x 3
@@ -82,6 +224,7 @@ def correct(inputs, coeffs, q_min, q_max, q_star_min, q_star_max):
     :type q_max: numpy.array(numpy.float64) shape (3,) or (, 3)
     :type q_star_min: numpy.array(numpy.float64) shape (3,) or (, 3)
     :type q_star_max: numpy.array(numpy.float64) shape (3,) or (, 3)
+    :type deg: Integer
 
     :return: outputcloud: dewarped set of point clouds extracted from input file
 
@@ -98,13 +241,8 @@ def correct(inputs, coeffs, q_min, q_max, q_star_min, q_star_max):
     points = np.shape(inputcloud[0][0].data)[1]
 
     for k in range(len(inputcloud)):
-        outputcloud[k][0].data = f_matrix(normalize(points, inputcloud[k][0].data, q_min, q_max), 5).dot(coeffs)
-        for i in range(points):
-            for j in range(3):
-                outputcloud[k][0].data[i, j] = (outputcloud[k][0].data[i, j])*(q_star_max[j] - q_star_min[j]) + \
-                                               q_star_min[j]
-
-        outputcloud[k][0].data = outputcloud[k][0].data.T
+        outputcloud[k][0].data = f_matrix(normalize(points, inputcloud[k][0].data, q_min, q_max), deg).dot(coeffs)
+        outputcloud[k][0].data = (outputcloud[k][0].data * (q_star_max - q_star_min) + q_star_min).T
 
     return outputcloud
 
@@ -129,11 +267,10 @@ def normalize(pPerFrame, c, q_min, q_max):
 
     """
 
-    u_s = np.zeros([pPerFrame, 3])
+    q_min = np.asarray(q_min).reshape((1, 3))
+    q_max = np.asarray(q_max).reshape((1, 3))
 
-    for k in range(pPerFrame):
-        for i in range(0, 3):
-            u_s[k][i] = (c[i][k] - q_min[i])/(q_max[i] - q_min[i])
+    u_s = (np.asarray(c)[:, 0:pPerFrame].T - q_min) / (q_max - q_min)
 
     return u_s
 
@@ -214,7 +351,7 @@ def bernstein(N, k, u):
     :rtype: B: numpy.float64
 
     """
-    B = spmisc.comb(N, k, exact=True) * math.pow(1 - u, N - k) * math.pow(u, k)
+    B = spspecial.comb(N, k, exact=True) * math.pow(1 - u, N - k) * math.pow(u, k)
     return B
 
 
@@ -246,9 +383,40 @@ def f_ijk(N, i, j, k, u_x, u_y, u_z):
     return bernstein(N, i, u_x) * bernstein(N, j, u_y) * bernstein(N, k, u_z)
 
 
+def bernstein_table(u, deg):
+    """
+    Calculates every Bernstein basis polynomial of a given degree at each value of u, so that column k holds
+    bernstein(deg, k, u).
+
+    :param u: normalized data values along one axis
+    :param deg: degree of Bernstein polynomial
+
+    :type u: numpy.array(numpy.float64) shape (totalPoints,)
+    :type deg: Integer
+
+    :return: table of Bernstein polynomial values
+
+    :rtype: numpy.array(numpy.float64) shape (totalPoints, deg + 1)
+
+    """
+    if deg not in _binomials:
+        _binomials[deg] = spspecial.comb(deg, np.arange(deg + 1), exact=False)
+
+    k = np.arange(deg + 1)
+    u = np.asarray(u, dtype=np.float64).reshape((-1, 1))
+
+    return _binomials[deg] * np.power(1 - u, deg - k) * np.power(u, k)
+
+
+# Binomial coefficients for each Bernstein polynomial degree used so far
+_binomials = {}
+
+
 def f_matrix(u, deg):
     """
-    Calculates the matrix of Bernstein polynomials from the scaled experimental data, the "F matrix".
+    Calculates the matrix of Bernstein polynomials from the scaled experimental data, the "F matrix". Each row is the
+    row-wise Kronecker product of the x, y and z Bernstein tables, so that column c = i*(deg + 1)**2 + j*(deg + 1) + k
+    holds f_ijk.
 
     :param u: array of points of scaled experimental data
     :param deg: degree of berenstein polynomial (should be 5 for this application)
@@ -263,16 +431,13 @@ def f_matrix(u, deg):
     """
     #deg is degree of berenstein polynomial, u is normalized distorted data
 
+    u = np.asarray(u, dtype=np.float64)
     nPoints = np.shape(u)[0]
 
-    f_mat = np.zeros([nPoints, math.pow(deg + 1, 3)])
+    b_x = bernstein_table(u[:, 0], deg)
+    b_y = bernstein_table(u[:, 1], deg)
+    b_z = bernstein_table(u[:, 2], deg)
 
-    for n in range(nPoints):
-        c = 0
-        for i in range(0, deg + 1):
-            for j in range(0, deg + 1):
-                for k in range(0, deg + 1):
-                    f_mat[n][c] = f_ijk(deg, i, j, k, u[n][0], u[n][1], u[n][2])
-                    c += 1
+    f_mat = b_x[:, :, np.newaxis, np.newaxis] * b_y[:, np.newaxis, :, np.newaxis] * b_z[:, np.newaxis, np.newaxis, :]
 
-    return f_mat
+    return f_mat.reshape((nPoints, (deg + 1) ** 3))
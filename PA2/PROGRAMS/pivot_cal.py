@@ -35,27 +35,15 @@ def pivot(G, nframe, debug=False):
 
     R_I = np.zeros([3 * n_frames, 6])  # matrix [Rn | -I] for least squares problem
 
-    p_lstsq = np.zeros([n_frames * 3])  # matrix [pn] for least squares problem
-
-    Fs = []
+    Fs = pc.register_many(G_j, pc.stack([G[k][nframe] for k in range(n_frames)]))
 
     # set rotational side of matrix for least squares problem
-    for k in range(n_frames):
-        F = pc.PointCloud(G_j).register(G[k][nframe])
-        if debug:
-            Fs.append(F)
-        R, p = F.r, F.p
-        for i in range(0, 3):
-            R_I[k * 3][i] = R[0][i]
-            R_I[k * 3 + 1][i] = R[1][i]
-            R_I[k * 3 + 2][i] = R[2][i]
-            p_lstsq[k * 3 + i] = -p[i]
+    R_I[:, 0:3] = Fs.r.reshape((3 * n_frames, 3))
+
+    p_lstsq = -Fs.p.reshape(3 * n_frames)  # matrix [pn] for least squares problem
 
     # set identity side of matrix for least squares problem
-    for n in range(n_frames):
-        R_I[n * 3][3] = -1
-        R_I[n * 3 + 1][4] = -1
-        R_I[n * 3 + 2][5] = -1
+    R_I[:, 3:6] = -np.tile(np.identity(3), (n_frames, 1))
 
     # solve as an Ax=B problem (R_I * [pcal ppiv] = p_leastsq)
     p_soln = np.linalg.lstsq(R_I, p_lstsq)
@@ -63,5 +51,5 @@ def pivot(G, nframe, debug=False):
     p_cal = np.array(p_soln[0][0:3])
     p_piv = np.array(p_soln[0][3:6])
     if debug:
-        return p_cal, p_piv, Fs
+        return p_cal, p_piv, [Fs[k] for k in range(n_frames)]
     return p_cal, p_piv
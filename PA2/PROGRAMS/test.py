@@ -1,5 +1,7 @@
 import numpy as np
 import scipy.linalg as scialg
+import os
+import tempfile
 import PointCloud as pc
 import pivot_cal as piv
 import distortion as d
@@ -58,6 +60,38 @@ def test_reg(tolerance=1e-4):
     print('\nRegistration tests passed!')
 
 
+def test_register_many(tolerance=1e-4):
+    """
+    Tests batched registration of a random point cloud to several randomly rotated and translated copies of it, by
+    comparing each result to the generated transformation and to registering the pair on its own.
+
+    :param tolerance: The amount of allowed error between the generated and calculated transformation components
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting batched registration...')
+    a = np.random.uniform(0, 10, (3, 10))
+    rs = np.array([_rotation(np.random.uniform(0, 2 * np.pi, (3,))) for k in range(5)])
+    ps = np.random.uniform(0, 10, (5, 3))
+    b = np.einsum('kij,jn->kin', rs, a) + ps[:, :, np.newaxis]
+
+    fs = pc.register_many(a, b)
+
+    print('\nAre calculated R and p within tolerance of each generated frame?')
+    passed = np.all(np.abs(fs.r - rs) <= tolerance) and np.all(np.abs(fs.p - ps) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nDo they match registering each pair separately?')
+    for k in range(len(fs)):
+        f = pc.PointCloud(a).register(pc.PointCloud(b[k]))
+        assert np.all(np.abs(fs[k].r - f.r) <= tolerance) and np.all(np.abs(fs[k].p - f.p) <= tolerance)
+    print(True)
+
+    print('\nBatched registration tests passed!')
+
+
 def test_pivot_cal(empivot, tolerance=1e-2):
     """
     Tests whether pivot calibration is correct by using the fact that all frame transformations F_G[k] from pointer to
@@ -162,6 +196,40 @@ def test_f():
     print('\nF tests pass!')
 
 
+def test_f_bernstein(tolerance=1e-10):
+    """
+    Checks that each entry of the F matrix, built from per-axis Bernstein tables, equals the product of the individual
+    Bernstein polynomials computed by f_ijk.
+
+    :param tolerance: Maximum difference between matrix entries and f_ijk
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTest F matrix entries against individual Bernstein polynomials.')
+    u = np.random.uniform(0, 1, (10, 3))
+    print('\nu (10 x 3):')
+    print(u)
+
+    for deg in (3, 5):
+        F = d.f_matrix(u, deg)
+        F_exp = np.zeros(F.shape)
+        for n in range(u.shape[0]):
+            c = 0
+            for i in range(deg + 1):
+                for j in range(deg + 1):
+                    for k in range(deg + 1):
+                        F_exp[n][c] = d.f_ijk(deg, i, j, k, u[n][0], u[n][1], u[n][2])
+                        c += 1
+
+        print('\nDegree {}: does every entry match?'.format(deg))
+        passed = np.all(np.abs(F - F_exp) <= tolerance)
+        assert passed
+        print(passed)
+
+    print('\nF entry tests pass!')
+
+
 def test_solve_fcu(tolerance=1e-4):
     print('\nTest dewarping correction.')
     u_star = np.random.uniform(-100, 100, (3, 10))
@@ -202,6 +270,54 @@ def test_solve_fcu(tolerance=1e-4):
     print('\nDewarping test passed!')
 
 
+def test_distortion_model(calbody, calreadings, empivot, tolerance=1e-6):
+    """
+    Tests that a fitted distortion model survives saving and loading, and that correcting a file through the model
+    gives the same result as correcting it with the coefficients directly.
+
+    :param calbody: The name/path of a calbody.txt file
+    :param calreadings: The name/path of the matching calreadings.txt file
+    :param empivot: The name/path of an empivot.txt file to correct
+    :param tolerance: Maximum difference between corrected points
+
+    :type calbody: str
+    :type calreadings: str
+    :type empivot: str
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTest saving and loading a distortion model.')
+    model = d.DistortionModel().fit(calbody, calreadings)
+
+    fd, fpath = tempfile.mkstemp(suffix='.npz')
+    os.close(fd)
+    try:
+        model.save(fpath)
+        loaded = d.DistortionModel.load(fpath)
+    finally:
+        os.remove(fpath)
+
+    print('\nKey matches the calibration files?')
+    passed = loaded.key == d.input_key(calbody, calreadings)
+    assert passed
+    print(passed)
+
+    print('\nLoaded model corrects like the original coefficients?')
+    G_exp = d.correct(empivot, model.coeffs, model.q_min, model.q_max, model.q_star_min, model.q_star_max)
+    G = loaded.apply(empivot)
+    passed = np.all([np.all(np.abs(G[k][0].data - G_exp[k][0].data) <= tolerance) for k in range(len(G))])
+    assert passed
+    print(passed)
+
+    print('\nSecond correction of the same file reused?')
+    passed = loaded.apply(empivot) is G
+    assert passed
+    print(passed)
+
+    print('\nDistortion model tests pass!')
+
+
 def _rotation(angles):
     """
     Helper method for generating a 3d rotation matrix
@@ -1,30 +1,157 @@
+import heapq
+import collections
 import numpy as np
 import scipy.linalg as scialg
 import Frame as fr
 import PointCloud as pc
+import TriangleSet as ts
 
 
 class CovTreeNode:
     """
     Class for node in a covariance tree.
     """
-    def __init__(self, triangles, num_tri):
+    def __init__(self, triangles, num_tri, split='sign', leaf_size=1):
         """
         Initializes a covariance tree data structure for a given surface.
         :param triangles: list of Triangles on the surface
         :param num_tri: number of Triangles on the surface
+        :param split: 'sign' to split nodes where the x coordinates of triangle centroids in the node frame change sign,
+                      or 'median' to split them into halves at the median x coordinate, which bounds the depth of the
+                      tree by log2(num_tri / leaf_size), rounded up
+        :param leaf_size: Most triangles a node may hold without being split
 
         :type triangles: np.array([Triangle])
         :type num_tri: integer
+        :type split: str
+        :type leaf_size: integer
+        """
+        if split not in ('sign', 'median'):
+            raise ValueError("Tree split must be 'sign' or 'median', not " + repr(split))
+        if leaf_size < 1:
+            raise ValueError('Leaf size must be at least 1, not ' + str(leaf_size))
+
+        self._Setup(triangles, num_tri, split, leaf_size)
+
+        # Build the subtrees from an explicit stack rather than by recursion, so that deep trees cannot reach the
+        # recursion limit
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node._ConstructSubtrees()
+            node._FindBoundingBox(node.num_tri)
+            if node.has_subtrees:
+                stack.extend(node.subtrees)
+
+        self._GatherTriangles()
+
+    def _Setup(self, triangles, num_tri, split, leaf_size):
+        """
+        Initializes this node's triangles and frame, without building its subtrees.
+        :param triangles: list of Triangles in this node
+        :param num_tri: number of Triangles in this node
+        :param split: How to split nodes, 'sign' or 'median'
+        :param leaf_size: Most triangles a node may hold without being split
+
+        :type triangles: np.array([Triangle])
+        :type num_tri: integer
+        :type split: str
+        :type leaf_size: integer
+
+        :return: None
         """
         self.triangle_list = triangles
         self.num_tri = num_tri
+        self.split = split
+        self.leaf_size = leaf_size
         self.bounds = None
         self.frame = self._FindCovFrame(self.num_tri)
+        self.inv_frame = self.frame.inv
         self.has_subtrees = False
         self.subtrees = [None, None]
-        self._ConstructSubtrees()
-        self._FindBoundingBox(self.num_tri)
+        self.triangle_set = None
+        self.start = 0
+        self.end = num_tri
+
+    def _Child(self, triangles, num_tri):
+        """
+        Creates a child of this node, to be built by the caller.
+        :param triangles: list of Triangles in the child
+        :param num_tri: number of Triangles in the child
+
+        :type triangles: np.array([Triangle])
+        :type num_tri: integer
+
+        :return: The child node, with its frame but no subtrees or bounding box yet
+        :rtype: CovTreeNode
+        """
+        child = CovTreeNode.__new__(type(self))
+        child._Setup(triangles, num_tri, self.split, self.leaf_size)
+        return child
+
+    def _GatherTriangles(self):
+        """
+        Stores the triangles of every leaf below this node, in depth first order, in one TriangleSet shared by every
+        node, so that the triangles below any node are the contiguous range start:end of the set and a leaf can test
+        all of its triangles in one vectorized call.
+
+        :return: None
+        """
+        leaves = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.has_subtrees:
+                stack.append(node.subtrees[1])
+                stack.append(node.subtrees[0])
+            else:
+                leaves.append(node)
+
+        corners = np.array([t.corners.data.T for leaf in leaves for t in leaf.triangle_list[0:leaf.num_tri]])
+        triangle_set = ts.TriangleSet(corners)
+        start = 0
+        for leaf in leaves:
+            leaf.start = start
+            start += leaf.num_tri
+            leaf.end = start
+
+        # Children come after their parent in a depth first order, so visiting it backwards finishes them first
+        nodes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            if node.has_subtrees:
+                stack.extend(node.subtrees)
+        for node in reversed(nodes):
+            node.triangle_set = triangle_set
+            if node.has_subtrees:
+                node.start = node.subtrees[0].start
+                node.end = node.subtrees[1].end
+
+    def SearchLeaf(self, v, bound, closest):
+        """
+        Finds the closest point to v on the triangles of this node, testing them all at once.
+        :param v: Point to find closest point to
+        :param bound: distance from current closest point
+        :param closest: Current closest point
+
+        :type v: np.array(np.float64) 3
+        :type bound: [np.float64]
+        :type closest: [np.array(np.float64) 3]
+
+        :return bound: the new distance to the new closest point, or old distance if no new closest point found
+        :return closest: the current closest point
+
+        :rtype bound: [np.float64]
+        :rtype closest: [np.array(np.float64) 3]
+        """
+        # Here bound, closest are one-element lists (like passing by reference)
+        cp, dist, ind = self.triangle_set.ClosestPoint(v.reshape(3), bound[0], slice(self.start, self.end))
+        if cp is not None:
+            bound[0] = dist
+            closest[0] = cp
+        return bound, closest
 
     def UpdateClosest(self, t, v, bound, closest):
         """
@@ -56,33 +183,114 @@ class CovTreeNode:
             closest[0] = cp
         return bound, closest
 
-    def FindClosestPoint(self, v, bound, closest):
+    def FindClosestPoint(self, v, bound, closest, order='near', counts=None):
         """
-        Finds the closest point to v on or below this node.
+        Finds the closest point to v on or below this node, without recursion. With order 'fixed' or 'near', nodes are
+        visited depth first from an explicit stack, children in the order they are stored or nearer child first, so
+        that the bound has usually shrunk by the time the farther child is tested. With order 'best', pending nodes are
+        kept in a heap by the distance from v to their bounding box, always expanding the nearest, and the search stops
+        as soon as the nearest pending box is farther than the bound.
         :param v: the point to find the closest point to
         :param bound: distance between this point and the current closest point
         :param closest: current closest point or estimate
+        :param order: Order to visit nodes in: 'fixed', 'near' or 'best'
+        :param counts: Counter to add the number of nodes whose box was measured ('nodes') and the number of triangles
+                       in the leaves searched ('triangles') to (optional)
 
         :type v: np.array(np.float64) 3 X 1
         :type bound: [np.float]
         :type closest: [np.array(np.float64) 3 X 1]
+        :type order: str
+        :type counts: collections.Counter
 
         :return: None if no closest point found
 
         """
-        temp = (self.frame.inv.r.dot(v.reshape((3, 1))) + self.frame.inv.p).flatten()
-        # Note: To pass by reference, closest should be a mutable type (e.g. a list)
-        if np.any(temp.reshape((3, 1)) < (self.bounds[0] - bound[0])) or (
-                np.any(temp.reshape((3, 1)) > (self.bounds[1] + bound[0]))):
+        if order not in ('fixed', 'near', 'best'):
+            raise ValueError("Search order must be 'fixed', 'near' or 'best', not " + repr(order))
+        if counts is None:
+            counts = collections.Counter()
+
+        point = v.reshape((3, 1))
+        counts['nodes'] += 1
+        if order == 'best':
+            self._FindClosestPointBestFirst(v, point, bound, closest, counts)
             return
 
-        if self.has_subtrees:
-            self.subtrees[0].FindClosestPoint(v, bound, closest)
-            self.subtrees[1].FindClosestPoint(v, bound, closest)
+        # Note: To pass by reference, closest should be a mutable type (e.g. a list)
+        stack = [(self, self._LocalPoint(point))]
+        while stack:
+            node, temp = stack.pop()
+            if np.any(temp < (node.bounds[0] - bound[0])) or np.any(temp > (node.bounds[1] + bound[0])):
+                continue
+
+            if node.has_subtrees:
+                children = [(child, child._LocalPoint(point)) for child in node.subtrees]
+                counts['nodes'] += 2
+                if order == 'near' and (children[1][0]._BoxDistance(children[1][1]) <
+                                        children[0][0]._BoxDistance(children[0][1])):
+                    children.reverse()
+                stack.append(children[1])
+                stack.append(children[0])
+
+            else:
+                counts['triangles'] += node.num_tri
+                bound, closest = node.SearchLeaf(v, bound, closest)
+
+    def _FindClosestPointBestFirst(self, v, point, bound, closest, counts):
+        """
+        Best first search for FindClosestPoint.
+        :param v: the point to find the closest point to
+        :param point: the same point, as a column
+        :param bound: distance between this point and the current closest point
+        :param closest: current closest point or estimate
+        :param counts: Counter of nodes measured and triangles searched
+
+        :type v: np.array(np.float64) 3 X 1
+        :type point: np.array(np.float64) 3 X 1
+        :type bound: [np.float]
+        :type closest: [np.array(np.float64) 3 X 1]
+        :type counts: collections.Counter
+
+        :return: None
+        """
+        # Entries are (box distance, insertion number, node); the insertion number keeps nodes from being compared
+        heap = [(self._BoxDistance(self._LocalPoint(point)), 0, self)]
+        pushed = 1
+        while heap and heap[0][0] <= bound[0]:
+            dist, k, node = heapq.heappop(heap)
+            if node.has_subtrees:
+                for child in node.subtrees:
+                    child_dist = child._BoxDistance(child._LocalPoint(point))
+                    counts['nodes'] += 1
+                    if child_dist <= bound[0]:
+                        heapq.heappush(heap, (child_dist, pushed, child))
+                        pushed += 1
+            else:
+                counts['triangles'] += node.num_tri
+                bound, closest = node.SearchLeaf(v, bound, closest)
+
+    def _LocalPoint(self, v):
+        """
+        Transforms a point into the frame of this node.
+        :param v: the point to transform
+        :type v: np.array(np.float64) 3 X 1
+
+        :return: the point in this node's frame
+        :rtype: np.array(np.float64) 3 X 1
+        """
+        return self.inv_frame.r.dot(v) + self.inv_frame.p
+
+    def _BoxDistance(self, temp):
+        """
+        Finds the distance from a point to the bounding box of this node.
+        :param temp: the point, in this node's frame
+        :type temp: np.array(np.float64) 3 X 1
 
-        else:
-            for i in range(self.num_tri):
-                bound, closest = self.UpdateClosest(self.triangle_list[i], v, bound, closest)
+        :return: distance from the point to the box, zero if it is inside
+        :rtype: np.float64
+        """
+        return np.linalg.norm(np.maximum(np.maximum(self.bounds[0] - temp, temp - self.bounds[1]), 0))
 
     def _FindCovFrame(self, *args):
         """
@@ -131,7 +339,7 @@ class CovTreeNode:
 
             r = u.dot(correction.dot(v))
 
-            return fr.Frame(r, c)
+            return fr.Frame(r, c, rigid=True)
 
     def _FindBoundingBox(self, n):
         """
@@ -142,7 +350,7 @@ class CovTreeNode:
         :return: upper and lower bounds of bounding box around this covariance tree
         :rtype: []
         """
-        LB = pc.PointCloud(self.triangle_list[0].SortPoint()).transform(self.frame.inv).data
+        LB = pc.PointCloud(self.triangle_list[0].SortPoint()).transform(self.inv_frame).data
         bounds = [LB, LB]
         for k in range(n):
             bounds = self.triangle_list[k].EnlargeBounds(self.frame, bounds)
@@ -160,7 +368,7 @@ class CovTreeNode:
         """
         points = []
         for k in range(num):
-            points.append(pc.PointCloud(self.triangle_list[k].SortPoint()).transform(self.frame.inv).data.tolist())
+            points.append(pc.PointCloud(self.triangle_list[k].SortPoint()).transform(self.inv_frame).data.tolist())
         points = np.array(points).squeeze().T
         inds = np.argsort(points[0, :])
         points = points[:, inds]
@@ -170,13 +378,62 @@ class CovTreeNode:
         if possible_splits:
             return np.where(np.diff(np.signbit(points[0, :])))[0][0]
 
+    def BuildStats(self):
+        """
+        Describes the shape of the tree below this node.
+
+        :return depth: Number of levels below this node (0 if it is a leaf)
+        :return num_nodes: Number of nodes in the tree, including this one
+        :return leaf_sizes: Histogram of leaf sizes: the number of leaves holding k triangles is leaf_sizes[k]
+
+        :rtype depth: integer
+        :rtype num_nodes: integer
+        :rtype leaf_sizes: np.array([int])
+        """
+        depth = 0
+        num_nodes = 0
+        sizes = []
+        stack = [(self, 0)]
+        while stack:
+            node, level = stack.pop()
+            num_nodes += 1
+            depth = max(depth, level)
+            if node.has_subtrees:
+                stack.append((node.subtrees[0], level + 1))
+                stack.append((node.subtrees[1], level + 1))
+            else:
+                sizes.append(node.num_tri)
+        return depth, num_nodes, np.bincount(sizes)
+
+    def _SplitMedian(self, num):
+        """
+        Sorts triangles based on their x coordinate and splits them into halves.
+        :param num: Number of triangles in this covariance tree.
+        :type num: integer
+
+        :return: index in list of triangles where split occurs
+        :rtype: integer
+        """
+        points = np.hstack([self.triangle_list[k].SortPoint() for k in range(num)])
+        x = self.inv_frame.r[0].dot(points) + self.inv_frame.p[0]
+        self.triangle_list = self.triangle_list[np.argsort(x, kind='mergesort')]
+        return num // 2
+
     def _ConstructSubtrees(self):
         """
         Constructs subtrees based on list of triangles in this covariance tree.
 
         :return: None
         """
-        if len(self.triangle_list) <= 1:
+        if self.split == 'median':
+            if self.num_tri > self.leaf_size:
+                splitpoint = self._SplitMedian(self.num_tri)
+                self.has_subtrees = True
+                self.subtrees[0] = self._Child(self.triangle_list[0:splitpoint], splitpoint)
+                self.subtrees[1] = self._Child(self.triangle_list[splitpoint:self.num_tri], self.num_tri - splitpoint)
+            return
+
+        if len(self.triangle_list) <= self.leaf_size:
             return
 
         splitpoint = self._SplitSort(self.num_tri)
@@ -189,5 +446,5 @@ class CovTreeNode:
 
             else:
                 self.has_subtrees = True
-                self.subtrees[0] = CovTreeNode(self.triangle_list[0:splitpoint], splitpoint)
-                self.subtrees[1] = CovTreeNode(self.triangle_list[splitpoint:self.num_tri], self.num_tri - splitpoint)
+                self.subtrees[0] = self._Child(self.triangle_list[0:splitpoint], splitpoint)
+                self.subtrees[1] = self._Child(self.triangle_list[splitpoint:self.num_tri], self.num_tri - splitpoint)
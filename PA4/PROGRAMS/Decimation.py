@@ -0,0 +1,120 @@
+import numpy as np
+import ICPmatching as icpm
+import FlatCovTree as fct
+
+
+class MeshLevel:
+    """
+    Class for one level of a mesh pyramid: a mesh, the tree over its triangles, and how closely it approximates the
+    full resolution mesh.
+    """
+    def __init__(self, vCoords, vIndices, error=0.0, tree=None):
+        """
+        Builds the tree over a mesh level.
+        :param vCoords: coordinates of all vertices on mesh
+        :param vIndices: indices of vertices for each triangle on mesh
+        :param error: root mean square distance from the vertices of the full resolution mesh to this mesh
+        :param tree: tree over the mesh, built if not given
+
+        :type vCoords: np.array([np.float64]) 3 x N
+        :type vIndices: np.array([int]) 3 x M
+        :type error: float
+        :type tree: fct.FlatCovTree
+        """
+        self.vCoords = vCoords
+        self.vIndices = vIndices
+        self.error = error
+        self.tree = tree if tree is not None else fct.fromMesh(vCoords, vIndices)
+
+
+def decimate(vCoords, vInd, cellSize):
+    """
+    Simplifies a mesh by vertex clustering: vertices are grouped by the cell of a uniform grid they fall in, each group
+    is replaced by the point that minimizes the summed squared distances to the planes of its triangles (the quadric
+    error), and triangles left with fewer than three distinct corners are removed.
+    :param vCoords: Coordinates of vertices on surface
+    :param vInd: Indices of vertices for each triangle on surface
+    :param cellSize: Edge length of the grid cells
+
+    :type vCoords: np.array([np.float64]) 3 x N
+    :type vInd: np.array([int]) 3 x M
+    :type cellSize: float
+
+    :return: Coordinates of vertices of the simplified mesh
+    :return: Indices of vertices for each triangle of the simplified mesh
+
+    :rtype: np.array([np.float64]) 3 x K
+    :rtype: np.array([int]) 3 x L
+    """
+    v = vCoords.T
+    cells = np.floor((v - np.amin(v, axis=0)) / cellSize).astype(int)
+    cells, cluster = np.unique(cells, axis=0, return_inverse=True)
+    cluster = cluster.reshape(-1)
+    nClusters = cells.shape[0]
+
+    # Plane of each triangle, weighted by its area
+    corners = icpm.meshTriangles(vCoords, vInd)
+    n = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]) / 2
+    area = np.sqrt(np.sum(n ** 2, axis=1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = np.where(area[:, np.newaxis] > 0, n / area[:, np.newaxis], 0)
+    d = -np.sum(n * corners[:, 0], axis=1)
+    q = area[:, np.newaxis, np.newaxis] * n[:, :, np.newaxis] * n[:, np.newaxis, :]
+    b = -(area * d)[:, np.newaxis] * n
+
+    # Sum the quadric of each triangle into the cluster of each of its corners
+    qSum = np.zeros((nClusters, 3, 3))
+    bSum = np.zeros((nClusters, 3))
+    for k in range(3):
+        np.add.at(qSum, cluster[vInd[k]], q)
+        np.add.at(bSum, cluster[vInd[k]], b)
+
+    counts = np.bincount(cluster, minlength=nClusters)
+    mean = np.zeros((nClusters, 3))
+    np.add.at(mean, cluster, v)
+    mean /= counts[:, np.newaxis]
+
+    # Minimize the quadric near the cluster mean, ignoring directions along which it is (nearly) flat
+    step = np.einsum('kij,kj->ki', np.linalg.pinv(qSum, rcond=1e-3), bSum - np.einsum('kij,kj->ki', qSum, mean))
+    reps = mean + step
+
+    newInd = cluster[vInd]
+    keep = (newInd[0] != newInd[1]) & (newInd[1] != newInd[2]) & (newInd[0] != newInd[2])
+    newInd = newInd[:, keep]
+    unique = np.unique(np.sort(newInd, axis=0), axis=1, return_index=True)[1]
+    newInd = newInd[:, np.sort(unique)]
+
+    used, newInd = np.unique(newInd, return_inverse=True)
+    return np.ascontiguousarray(reps[used].T), newInd.reshape((3, -1))
+
+
+def meshPyramid(vCoords, vInd, levels, factor=2.0, tree=None):
+    """
+    Builds successively coarser versions of a mesh, doubling (by default) the clustering cell size at each level. The
+    first cell size is twice the mean edge length of the mesh.
+    :param vCoords: Coordinates of vertices on surface
+    :param vInd: Indices of vertices for each triangle on surface
+    :param levels: Number of coarse levels to build
+    :param factor: Growth of the cell size from one level to the next
+    :param tree: Tree over the full resolution mesh, built if not given
+
+    :type vCoords: np.array([np.float64]) 3 x N
+    :type vInd: np.array([int]) 3 x M
+    :type levels: int
+    :type factor: float
+    :type tree: fct.FlatCovTree
+
+    :return: Every level, coarsest first, ending with the full resolution mesh
+    :rtype: [MeshLevel]
+    """
+    corners = icpm.meshTriangles(vCoords, vInd)
+    edges = np.concatenate([corners[:, (k + 1) % 3] - corners[:, k] for k in range(3)])
+    cellSize = 2 * np.mean(np.sqrt(np.sum(edges ** 2, axis=1)))
+
+    pyramid = [MeshLevel(vCoords, vInd, tree=tree)]
+    for k in range(levels):
+        coarse = MeshLevel(*decimate(vCoords, vInd, cellSize * factor ** k))
+        c, dist, inds = coarse.tree.find_closest_points(vCoords.T, np.inf * np.ones(vCoords.shape[1]), vCoords.T)
+        coarse.error = np.sqrt(np.mean(dist ** 2))
+        pyramid.insert(0, coarse)
+    return pyramid
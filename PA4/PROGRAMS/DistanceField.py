@@ -0,0 +1,195 @@
+import numpy as np
+import ICPmatching as icpm
+import PointCloud as pc
+import TriangleSet as ts
+import UniformGrid as ug
+
+# Arrays that, with the mesh, fully describe a DistanceField
+_ARRAYS = ('lower', 'spacing', 'shape', 'nodes', 'closest', 'triangles', 'adjacency_offsets', 'adjacency_neighbours')
+
+# Largest number of grid nodes sampled at once
+_SAMPLE_NODES = 1 << 16
+
+
+class DistanceField:
+    """
+    Closest point on a mesh, and the triangle it lies on, sampled at the nodes of a regular grid in a narrow band around
+    the surface. Only the nodes in the band are stored, by their index in the grid in increasing order, so the field
+    grows with the area of the surface rather than the volume of its bounding box. A point inside the band is matched
+    in a time that does not grow with the size of the mesh, and only logarithmically with that of the band: either
+    approximately, by trilinear interpolation of the closest points stored at the corners of its voxel, or by refining
+    that match exactly over the triangle stored at its nearest corner and every triangle sharing a vertex with it. The
+    refined match is the true closest point whenever the closest triangle is one of those, which it is for points near
+    the surface unless the mesh is much finer than the grid. Points outside the band are matched by a tree search.
+    """
+    def __init__(self, vCoords, vIndices, spacing=None, band=4):
+        """
+        Samples the closest points of a mesh on a grid.
+        :param vCoords: coordinates of all vertices on mesh
+        :param vIndices: indices of vertices for each triangle on mesh
+        :param spacing: Distance between neighbouring grid nodes, half the mean edge length of the mesh if not given
+        :param band: Farthest from the surface, in grid spacings, that nodes are sampled
+
+        :type vCoords: np.array([np.float64]) 3 x N
+        :type vIndices: np.array([int]) 3 x M
+        :type spacing: float
+        :type band: float
+        """
+        triangles = ts.fromMesh(vCoords, vIndices)
+        if spacing is None:
+            edges = np.concatenate((triangles.edges[:, 0], triangles.edges[:, 1],
+                                    triangles.edges[:, 1] - triangles.edges[:, 0]))
+            spacing = np.mean(np.sqrt(np.sum(edges ** 2, axis=1))) / 2
+        if not spacing > 0:
+            raise ValueError('Grid spacing must be positive, not ' + str(spacing))
+
+        self.vCoords = vCoords
+        self.vIndices = vIndices
+        self.spacing = float(spacing)
+        self.lower = np.amin(vCoords, axis=1) - band * self.spacing
+        upper = np.amax(vCoords, axis=1) + band * self.spacing
+        self.shape = np.ceil((upper - self.lower) / self.spacing).astype(int) + 1
+
+        # Sample the grid a block of nodes at a time, keeping the nodes whose closest point is within the band
+        grid = ug.UniformGrid.fromTriangleSet(triangles)
+        nodes = []
+        closest = []
+        tris = []
+        for start in range(0, int(np.prod(self.shape)), _SAMPLE_NODES):
+            ids = np.arange(start, min(start + _SAMPLE_NODES, np.prod(self.shape)))
+            points = self.lower + self.spacing * np.array(np.unravel_index(ids, self.shape)).T
+            c, dist, t = grid.find_closest_points(points, band * self.spacing * np.ones(ids.size), points)
+            inside = t >= 0
+            nodes.append(ids[inside])
+            closest.append(c[inside])
+            tris.append(t[inside])
+        self.nodes = np.concatenate(nodes)
+        self.closest = np.concatenate(closest)
+        self.triangles = np.concatenate(tris).astype(np.int32)
+        self.adjacency = ts.vertexAdjacency(vIndices)
+
+    @classmethod
+    def fromArrays(cls, vCoords, vIndices, arrays):
+        """
+        Recreates a field from arrays returned by toArrays, without sampling anything. The arrays are used as given, so
+        read-only memory mapped arrays can be passed directly.
+        :param vCoords: coordinates of all vertices on mesh
+        :param vIndices: indices of vertices for each triangle on mesh
+        :param arrays: Arrays of the field, by name
+
+        :type vCoords: np.array([np.float64]) 3 x N
+        :type vIndices: np.array([int]) 3 x M
+        :type arrays: dict
+
+        :return: The field holding the given arrays
+        :rtype: DistanceField
+        """
+        field = cls.__new__(cls)
+        field.vCoords = vCoords
+        field.vIndices = vIndices
+        field.lower = arrays['lower']
+        field.spacing = float(arrays['spacing'][0])
+        field.shape = arrays['shape']
+        field.nodes = arrays['nodes']
+        field.closest = arrays['closest']
+        field.triangles = arrays['triangles']
+        field.adjacency = (arrays['adjacency_offsets'], arrays['adjacency_neighbours'])
+        return field
+
+    def toArrays(self):
+        """
+        :return: Every array of the field, by name
+        :rtype: dict
+        """
+        return {'lower': self.lower, 'spacing': np.array([self.spacing]), 'shape': self.shape, 'nodes': self.nodes,
+                'closest': self.closest, 'triangles': self.triangles, 'adjacency_offsets': self.adjacency[0],
+                'adjacency_neighbours': self.adjacency[1]}
+
+    def Interpolate(self, points):
+        """
+        Approximates the closest point on the mesh to each point by trilinear interpolation of the closest points at
+        the corners of its voxel, along with the triangle of the closest point at the nearest corner.
+        :param points: Points to find the closest point to
+        :type points: np.array(np.float64) N X 3
+
+        :return closest: Approximate closest point to each point
+        :return triangles: Triangle of the closest point at the nearest corner, or -1 where a corner is outside the band
+
+        :rtype closest: np.array(np.float64) N X 3
+        :rtype triangles: np.array(int) N
+        """
+        n = points.shape[0]
+        closest = np.zeros((n, 3))
+        triangles = -np.ones(n, dtype=int)
+        if self.nodes.size == 0:
+            return closest, triangles
+
+        g = (points - self.lower) / self.spacing
+        cells = np.floor(g).astype(int)
+        inside = np.where(np.all((cells >= 0) & (cells < self.shape - 1), axis=1))[0]
+        cells = cells[inside]
+        f = g[inside] - cells
+
+        # Weight and stored position of each of the 8 corners of each voxel
+        corners = np.array([(i, j, k) for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+        ids = np.ravel_multi_index((cells[:, np.newaxis, :] + corners).reshape((-1, 3)).T, self.shape)
+        weights = np.prod(np.where(corners == 1, f[:, np.newaxis, :], 1 - f[:, np.newaxis, :]), axis=2)
+        stored = np.minimum(np.searchsorted(self.nodes, ids), self.nodes.size - 1)
+
+        valid = np.all((self.nodes[stored] == ids).reshape((-1, 8)), axis=1)
+        stored = stored.reshape((-1, 8))
+        inside, stored, weights = inside[valid], stored[valid], weights[valid]
+        closest[inside] = np.einsum('kc,kcd->kd', weights, self.closest[stored])
+        triangles[inside] = self.triangles[stored[np.arange(inside.size), np.argmax(weights, axis=1)]]
+        return closest, triangles
+
+    def match(self, s_i, tree, refine=True):
+        """
+        Finds the closest point on the mesh to each point, from the field for points inside the band and by searching
+        the tree for the others.
+        :param s_i: Points to match
+        :param tree: Tree over the mesh, searched for points outside the band
+        :param refine: True to refine each match over the nearest stored triangle and its neighbours, False to use the
+                       interpolated closest points
+
+        :type s_i: pc.PointCloud
+        :type tree: fct.FlatCovTree
+        :type refine: bool
+
+        :return: closest point on surface to each point in s_i
+        :return: index of the triangle holding each closest point, or near it if not refined
+
+        :rtype: pc.PointCloud
+        :rtype: np.array(int) N
+        """
+        s = s_i.data.T
+        closest, triangles = self.Interpolate(s)
+        if refine:
+            closest, dist, triangles = icpm.findClosestPointsNear(s, self.vCoords, self.vIndices, triangles,
+                                                                  self.adjacency)
+
+        outside = np.where(triangles < 0)[0]
+        if outside.size:
+            points = s[outside]
+            closest[outside], dist, triangles[outside] = tree.find_closest_points(
+                points, np.inf * np.ones(outside.size), points + np.inf)
+        return pc.PointCloud(closest.T), triangles
+
+
+def fromMesh(vCoords, vInd, spacing=None, band=4):
+    """
+    Samples the closest points of a mesh on a grid (see DistanceField).
+    :param vCoords: Coordinates of vertices on surface
+    :param vInd: Indices of vertices for each triangle on surface
+    :param spacing: Distance between neighbouring grid nodes, half the mean edge length of the mesh if not given
+    :param band: Farthest from the surface, in grid spacings, that nodes are sampled
+
+    :type vCoords: np.array([np.float64]), 3 x N
+    :type vInd: np.array([int]), 3 x M
+    :type spacing: float
+    :type band: float
+
+    :return: The field, reporting triangle indices in the order of vInd
+    :rtype: DistanceField
+    """
+    return DistanceField(vCoords, vInd, spacing, band)
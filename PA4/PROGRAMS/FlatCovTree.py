@@ -0,0 +1,559 @@
+import numpy as np
+import PointCloud as pc
+import Triangle as tr
+import CovTreeNode as ctn
+import TriangleSet as ts
+
+# Node arrays that, with the triangle set, fully describe a FlatCovTree
+_ARRAYS = ('rotations', 'translations', 'lower', 'upper', 'children', 'leaf_start', 'leaf_end', 'tri_ids')
+
+
+class FlatCovTree:
+    """
+    Covariance tree compiled into contiguous arrays. Node k is described by row k of each node array, and the
+    triangles of every leaf occupy one contiguous range of the triangle arrays, so a search only indexes arrays instead
+    of following Python objects.
+    """
+    def __init__(self, root, triangles=None):
+        """
+        Compiles a built covariance tree into flat arrays.
+        :param root: Root node of the covariance tree to compile
+        :param triangles: Triangles the tree was built from, used to report triangle indices in that order (optional)
+
+        :type root: CovTreeNode.CovTreeNode
+        :type triangles: np.array([Triangle])
+        """
+        nodes = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            if node.has_subtrees:
+                stack.append(node.subtrees[1])
+                stack.append(node.subtrees[0])
+
+        ids = dict((id(node), k) for k, node in enumerate(nodes))
+        if triangles is not None:
+            mesh_ids = dict((id(t), k) for k, t in enumerate(triangles))
+
+        num_nodes = len(nodes)
+        self.rotations = np.zeros((num_nodes, 3, 3))
+        self.translations = np.zeros((num_nodes, 3))
+        self.lower = np.zeros((num_nodes, 3))
+        self.upper = np.zeros((num_nodes, 3))
+        self.children = -np.ones((num_nodes, 2), dtype=np.int32)
+        self.leaf_start = np.zeros(num_nodes, dtype=np.int32)
+        self.leaf_end = np.zeros(num_nodes, dtype=np.int32)
+
+        leaf_triangles = []
+        for k, node in enumerate(nodes):
+            self.rotations[k] = node.frame.r
+            self.translations[k] = node.frame.p.flatten()
+            self.lower[k] = node.bounds[0].flatten()
+            self.upper[k] = node.bounds[1].flatten()
+            self.leaf_start[k] = len(leaf_triangles)
+            if node.has_subtrees:
+                self.children[k, 0] = ids[id(node.subtrees[0])]
+                self.children[k, 1] = ids[id(node.subtrees[1])]
+            else:
+                leaf_triangles.extend(node.triangle_list[0:node.num_tri])
+            self.leaf_end[k] = len(leaf_triangles)
+
+        corners = np.array([t.corners.data.T for t in leaf_triangles]).reshape((-1, 3, 3))
+        self.triangles = ts.TriangleSet(corners)
+        if triangles is None:
+            self.tri_ids = np.arange(len(leaf_triangles), dtype=np.int32)
+        else:
+            self.tri_ids = np.array([mesh_ids[id(t)] for t in leaf_triangles], dtype=np.int32)
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        """
+        Recreates a compiled tree from arrays returned by toArrays, without rebuilding it. The arrays are used as given,
+        so read-only memory mapped arrays can be passed directly.
+        :param arrays: Arrays of the tree, by attribute name, with the triangle arrays prefixed by 'triangles.'
+        :type arrays: dict
+
+        :return: The tree holding the given arrays
+        :rtype: FlatCovTree
+        """
+        tree = cls.__new__(cls)
+        for name in _ARRAYS:
+            setattr(tree, name, arrays[name])
+        tree.triangles = ts.TriangleSet.fromArrays(dict((name[len('triangles.'):], a) for name, a in arrays.items()
+                                                        if name.startswith('triangles.')))
+        return tree
+
+    @classmethod
+    def fromTriangleSet(cls, triangles, leaf_size=8):
+        """
+        Builds a median split tree (as CovTreeNode does with split='median') directly into arrays. Each node works on
+        a contiguous range of one permutation of the triangles: its frame comes from the eigenvectors of the covariance
+        of the corners in the range, its box from the corners in that frame, and its children from partitioning the
+        range around the median centroid coordinate along the principal axis, which takes time linear in the range
+        rather than a sort. Building takes O(n log n) whole array operations and no Python object per triangle.
+        :param triangles: Triangles to build the tree over
+        :param leaf_size: Most triangles a leaf may hold
+
+        :type triangles: ts.TriangleSet
+        :type leaf_size: int
+
+        :return: The tree, reporting triangle indices in the order of triangles
+        :rtype: FlatCovTree
+        """
+        if leaf_size < 1:
+            raise ValueError('Leaf size must be at least 1, not ' + str(leaf_size))
+
+        n = len(triangles)
+        num_nodes = 2 * n
+        rotations = np.zeros((num_nodes, 3, 3))
+        translations = np.zeros((num_nodes, 3))
+        lower = np.zeros((num_nodes, 3))
+        upper = np.zeros((num_nodes, 3))
+        children = -np.ones((num_nodes, 2), dtype=np.int32)
+        leaf_start = np.zeros(num_nodes, dtype=np.int32)
+        leaf_end = np.zeros(num_nodes, dtype=np.int32)
+
+        order = np.arange(n)
+        k = 0
+        # Range of triangles, parent and child slot of each node still to build, popped left child first so that
+        # nodes are numbered, and leaves reached, in depth first order
+        stack = [(0, n, -1, 0)]
+        while stack:
+            start, end, parent, slot = stack.pop()
+            if parent >= 0:
+                children[parent, slot] = k
+
+            inds = order[start:end]
+            points = triangles.corners[inds].reshape((-1, 3))
+            c = np.mean(points, axis=0)
+            evals, evecs = np.linalg.eigh(np.cov(points - c, rowvar=False, bias=True))
+            r = evecs[:, ::-1]
+            if np.linalg.det(r) < 0:
+                r[:, 2] = -r[:, 2]
+
+            local = (points - c).dot(r)
+            rotations[k] = r
+            translations[k] = c
+            lower[k] = np.amin(local, axis=0)
+            upper[k] = np.amax(local, axis=0)
+            leaf_start[k] = start
+            leaf_end[k] = start
+
+            if end - start > leaf_size:
+                half = (end - start) // 2
+                x = (triangles.centroids[inds] - c).dot(r[:, 0])
+                order[start:end] = inds[np.argpartition(x, half - 1)]
+                stack.append((start + half, end, k, 1))
+                stack.append((start, start + half, k, 0))
+            else:
+                leaf_end[k] = end
+            k += 1
+
+        tree = cls.__new__(cls)
+        tree.rotations = rotations[:k]
+        tree.translations = translations[:k]
+        tree.lower = lower[:k]
+        tree.upper = upper[:k]
+        tree.children = children[:k]
+        tree.leaf_start = leaf_start[:k]
+        tree.leaf_end = leaf_end[:k]
+        tree.tri_ids = order.astype(np.int32)
+        tree.triangles = triangles.Subset(order)
+        return tree
+
+    def toArrays(self):
+        """
+        :return: Every array of the tree, by attribute name, with the triangle arrays prefixed by 'triangles.'
+        :rtype: dict
+        """
+        arrays = dict((name, getattr(self, name)) for name in _ARRAYS)
+        for name, a in self.triangles.toArrays().items():
+            arrays['triangles.' + name] = a
+        return arrays
+
+    @property
+    def nbytes(self):
+        """
+        Total memory held by the tree arrays.
+        :return: Number of bytes used by all node and triangle arrays
+        :rtype: int
+        """
+        return self.triangles.nbytes + sum(getattr(self, name).nbytes for name in _ARRAYS)
+
+    def BuildStats(self):
+        """
+        Describes the shape of the tree, as CovTreeNode.BuildStats does for the tree it was compiled from.
+
+        :return depth: Number of levels below the root (0 if the root is a leaf)
+        :return num_nodes: Number of nodes in the tree
+        :return leaf_sizes: Histogram of leaf sizes: the number of leaves holding k triangles is leaf_sizes[k]
+
+        :rtype depth: int
+        :rtype num_nodes: int
+        :rtype leaf_sizes: np.array([int])
+        """
+        depth = 0
+        nodes = np.zeros(1, dtype=np.int32)
+        while True:
+            nodes = self.children[nodes[self.children[nodes, 0] >= 0]].reshape(-1)
+            if nodes.size == 0:
+                break
+            depth += 1
+
+        leaves = self.children[:, 0] < 0
+        return depth, self.children.shape[0], np.bincount(self.leaf_end[leaves] - self.leaf_start[leaves])
+
+    def FindClosestPoint(self, v, bound, closest):
+        """
+        Finds the closest point to v in the tree, walking nodes with an explicit stack. Matches the calling convention of
+        CovTreeNode.FindClosestPoint, so either can be passed to ICPmatching.ICPmatch.
+        :param v: the point to find the closest point to
+        :param bound: distance between this point and the current closest point
+        :param closest: current closest point or estimate
+
+        :type v: np.array(np.float64) 3 X 1
+        :type bound: [np.float]
+        :type closest: [np.array(np.float64) 3 X 1]
+
+        :return: None, bound and closest are updated in place
+        """
+        v = np.asarray(v, dtype=np.float64).reshape(3)
+        stack = [0]
+        while stack:
+            k = stack.pop()
+            # Node frames are rotations, so the inverse rotation is the transpose
+            local = (v - self.translations[k]).dot(self.rotations[k])
+            if np.any(local < self.lower[k] - bound[0]) or np.any(local > self.upper[k] + bound[0]):
+                continue
+
+            if self.children[k, 0] >= 0:
+                stack.append(self.children[k, 1])
+                stack.append(self.children[k, 0])
+            else:
+                self._SearchLeaf(k, v, bound, closest)
+
+    def _SearchLeaf(self, k, v, bound, closest):
+        """
+        Tests every triangle in leaf k whose bounding sphere may hold a closer point than the current bound.
+        :param k: Index of the leaf node
+        :param v: the point to find the closest point to
+        :param bound: distance between this point and the current closest point
+        :param closest: current closest point or estimate
+
+        :type k: int
+        :type v: np.array(np.float64) 3
+        :type bound: [np.float]
+        :type closest: [np.array(np.float64) 3 X 1]
+
+        :return: None, bound and closest are updated in place
+        """
+        cp, dist, ind = self.triangles.ClosestPoint(v, bound[0], slice(self.leaf_start[k], self.leaf_end[k]))
+        if cp is not None:
+            bound[0] = dist
+            closest[0] = cp
+
+    def find_closest_points(self, points, bounds, closest):
+        """
+        Finds the closest point in the tree to every point at once. All queries descend the tree together one level
+        at a time: at each level the box test is applied to every active (point, node) pair, the triangles of leaves
+        reached are tested together, and the surviving pairs are replaced by the pairs of their children. Queries with
+        no finite starting bound first take a greedy dive to a single leaf, so that the frontier is pruned from the
+        start.
+        :param points: Points to find the closest point to
+        :param bounds: Distance from each point to its current closest point (np.inf if there is no estimate)
+        :param closest: Current closest point or estimate for each point
+
+        :type points: np.array(np.float64) N X 3
+        :type bounds: np.array(np.float64) N
+        :type closest: np.array(np.float64) N X 3
+
+        :return closest: Closest point to each point
+        :return bounds: Distance from each point to its closest point
+        :return triangles: Index of the triangle each closest point lies on, or -1 where the estimate was not improved
+
+        :rtype closest: np.array(np.float64) N X 3
+        :rtype bounds: np.array(np.float64) N
+        :rtype triangles: np.array(int) N
+        """
+        points = np.asarray(points, dtype=np.float64).reshape((-1, 3))
+        bounds = np.array(bounds, dtype=np.float64).reshape(-1)
+        closest = np.array(closest, dtype=np.float64).reshape((-1, 3))
+        triangles = -np.ones(points.shape[0], dtype=int)
+
+        unbounded = np.where(~np.isfinite(bounds))[0]
+        if unbounded.size:
+            self._SearchLeaves(unbounded, self._Dive(points[unbounded]), points, bounds, closest, triangles)
+
+        self._Descend(points, bounds, lambda queries, nodes: self._SearchLeaves(queries, nodes, points, bounds, closest,
+                                                                                triangles))
+        return closest, bounds, triangles
+
+    def find_closest_points_with_gap(self, points, bounds, closest, triangles, margins):
+        """
+        Finds the closest point in the tree to every point at once, as find_closest_points does, and also how much
+        farther from each point the nearest point on any other triangle is, up to a margin. Both come from a single
+        descent, pruned by the second nearest distance found so far, or by the nearest plus the margin if that is less.
+        :param points: Points to find the closest point to
+        :param bounds: Distance from each point to its current closest point (np.inf if there is no estimate)
+        :param closest: Current closest point or estimate for each point
+        :param triangles: Index of the triangle each current estimate lies on, or -1 if it is not on a triangle
+        :param margins: Farthest beyond its closest point to look for another triangle, for each point
+
+        :type points: np.array(np.float64) N X 3
+        :type bounds: np.array(np.float64) N
+        :type closest: np.array(np.float64) N X 3
+        :type triangles: np.array(int) N
+        :type margins: np.array(np.float64) N
+
+        :return closest: Closest point to each point
+        :return bounds: Distance from each point to its closest point
+        :return triangles: Index of the triangle each closest point lies on, as given where the estimate was not
+                           improved
+        :return gaps: Distance to the nearest point on any other triangle less the distance to the closest point, or
+                      the margin if that is smaller
+
+        :rtype closest: np.array(np.float64) N X 3
+        :rtype bounds: np.array(np.float64) N
+        :rtype triangles: np.array(int) N
+        :rtype gaps: np.array(np.float64) N
+        """
+        points = np.asarray(points, dtype=np.float64).reshape((-1, 3))
+        bounds = np.array(bounds, dtype=np.float64).reshape(-1)
+        closest = np.array(closest, dtype=np.float64).reshape((-1, 3))
+        triangles = np.array(triangles, dtype=int).reshape(-1)
+        margins = np.asarray(margins, dtype=np.float64).reshape(-1)
+        second = np.inf * np.ones(points.shape[0])
+        reach = bounds + margins
+
+        self._Descend(points, reach, lambda queries, nodes: self._SearchLeavesWithGap(
+            queries, nodes, points, bounds, closest, triangles, second, reach, margins))
+        return closest, bounds, triangles, reach - bounds
+
+    def _Descend(self, points, reach, search):
+        """
+        Descends the tree for all points together one level at a time: at each level the box test is applied to every
+        active (point, node) pair, the leaves reached are searched together, and the surviving pairs are replaced by
+        the pairs of their children.
+        :param points: Points to descend for
+        :param reach: Distance within which each point still needs to be searched, updated in place by search
+        :param search: Searches the leaves of some pairs, called with the point and leaf index of each pair
+
+        :type points: np.array(np.float64) N X 3
+        :type reach: np.array(np.float64) N
+        :type search: callable
+
+        :return: None
+        """
+        queries = np.arange(points.shape[0])
+        nodes = np.zeros(points.shape[0], dtype=np.int32)
+        while queries.size:
+            local = self._LocalCoordinates(points[queries], nodes)
+            bound = reach[queries, np.newaxis]
+            inside = np.all(local >= self.lower[nodes] - bound, axis=1) & np.all(local <= self.upper[nodes] + bound,
+                                                                                 axis=1)
+            queries, nodes = queries[inside], nodes[inside]
+
+            leaf = self.children[nodes, 0] < 0
+            if np.any(leaf):
+                search(queries[leaf], nodes[leaf])
+
+            queries = np.repeat(queries[~leaf], 2)
+            nodes = self.children[nodes[~leaf]].reshape(-1)
+
+    def _LocalCoordinates(self, points, nodes):
+        """
+        Transforms each point into the frame of its paired node.
+        :param points: Points to transform
+        :param nodes: Index of the node paired with each point
+
+        :type points: np.array(np.float64) K X 3
+        :type nodes: np.array(int) K
+
+        :return: Coordinates of each point in the frame of its node
+        :rtype: np.array(np.float64) K X 3
+        """
+        return np.einsum('kij,ki->kj', self.rotations[nodes], points - self.translations[nodes])
+
+    def _BoxDistance(self, points, nodes):
+        """
+        Computes the distance from each point to the bounding box of its paired node.
+        :param points: Points to measure from
+        :param nodes: Index of the node paired with each point
+
+        :type points: np.array(np.float64) K X 3
+        :type nodes: np.array(int) K
+
+        :return: Distance from each point to its node's box, zero for points inside the box
+        :rtype: np.array(np.float64) K
+        """
+        local = self._LocalCoordinates(points, nodes)
+        outside = np.maximum(np.maximum(self.lower[nodes] - local, local - self.upper[nodes]), 0)
+        return np.sqrt(np.sum(outside ** 2, axis=1))
+
+    def _Dive(self, points):
+        """
+        Descends from the root to a single leaf for each point, always stepping into the child whose box is nearer.
+        :param points: Points to descend for
+        :type points: np.array(np.float64) K X 3
+
+        :return: Index of the leaf reached by each point
+        :rtype: np.array(int) K
+        """
+        nodes = np.zeros(points.shape[0], dtype=np.int32)
+        inner = np.where(self.children[nodes, 0] >= 0)[0]
+        while inner.size:
+            left = self.children[nodes[inner], 0]
+            right = self.children[nodes[inner], 1]
+            nearer = self._BoxDistance(points[inner], right) < self._BoxDistance(points[inner], left)
+            nodes[inner] = np.where(nearer, right, left)
+            inner = inner[self.children[nodes[inner], 0] >= 0]
+        return nodes
+
+    def _SearchLeaves(self, queries, nodes, points, bounds, closest, triangles):
+        """
+        Tests every triangle of each paired leaf against its query point, skipping triangles whose bounding sphere is
+        farther than the query's bound, and keeps the best result for each query.
+        :param queries: Index of the query point in each pair
+        :param nodes: Index of the leaf node in each pair
+        :param points: All query points
+        :param bounds: Distance from each query point to its current closest point, updated in place
+        :param closest: Current closest point to each query point, updated in place
+        :param triangles: Triangle index of each current closest point, updated in place
+
+        :type queries: np.array(int) K
+        :type nodes: np.array(int) K
+        :type points: np.array(np.float64) N X 3
+        :type bounds: np.array(np.float64) N
+        :type closest: np.array(np.float64) N X 3
+        :type triangles: np.array(int) N
+
+        :return: None
+        """
+        queries, tris, v = self._LeafPairs(queries, nodes, points, bounds)
+        if queries.size == 0:
+            return
+
+        cp = self.triangles.ClosestPointsTo(v, tris)
+        dist = np.sqrt(np.sum((cp - v) ** 2, axis=1))
+
+        # Keep the nearest triangle for each query
+        order = np.lexsort((dist, queries))
+        first = np.concatenate(([True], queries[order][1:] != queries[order][:-1]))
+        best = order[first]
+        better = dist[best] < bounds[queries[best]]
+        best = best[better]
+
+        bounds[queries[best]] = dist[best]
+        closest[queries[best]] = cp[best]
+        triangles[queries[best]] = self.tri_ids[tris[best]]
+
+    def _SearchLeavesWithGap(self, queries, nodes, points, bounds, closest, triangles, second, reach, margins):
+        """
+        Tests every triangle of each paired leaf against its query point, as _SearchLeaves does, keeping both the best
+        result for each query and the distance to the nearest other triangle.
+        :param queries: Index of the query point in each pair
+        :param nodes: Index of the leaf node in each pair
+        :param points: All query points
+        :param bounds: Distance from each query point to its current closest point, updated in place
+        :param closest: Current closest point to each query point, updated in place
+        :param triangles: Triangle index of each current closest point, updated in place
+        :param second: Distance from each query point to the nearest triangle other than its closest, updated in place
+        :param reach: Lesser of second and bounds plus margins, updated in place
+        :param margins: Farthest beyond its closest point to look for another triangle, for each query point
+
+        :type queries: np.array(int) K
+        :type nodes: np.array(int) K
+        :type points: np.array(np.float64) N X 3
+        :type bounds: np.array(np.float64) N
+        :type closest: np.array(np.float64) N X 3
+        :type triangles: np.array(int) N
+        :type second: np.array(np.float64) N
+        :type reach: np.array(np.float64) N
+        :type margins: np.array(np.float64) N
+
+        :return: None
+        """
+        queries, tris, v = self._LeafPairs(queries, nodes, points, reach)
+        if queries.size == 0:
+            return
+
+        cp = self.triangles.ClosestPointsTo(v, tris)
+        dist = np.sqrt(np.sum((cp - v) ** 2, axis=1))
+        ids = self.tri_ids[tris]
+
+        # Nearest and second nearest triangle of this pass for each query. A query meets each triangle at most once
+        # per pass, so both are distinct triangles.
+        order = np.lexsort((dist, queries))
+        queries, dist, ids, cp = queries[order], dist[order], ids[order], cp[order]
+        first = np.where(np.concatenate(([True], queries[1:] != queries[:-1])))[0]
+        q = queries[first]
+        has_next = np.concatenate((first[1:] - first[:-1] > 1, [queries.size - first[-1] > 1]))
+        next_dist = np.where(has_next, dist[np.minimum(first + 1, dist.size - 1)], np.inf)
+
+        # Merge with the current best, which becomes a second nearest candidate if it is replaced
+        better = dist[first] < bounds[q]
+        replaced = np.where(triangles[q] != ids[first], bounds[q], np.inf)
+        other = np.where(ids[first] != triangles[q], dist[first], next_dist)
+        second[q] = np.minimum(second[q], np.where(better, np.minimum(replaced, next_dist), other))
+
+        best = first[better]
+        bounds[queries[best]] = dist[best]
+        closest[queries[best]] = cp[best]
+        triangles[queries[best]] = ids[best]
+        reach[q] = np.minimum(second[q], bounds[q] + margins[q])
+
+    def _LeafPairs(self, queries, nodes, points, reach):
+        """
+        Pairs each query point with every triangle of its paired leaf whose bounding sphere is within its reach.
+        :param queries: Index of the query point in each (point, leaf) pair
+        :param nodes: Index of the leaf node in each pair
+        :param points: All query points
+        :param reach: Distance within which each query point is searched
+
+        :type queries: np.array(int) K
+        :type nodes: np.array(int) K
+        :type points: np.array(np.float64) N X 3
+        :type reach: np.array(np.float64) N
+
+        :return queries: Index of the query point in each (point, triangle) pair
+        :return tris: Position of the triangle in each pair, in the leaf ordered triangle set
+        :return v: Query point of each pair
+
+        :rtype queries: np.array(int) L
+        :rtype tris: np.array(int) L
+        :rtype v: np.array(np.float64) L X 3
+        """
+        counts = self.leaf_end[nodes] - self.leaf_start[nodes]
+        offsets = np.cumsum(counts) - counts
+        tris = np.arange(np.sum(counts)) - np.repeat(offsets - self.leaf_start[nodes], counts)
+        queries = np.repeat(queries, counts)
+
+        v = points[queries]
+        near = (np.sqrt(np.sum((self.triangles.centers[tris] - v) ** 2, axis=1)) - self.triangles.radii[tris] <=
+                reach[queries])
+        return queries[near], tris[near], v[near]
+
+
+def fromMesh(vCoords, vInd, split='median', leaf_size=8):
+    """
+    Builds the covariance tree over every triangle on a mesh and compiles it into arrays. Median split trees are built
+    directly into arrays by FlatCovTree.fromTriangleSet; sign split trees are built as CovTreeNodes and compiled.
+    :param vCoords: Coordinates of vertices on surface
+    :param vInd: Indices of vertices for each triangle on surface
+    :param split: How to split tree nodes, 'median' or 'sign' (see CovTreeNode)
+    :param leaf_size: Most triangles a leaf may hold
+
+    :type vCoords: np.array([np.float64]), 3 x N
+    :type vInd: np.array([int]), 3 x M
+    :type split: str
+    :type leaf_size: int
+
+    :return: The compiled tree, reporting triangle indices in the order of vInd
+    :rtype: FlatCovTree
+    """
+    if split == 'median':
+        return FlatCovTree.fromTriangleSet(ts.fromMesh(vCoords, vInd), leaf_size)
+
+    triangles = np.array([tr.Triangle(pc.PointCloud(vCoords[:, vInd[:, i]])) for i in range(vInd.shape[1])])
+    return FlatCovTree(ctn.CovTreeNode(triangles, vInd.shape[1], split, leaf_size), triangles)
@@ -1,3 +1,4 @@
+import numpy as np
 import scipy.linalg as scialg
 
 
@@ -5,29 +6,40 @@ class Frame:
     """
     Class for representing a coordinate frame transformation.
     """
-    def __init__(self, r, p):
+    def __init__(self, r, p, rigid=False):
         """
         Initialize F = [r, p]
 
         :param r: The rotation matrix of the frame transformation
         :param p: The translation vector of the frame transformation
+        :param rigid: True if r is known to be orthonormal, so that its inverse is its transpose
 
         :type r: numpy.array([numpy.float64][]), N x N (usually 3 x 3)
         :type p: numpy.array([numpy.float64]), N x 1
+        :type rigid: bool
         """
         self.r = r
         self.p = p
+        self.rigid = rigid
+        self._inv = None
 
     @property
     def inv(self):
         """
-        The inverse transformation
+        The inverse transformation. Computed on first access and reused afterwards, so r and p should not be modified
+        in place once the inverse has been taken.
         :return: A Frame transformation with components [r, p] corresponding to the inverse of the current
                  transformation
         :rtype: Frame
         """
-        r_inv = scialg.inv(self.r)
-        return Frame(r_inv, -r_inv.dot(self.p))
+        if self._inv is None:
+            if self.rigid:
+                r_inv = self.r.T
+            else:
+                r_inv = scialg.inv(self.r)
+            self._inv = Frame(r_inv, -r_inv.dot(self.p), self.rigid)
+            self._inv._inv = self
+        return self._inv
 
     def compose(self, f):
         """
@@ -40,4 +52,150 @@ class Frame:
                  current frame with those of f
         :rtype: Frame
         """
-        return Frame(self.r.dot(f.r), self.r.dot(f.p) + self.p)
+        return Frame(self.r.dot(f.r), self.r.dot(f.p) + self.p, self.rigid and f.rigid)
+
+
+class FrameArray:
+    """
+    Class for representing a stack of rigid coordinate frame transformations, stored as one array of rotations and one
+    array of translations rather than one Frame per transformation.
+    """
+    def __init__(self, r, p):
+        """
+        Initialize F_k = [r_k, p_k] for k = 0 ... K - 1
+
+        :param r: The rotation matrix of each frame transformation
+        :param p: The translation vector of each frame transformation
+
+        :type r: numpy.array([numpy.float64][][]), K x 3 x 3
+        :type p: numpy.array([numpy.float64][]), K x 3
+        """
+        self.r = r
+        self.p = p
+
+    def __len__(self):
+        """
+        :return: The number of frame transformations
+        :rtype: int
+        """
+        return self.r.shape[0]
+
+    def __getitem__(self, k):
+        """
+        Extracts a single frame transformation.
+
+        :param k: Index of the frame transformation
+        :type k: int
+
+        :return: The frame transformation F_k
+        :rtype: Frame
+        """
+        return Frame(self.r[k], self.p[k].reshape((3, 1)), rigid=True)
+
+    @property
+    def inv(self):
+        """
+        The inverse of each transformation, found by transposing the rotations
+        :return: A FrameArray with components [r_k, p_k] corresponding to the inverse of each transformation
+        :rtype: FrameArray
+        """
+        r_inv = self.r.transpose((0, 2, 1))
+        return FrameArray(r_inv, -np.einsum('kij,kj->ki', r_inv, self.p))
+
+    def compose(self, f):
+        """
+        Frame composition of each transformation with another set of frames f. Either side may hold a single
+        transformation, which is then composed with every transformation on the other side.
+
+        :param f: The frames to compose with
+        :type f: FrameArray or Frame
+
+        :return: A FrameArray with components corresponding to the composition of each transformation with the matching
+                 transformation of f
+        :rtype: FrameArray
+        """
+        if isinstance(f, Frame):
+            f = FrameArray(f.r[np.newaxis], f.p.reshape((1, 3)))
+        return FrameArray(np.matmul(self.r, f.r), np.einsum('kij,kj->ki', self.r, f.p) + self.p)
+
+    def apply(self, v):
+        """
+        Applies each transformation to a point, either the same point for every transformation or one point each.
+
+        :param v: The point to transform, or one point per transformation
+        :type v: numpy.array([numpy.float64]), 3 x 1, 3 or K x 3
+
+        :return: The transformed point for each transformation
+        :rtype: numpy.array([numpy.float64][]), K x 3
+        """
+        v = np.asarray(v, dtype=np.float64)
+        if v.ndim == 1 or v.shape == (3, 1):
+            return np.einsum('kij,j->ki', self.r, v.reshape(3)) + self.p
+        return np.einsum('kij,kj->ki', self.r, v) + self.p
+
+    def transform(self, data):
+        """
+        Applies each transformation to a point cloud, either the same cloud for every transformation or one cloud each.
+
+        :param data: Column vectors of the cloud to transform, or one such cloud per transformation
+        :type data: numpy.array([numpy.float64][]), 3 x N or K x 3 x N
+
+        :return: The transformed cloud for each transformation
+        :rtype: numpy.array([numpy.float64][][]), K x 3 x N
+        """
+        data = np.asarray(data, dtype=np.float64)
+        if data.ndim == 2:
+            return np.einsum('kij,jn->kin', self.r, data) + self.p[:, :, np.newaxis]
+        return np.einsum('kij,kjn->kin', self.r, data) + self.p[:, :, np.newaxis]
+
+
+def fromRotationVector(w, p):
+    """
+    Creates the rigid frame that rotates by |w| radians about the axis w (Rodrigues' formula) and then translates by p.
+
+    :param w: Rotation vector, the rotation axis scaled by the angle
+    :param p: The translation vector of the frame transformation
+
+    :type w: numpy.array([numpy.float64]), 3
+    :type p: numpy.array([numpy.float64]), 3 or 3 x 1
+
+    :return: The frame transformation [exp(w), p]
+    :rtype: Frame
+    """
+    w = np.asarray(w, dtype=np.float64).reshape(3)
+    theta = np.sqrt(w.dot(w))
+    k = np.array([[0, -w[2], w[1]],
+                  [w[2], 0, -w[0]],
+                  [-w[1], w[0], 0]])
+    if theta < 1e-12:
+        r = np.identity(3) + k
+    else:
+        k = k / theta
+        r = np.identity(3) + np.sin(theta) * k + (1 - np.cos(theta)) * k.dot(k)
+    return Frame(r, np.asarray(p, dtype=np.float64).reshape((3, 1)), rigid=True)
+
+
+def rotationVector(r):
+    """
+    Finds the rotation vector (the rotation axis scaled by the angle, in radians) of a rotation matrix, the inverse of
+    fromRotationVector.
+
+    :param r: The rotation matrix
+    :type r: numpy.array([numpy.float64][]), 3 x 3
+
+    :return: The rotation vector, with angle in [0, pi]
+    :rtype: numpy.array([numpy.float64]), 3
+    """
+    v = np.array([r[2, 1] - r[1, 2], r[0, 2] - r[2, 0], r[1, 0] - r[0, 1]])
+    theta = np.arccos(np.clip((np.trace(r) - 1) / 2, -1, 1))
+    if theta < 1e-12:
+        return v / 2
+    if np.pi - theta < 1e-6:
+        # Near a half turn v vanishes, so take the axis from the symmetric part r + I = 2 k k^T
+        b = (r + np.identity(3)) / 2
+        i = np.argmax(np.diag(b))
+        axis = b[:, i] / np.sqrt(b[i, i])
+        if axis.dot(v) < 0:
+            axis = -axis
+        return theta * axis
+    return theta / (2 * np.sin(theta)) * v
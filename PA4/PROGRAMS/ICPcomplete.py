@@ -5,33 +5,55 @@ import ICPmatching as icpm
 import ICPfilereading as icpf
 import Frame as fr
 import PointCloud as pc
-import Triangle as tr
-import CovTreeNode as ctn
+import FlatCovTree as fct
+import MeshCache as mc
+import TriangleSet as ts
+import Decimation as dc
+import IncrementalMatcher as im
 
 
-def completeICP(meshfile, bodyA, bodyB, sampleData):
+def completeICP(meshfile, bodyA, bodyB, sampleData, mesh=None, workers=1, mode='point', anderson=0, levels=0,
+                incremental=False, field=False):
     """
     :param meshfile: path to file that defines surface mesh
     :param bodyA: path to file that defines rigid body A
     :param bodyB: path to file that defines rigid body B
     :param sampleData: path to file that contains frames of sample data
+    :param mesh: Cached mesh and tree to use, opened from meshfile if not given
+    :param workers: number of processes to split each closest point search between
+    :param mode: 'point' for point-to-point ICP, or 'plane' for point-to-plane ICP
+    :param anderson: number of previous iterations used for Anderson acceleration, or 0 for none
+    :param levels: number of decimated meshes to register to before the full resolution mesh
+    :param incremental: true to only search the tree again for points whose closest triangle may have changed
+    :param field: true to match against the cached distance field of the mesh
 
     :type meshfile: str
     :type bodyA: str
     :type bodyB: str
     :type sampleData: str
+    :type mesh: mc.MeshCache
+    :type workers: int
+    :type mode: str
+    :type anderson: int
+    :type levels: int
+    :type incremental: bool
+    :type field: bool
     """
+    if mesh is None:
+        mesh = mc.MeshCache(meshfile)
 
-    vCoords, vIndices = icpf.meshDef(meshfile)
+    vCoords, vIndices = mesh.vCoords, mesh.vIndices
 
     nledA, ledA, tipA = icpf.bodyDef(bodyA)
     nledB, ledB, tipB = icpf.bodyDef(bodyB)
 
-    aFrames, bFrames = icpf.readSample(sampleData, nledA, nledB)
+    samples, aFrames, bFrames, dummy = icpf.readSampleArray(sampleData, nledA, nledB)
 
     d_kPoints = icpm.findTipB(aFrames, bFrames, ledA, tipA, ledB)
 
-    c_kPoints, F_reg = iterativeFramePointFinder(vCoords, vIndices, d_kPoints)
+    c_kPoints, F_reg = iterativeFramePointFinder(vCoords, vIndices, d_kPoints, mesh.tree, workers, mode,
+                                                 anderson, mesh.pyramid(levels) if levels else 0, incremental,
+                                                 mesh.field if field else None)
 
     s_k = d_kPoints.transform(F_reg)
     dist = icpm.calcDifference(s_k, c_kPoints)
@@ -39,16 +61,50 @@ def completeICP(meshfile, bodyA, bodyB, sampleData):
     return s_k, c_kPoints, dist
 
 
-def iterativeFramePointFinder(vCoords, vIndices, d_kPoints):
+def iterativeFramePointFinder(vCoords, vIndices, d_kPoints, tree=None, workers=1, mode='point', anderson=0,
+                              levels=0, incremental=False, field=None):
     """
     Finds registration transformation Freg between rigid body B and bone through iterative closest point finding.
+    Point-to-point ICP registers the points to their closest points on each iteration. Point-to-plane ICP instead takes
+    a Gauss-Newton step towards the planes of the triangles the closest points lie on, which lets the points slide
+    along the surface and usually converges in fewer iterations.
+    With Anderson acceleration, each new frame is extrapolated from the last few ICP updates of the rotation vector and
+    translation. If the extrapolated frame gives a larger mean squared match distance than the frame before it, it is
+    discarded for the plain ICP update and the history is cleared, so that matching has to be repeated for that
+    iteration.
+    With coarse levels, ICP starts on the coarsest of a pyramid of decimated meshes, and moves to the next finer mesh
+    once ICP converges on the current one or the root mean square match distance is within twice that mesh's own
+    distance from the full resolution mesh.
+    With incremental matching, each point only searches the tree again once it has moved far enough since its last
+    search that its closest triangle may have changed (see IncrementalMatcher); the matches are the same as without.
+    With a distance field, the full resolution mesh is matched from the field instead (see DistanceField): from the
+    interpolated closest points until ICP converges on them or the root mean square match distance is within the field
+    spacing, then from matches refined over the triangles near each point until ICP converges again. Point-to-plane
+    ICP uses refined matches from the start, as its planes are those of the matched triangles. The matches returned are
+    exact, from a tree search bounded by the last field matches. A distance field cannot be used with incremental
+    matching.
     :param vCoords: coordinates of all vertices on mesh
     :param vIndices: indices of vertices for each triangle on mesh
     :param d_kPoints: starting positions of tip of rigid body A
+    :param tree: Covariance tree over the mesh, built from vCoords and vIndices if not given
+    :param workers: number of processes to split each closest point search between
+    :param mode: 'point' for point-to-point ICP, or 'plane' for point-to-plane ICP
+    :param anderson: number of previous iterations used for Anderson acceleration, or 0 for none
+    :param levels: number of decimated meshes to register to before the full resolution mesh, or the whole pyramid as
+                   built by Decimation.meshPyramid
+    :param incremental: true to only search the tree again for points whose closest triangle may have changed
+    :param field: Distance field of the full resolution mesh to match against (optional)
 
     :type vCoords: np.array([np.float64]) 3 x N
     :type vIndices: np.array([np.float64]) 3 x M
     :type d_kPoints: pc.PointCloud
+    :type tree: fct.FlatCovTree
+    :type workers: int
+    :type mode: str
+    :type anderson: int
+    :type levels: int or [dc.MeshLevel]
+    :type incremental: bool
+    :type field: DistanceField.DistanceField
 
     :return c_kPoints: Transformed tip positions in bone coordinate system
     :return F_reg: Registration frame between bone and rigid body B
@@ -56,27 +112,100 @@ def iterativeFramePointFinder(vCoords, vIndices, d_kPoints):
     :rtype c_kPoints: pc.PointCloud
     :rtype F_reg: fr.Frame
     """
-    F_reg = fr.Frame(np.identity(3), np.zeros([3, 1]))
+    if mode not in ('point', 'plane'):
+        raise ValueError("ICP mode must be 'point' or 'plane', not " + repr(mode))
+    if incremental and field is not None:
+        raise ValueError('Incremental matching cannot be combined with a distance field')
+
+    if tree is None:
+        print('Building tree...')
+        tree = fct.fromMesh(vCoords, vIndices)
+
+    if isinstance(levels, list):
+        pyramid = levels
+    elif levels:
+        print('Decimating mesh...')
+        pyramid = dc.meshPyramid(vCoords, vIndices, levels, tree=tree)
+    else:
+        pyramid = [dc.MeshLevel(vCoords, vIndices, tree=tree)]
 
+    F_reg = fr.Frame(np.identity(3), np.zeros([3, 1]))
     nIters = 0
+    nPasses = 0
+
+    print('\nStarting ICP (point-to-' + mode + (', Anderson acceleration' if anderson else '') + '):')
+    for level in pyramid:
+        c_kPoints, F_reg, converged, iters, passes = _levelICP(level, d_kPoints, F_reg, workers, mode, anderson,
+                                                               incremental, field if level is pyramid[-1] else None)
+        nIters += iters
+        nPasses += passes
+        if len(pyramid) > 1:
+            print('Mesh with ' + str(level.vIndices.shape[1]) + ' triangles: ' + str(iters) + ' iterations, ' +
+                  str(passes) + ' match passes')
+
+    print('Point-to-' + mode + ' ICP ' + ('converged' if converged else 'stopped') + ' after ' + str(nIters) +
+          ' iterations, ' + str(nPasses) + ' match passes')
+    return c_kPoints, F_reg
+
+
+def _levelICP(level, d_kPoints, F_reg, workers, mode, anderson, incremental=False, field=None):
+    """
+    Runs ICP against one mesh of a pyramid, starting from a given registration. For any but the full resolution mesh,
+    stops early, keeping the registration it last matched from, once the root mean square match distance is within
+    twice the mesh's distance from the full resolution mesh.
+    :param level: The mesh and its tree
+    :param d_kPoints: starting positions of tip of rigid body A
+    :param F_reg: Registration frame to start from
+    :param workers: number of processes to split each closest point search between
+    :param mode: 'point' for point-to-point ICP, or 'plane' for point-to-plane ICP
+    :param anderson: number of previous iterations used for Anderson acceleration, or 0 for none
+    :param incremental: true to only search the tree again for points whose closest triangle may have changed
+    :param field: Distance field of the mesh to match against, in place of the tree (optional)
+
+    :type level: dc.MeshLevel
+    :type d_kPoints: pc.PointCloud
+    :type F_reg: fr.Frame
+    :type workers: int
+    :type mode: str
+    :type anderson: int
+    :type incremental: bool
+    :type field: DistanceField.DistanceField
 
-    triangles = []
+    :return c_kPoints: Transformed tip positions in bone coordinate system
+    :return F_reg: Registration frame between bone and rigid body B
+    :return converged: True if the registration converged, False if it stopped early or ran out of iterations
+    :return nIters: Number of ICP iterations
+    :return nPasses: Number of closest point matches
 
-    for i in range(vIndices.shape[1]):
-        t = tr.Triangle(pc.PointCloud(vCoords[:, vIndices[:, i]]))
-        triangles.append(t)
+    :rtype c_kPoints: pc.PointCloud
+    :rtype F_reg: fr.Frame
+    :rtype converged: bool
+    :rtype nIters: int
+    :rtype nPasses: int
+    """
+    vCoords, vIndices, tree = level.vCoords, level.vIndices, level.tree
 
-    triangles = np.array(triangles)
+    nIters = 0
+    nPasses = 0
+
+    if mode == 'plane':
+        normals = ts.fromMesh(vCoords, vIndices).normals
+        tri = None
 
-    print('Building tree...')
-    tree = ctn.CovTreeNode(triangles, vIndices.shape[1])
+    matcher = im.IncrementalMatcher(vCoords, vIndices, tree, workers) if incremental else None
+    # Point-to-plane ICP takes its planes from the matched triangles, which only refined matches find
+    approximate = field is not None and mode == 'point'
 
     old_pts = None
     c_kPoints = None
     prev_error = collections.deque(maxlen=4)
     prev_error.append(0)
 
-    print('\nStarting ICP:')
+    # Frame parameters before and after each ICP update, for Anderson acceleration
+    history = collections.deque(maxlen=anderson + 1)
+    match_error = np.inf
+    F_plain = None
+
     while nIters < 40:
 
         s_i = d_kPoints.transform(F_reg)
@@ -85,25 +214,138 @@ def iterativeFramePointFinder(vCoords, vIndices, d_kPoints):
             # First guess is infinity
             old_pts = pc.PointCloud(s_i.data + np.inf)
 
-        c_kPoints = icpm.ICPmatch(s_i, vCoords, vIndices, tree=tree, oldpts=old_pts, usetree=True)
+        if field is not None:
+            c_kPoints, tri = field.match(s_i, tree, refine=not approximate)
+        elif matcher is not None:
+            c_kPoints, tri = matcher.match(s_i)
+        elif mode == 'plane':
+            c_kPoints, inds = icpm.ICPmatch(s_i, vCoords, vIndices, tree=tree, oldpts=old_pts, usetree=True,
+                                            workers=workers, triangles=True)
+            # Points whose closest point did not change stay on the same triangle
+            tri = inds if tri is None else np.where(inds >= 0, inds, tri)
+            if np.any(tri < 0):
+                raise ValueError('Point-to-plane ICP needs a tree search that reports matched triangles')
+        else:
+            c_kPoints = icpm.ICPmatch(s_i, vCoords, vIndices, tree=tree, oldpts=old_pts, usetree=True,
+                                     workers=workers)
+
+        nPasses += 1
 
         # Update guess
         old_pts = c_kPoints
 
-        deltaF_reg = s_i.register(c_kPoints)
+        new_error = np.mean(np.sum((s_i.data - c_kPoints.data) ** 2, axis=0))
+        if F_plain is not None and new_error > match_error:
+            # Extrapolated frame matched worse, so take the plain ICP update instead
+            history.clear()
+            F_reg = F_plain
+            F_plain = None
+            continue
+        match_error = new_error
+
+        if level.error > 0 and np.sqrt(match_error) <= 2 * level.error:
+            # Already as close as this coarse mesh can resolve, so leave the registration for the next mesh to refine
+            return c_kPoints, F_reg, False, nIters, nPasses
+
+        if mode == 'plane':
+            deltaF_reg = s_i.registerToPlanes(c_kPoints, normals[tri].T)
+        else:
+            deltaF_reg = s_i.register(c_kPoints)
 
         F_regNew = deltaF_reg.compose(F_reg)
 
-        if isClose(.000001, F_reg, F_regNew, prev_error):
-            return c_kPoints, F_regNew
+        # With Anderson acceleration, the next frame is extrapolated from the recent updates, and is also the estimate
+        # of where ICP converges to
+        F_next = F_regNew
+        if anderson:
+            history.append((frameParameters(F_reg), frameParameters(F_regNew)))
+            if len(history) > 1:
+                x = andersonStep(history)
+                F_next = fr.fromRotationVector(x[0:3], x[3:6])
+
+        confirm = False
+        if isClose(.000001, F_reg, F_next, prev_error):
+            if not approximate and F_plain is None:
+                if field is not None:
+                    c_kPoints = _exactMatches(s_i, c_kPoints, level, workers)
+                    nPasses += 1
+                return c_kPoints, F_regNew, True, nIters + 1, nPasses
+            # Only a plain update from exact matches may end ICP: refine interpolated matches from here on, and take
+            # the plain update next rather than stopping on an extrapolated frame
+            approximate = False
+            confirm = True
+
+        if approximate and np.sqrt(match_error) <= field.spacing:
+            approximate = False
 
         print('Iteration: ' + str(nIters) + ',   error = ' + str(prev_error[-1]))
 
+        F_plain = None
+        if F_next is not F_regNew and not confirm:
+            F_plain = F_regNew
+            F_regNew = F_next
+
         F_reg = F_regNew
 
         nIters += 1
 
-    return c_kPoints, F_reg
+    if field is not None:
+        c_kPoints = _exactMatches(d_kPoints.transform(F_reg), c_kPoints, level, workers)
+        nPasses += 1
+    return c_kPoints, F_reg, False, nIters, nPasses
+
+
+def _exactMatches(s_i, c_kPoints, level, workers):
+    """
+    Finds the exact closest points on a mesh by a tree search bounded by matches from its distance field, which
+    may have missed a closer triangle away from the one stored at the nearest grid node.
+    :param s_i: Points to match
+    :param c_kPoints: Point on the mesh for each point, from the last match against the distance field
+    :param level: The mesh and its tree
+    :param workers: number of processes to split the closest point search between
+
+    :type s_i: pc.PointCloud
+    :type c_kPoints: pc.PointCloud
+    :type level: dc.MeshLevel
+    :type workers: int
+
+    :return: closest point on the mesh to each point in s_i
+    :rtype: pc.PointCloud
+    """
+    return icpm.ICPmatch(s_i, level.vCoords, level.vIndices, tree=level.tree, oldpts=c_kPoints, usetree=True,
+                         workers=workers)
+
+
+def frameParameters(f):
+    """
+    Describes a rigid frame by six parameters, its rotation vector followed by its translation.
+    :param f: The frame
+    :type f: fr.Frame
+
+    :return: Rotation vector and translation of the frame
+    :rtype: np.array([np.float64]) 6
+    """
+    return np.concatenate((fr.rotationVector(f.r), f.p.reshape(3)))
+
+
+def andersonStep(history):
+    """
+    Extrapolates the fixed point of the ICP update from its most recent applications (Anderson acceleration). The
+    result is the latest update corrected by the combination of recent changes that best cancels the latest residual.
+    :param history: Parameters before and after each recent ICP update, oldest first
+    :type history: collections.deque([(np.array([np.float64]) 6, np.array([np.float64]) 6)])
+
+    :return: Extrapolated parameters
+    :rtype: np.array([np.float64]) 6
+    """
+    x = np.array([h[0] for h in history])
+    g = np.array([h[1] for h in history])
+    f = g - x
+
+    dF = np.diff(f, axis=0)
+    dG = np.diff(g, axis=0)
+    gamma = np.linalg.lstsq(dF.T, f[-1], rcond=None)[0]
+    return g[-1] - dG.T.dot(gamma)
 
 
 def isClose(tolerance, F_reg, F_regNew, prev_error):
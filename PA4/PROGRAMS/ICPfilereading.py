@@ -1,6 +1,42 @@
 import numpy as np
+import pandas as pd
 import PointCloud as pc
 
+
+def readSampleArray(fpath, nA, nB):
+    """
+    Reads every frame of LED marker positions from a sample readings file with a single parse.
+    :param fpath: Filepath containing sample readings
+    :param nA: number of LED markers on A
+    :param nB: number of LED markers on B
+
+    :type fpath: str
+    :type nA: int
+    :type nB: int
+
+    :return: Position of every marker in every frame, indexed as [frame, marker, coordinate]
+    :return: Positions of LEDs on A in each frame, a view of the first array indexed as [frame, coordinate, marker]
+    :return: Positions of LEDs on B in each frame, a view of the first array indexed as [frame, coordinate, marker]
+    :return: Positions of the remaining (dummy) markers in each frame, a view indexed as [frame, coordinate, marker]
+
+    :rtype: np.array(float64) nSamples x nMarkers x 3
+    :rtype: np.array(float64) nSamples x 3 x nA
+    :rtype: np.array(float64) nSamples x 3 x nB
+    :rtype: np.array(float64) nSamples x 3 x (nMarkers - nA - nB)
+    """
+    with open(fpath, 'r') as f:
+        line1 = f.readline().split(',')
+    nMarkers = int(line1[0])
+    nSamples = int(line1[1])
+
+    samples = pd.read_csv(fpath, header=None, skiprows=1, nrows=nMarkers * nSamples, usecols=[0, 1, 2],
+                          skipinitialspace=True, dtype=np.float64).values.reshape((nSamples, nMarkers, 3))
+
+    frames = samples.transpose((0, 2, 1))
+
+    return samples, frames[:, :, 0:nA], frames[:, :, nA:nA + nB], frames[:, :, nA + nB:]
+
+
 def readSample(fpath, nA, nB):
     """
     Reads frames of positions of led markers on bodies A and B and creates 2 lists of pointClouds.
@@ -18,31 +54,10 @@ def readSample(fpath, nA, nB):
     :rtype: [pc.PointCloud]
     :rtype: [pc.PointCloud]
     """
-    f = open(fpath, 'r')
-
-    line1 = f.readline()
-    nMarkers = int(line1.split()[0].replace(',',''))
-    nSamples = int(line1.split()[1].replace(',',''))
-
-    aFrames = []
-    bFrames = []
-
-    for i in range(nSamples):
-        aCloud = np.zeros([3, nA])
-        bCloud = np.zeros([3, nB])
-        for j in range(nA):
-            point = f.readline().split()
-            for k in range(0, 3):
-                aCloud[k][j] = np.float64(point[k].replace(',',''))
-        for j in range(nB):
-            point = f.readline().split()
-            for k in range(0, 3):
-                bCloud[k][j] = np.float64(point[k].replace(',', ''))
-        for j in range(nMarkers - nA - nB):
-            f.readline()
-
-        aFrames.append(pc.PointCloud(aCloud))
-        bFrames.append(pc.PointCloud(bCloud))
+    samples, aData, bData, dummy = readSampleArray(fpath, nA, nB)
+
+    aFrames = [pc.PointCloud(a) for a in aData]
+    bFrames = [pc.PointCloud(b) for b in bData]
 
     return aFrames, bFrames
 
@@ -62,21 +77,14 @@ def bodyDef(fpath):
     :rtype: pc.PointCloud
     :rtype: pc.PointCloud
     """
-    f = open(fpath, 'r')
+    with open(fpath, 'r') as f:
+        nMarkers = int(f.readline().split()[0])
 
-    nMarkers = int(f.readline().split()[0])
+    points = pd.read_csv(fpath, header=None, skiprows=1, nrows=nMarkers + 1, sep=r'\s+', usecols=[0, 1, 2],
+                         dtype=np.float64).values
 
-    pcArray = np.zeros([3, nMarkers])
-
-    for i in range(nMarkers):
-        led = f.readline().split()
-        for j in range(0, 3):
-            pcArray[j][i] = np.float64(led[j])
-
-    tip = np.zeros([3, 1])
-    tipPos = f.readline().split()
-    for j in range(0, 3):
-        tip[j] = np.float64(tipPos[j])
+    pcArray = points[0:nMarkers].T
+    tip = points[nMarkers:nMarkers + 1].T
 
     ledPC = pc.PointCloud(pcArray)
     tip = pc.PointCloud(tip)
@@ -96,24 +104,13 @@ def meshDef(fpath):
     :rtype: np.array(int) 3 x nTriangles
     """
 
-    f = open(fpath, 'r')
-
-    nVertices = int(f.readline())
-
-    vCoords = np.zeros([3, nVertices])
-
-    for i in range(nVertices):
-        vertex = f.readline().split()
-        for j in range(0, 3):
-            vCoords[j][i] = np.float64(vertex[j])
-
-    nTriangles = int(f.readline())
+    with open(fpath, 'r') as f:
+        nVertices = int(f.readline())
 
-    vIndices = np.zeros([3, nTriangles], dtype=int)
+    vCoords = pd.read_csv(fpath, header=None, skiprows=1, nrows=nVertices, sep=r'\s+', usecols=[0, 1, 2],
+                          dtype=np.float64).values.T
 
-    for i in range(nTriangles):
-        triangle = f.readline().split()
-        for j in range(0, 3):
-            vIndices[j][i] = int(triangle[j])
+    vIndices = pd.read_csv(fpath, header=None, skiprows=nVertices + 2, sep=r'\s+', usecols=[0, 1, 2],
+                           dtype=int).values.T
 
     return vCoords, vIndices
\ No newline at end of file
@@ -1,6 +1,8 @@
 import numpy as np
 import numpy.linalg as numalg
 import PointCloud as pc
+import SharedMesh as sm
+import FlatCovTree as fct
 
 def findTipB(aFrames, bFrames, ledA, tipA, ledB):
     """
@@ -12,8 +14,8 @@ def findTipB(aFrames, bFrames, ledA, tipA, ledB):
     :param ledB: Position of LEDs on B rigid body in calibration frame
     :param tipB: Position of attachment of B to bone in B coordinate system
 
-    :type aFrames: [pc.PointCloud]
-    :type bFrames: [pc.PointCloud]
+    :type aFrames: [pc.PointCloud] or np.array([np.float64]) K x 3 x nA
+    :type bFrames: [pc.PointCloud] or np.array([np.float64]) K x 3 x nB
     :type ledA: pc.PointCloud
     :type tipA: pc.PointCloud
     :type ledB: pc.PointCloud
@@ -23,15 +25,10 @@ def findTipB(aFrames, bFrames, ledA, tipA, ledB):
     :rtype: pc.PointCloud
     """
 
-    d_ks = np.zeros([3, len(aFrames)])
+    regAs = pc.register_many(ledA.data, pc.stack(aFrames))
+    regBs = pc.register_many(ledB.data, pc.stack(bFrames))
 
-    for i in range(len(aFrames)):
-        regA = ledA.register(aFrames[i])
-        regB = ledB.register(bFrames[i])
-        reg = regB.inv.compose(regA)
-        d_k = reg.r.dot(tipA.data) + reg.p
-        for j in range(0, 3):
-            d_ks[j][i] = d_k[j]
+    d_ks = regBs.inv.compose(regAs).apply(tipA.data).T
 
     return pc.PointCloud(d_ks)
 
@@ -139,30 +136,289 @@ def projectOnSegment(c, p, q):
     return c_star
 
 
-def ICPmatch(s_i, vCoords, vInd, spheres=None, tree=None, oldpts=None, linear=False, usetree=True):
+# Largest number of point/triangle pairs evaluated at once by findClosestPointsBatch, to bound temporary memory
+_BATCH_PAIRS = 2 ** 18
+
+
+def meshTriangles(vCoords, vInd):
+    """
+    Gathers the corners of every triangle on a mesh into a single array.
+    :param vCoords: Coordinates of vertices
+    :param vInd: Indices of vertex coordinates for each triangle
+
+    :type vCoords: np.array([np.float64]) 3 x N
+    :type vInd: np.array([np.float64]) 3 x M
+
+    :return: Corners of each triangle, indexed as [triangle, corner, coordinate]
+    :rtype: np.array([np.float64]) M x 3 x 3
+    """
+    return np.ascontiguousarray(vCoords[:, np.asarray(vInd, dtype=int)].transpose(2, 1, 0))
+
+
+def closestPointsOnTriangles(s, a, b, c):
+    """
+    Returns the closest point to each point in s on the triangle with corners a, b, c, using closed-form barycentric
+    region tests rather than a least squares solve. All arguments broadcast against each other, so this evaluates
+    paired points and triangles (all N x 3) as well as every point against every triangle (N x 1 x 3 and 1 x M x 3).
+    :param s: points to search for closest point to
+    :param a: first vertex of each triangle
+    :param b: second vertex of each triangle
+    :param c: third vertex of each triangle
+
+    :type s: np.array([np.float64]) ... x 3
+    :type a: np.array([np.float64]) ... x 3
+    :type b: np.array([np.float64]) ... x 3
+    :type c: np.array([np.float64]) ... x 3
+
+    :return: Point on each triangle with minimum distance to the corresponding point of s
+    :rtype: np.array([np.float64]) ... x 3
+    """
+    return closestPointsFromEdges(s, a, b - a, c - a)
+
+
+def closestPointsFromEdges(s, a, ab, ac):
+    """
+    Same as closestPointsOnTriangles, for triangles given by one vertex and the two edges leaving it, so that edge vectors
+    computed ahead of time can be reused.
+    :param s: points to search for closest point to
+    :param a: first vertex of each triangle
+    :param ab: edge from the first to the second vertex of each triangle
+    :param ac: edge from the first to the third vertex of each triangle
+
+    :type s: np.array([np.float64]) ... x 3
+    :type a: np.array([np.float64]) ... x 3
+    :type ab: np.array([np.float64]) ... x 3
+    :type ac: np.array([np.float64]) ... x 3
+
+    :return: Point on each triangle with minimum distance to the corresponding point of s
+    :rtype: np.array([np.float64]) ... x 3
+    """
+    ap = s - a
+
+    d1 = np.einsum('...i,...i->...', ab, ap)
+    d2 = np.einsum('...i,...i->...', ac, ap)
+    ab_ab = np.einsum('...i,...i->...', ab, ab)
+    ab_ac = np.einsum('...i,...i->...', ab, ac)
+    ac_ac = np.einsum('...i,...i->...', ac, ac)
+
+    # Projections of s - b and s - c onto both edges, derived from d1 and d2
+    d3 = d1 - ab_ab
+    d4 = d2 - ab_ac
+    d5 = d1 - ab_ac
+    d6 = d2 - ac_ac
+
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Start from the projection into the face, then overwrite with each Voronoi region in reverse order of
+        # precedence, so that vertex regions take priority over edge regions and edge regions over the face
+        denom = va + vb + vc
+        l = vb / denom
+        u = vc / denom
+
+        region = (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+        t = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+        l = np.where(region, 1 - t, l)
+        u = np.where(region, t, u)
+
+        region = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+        t = d2 / (d2 - d6)
+        l = np.where(region, 0, l)
+        u = np.where(region, t, u)
+
+        region = (d6 >= 0) & (d5 <= d6)
+        l = np.where(region, 0, l)
+        u = np.where(region, 1, u)
+
+        region = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+        t = d1 / (d1 - d3)
+        l = np.where(region, t, l)
+        u = np.where(region, 0, u)
+
+        region = (d3 >= 0) & (d4 <= d3)
+        l = np.where(region, 1, l)
+        u = np.where(region, 0, u)
+
+        region = (d1 <= 0) & (d2 <= 0)
+        l = np.where(region, 0, l)
+        u = np.where(region, 0, u)
+
+    return a + l[..., np.newaxis] * ab + u[..., np.newaxis] * ac
+
+
+def findClosestPointsBatch(s, triangles):
+    """
+    Finds the closest point on a mesh to each of a set of points by evaluating every point against every triangle in
+    vectorized blocks.
+    :param s: Points to find the closest point to
+    :param triangles: Corners of each triangle on the mesh, as returned by meshTriangles
+
+    :type s: np.array([np.float64]) N x 3
+    :type triangles: np.array([np.float64]) M x 3 x 3
+
+    :return c: Closest point on the mesh to each point in s
+    :return dist: Distance from each point in s to its closest point
+    :return inds: Index of the triangle each closest point lies on
+
+    :rtype c: np.array([np.float64]) N x 3
+    :rtype dist: np.array([np.float64]) N
+    :rtype inds: np.array([int]) N
+    """
+    s = np.asarray(s, dtype=np.float64).reshape((-1, 3))
+    n = s.shape[0]
+    m = triangles.shape[0]
+
+    c = np.zeros((n, 3))
+    dist = np.zeros(n)
+    inds = np.zeros(n, dtype=int)
+
+    a = triangles[np.newaxis, :, 0, :]
+    b = triangles[np.newaxis, :, 1, :]
+    t = triangles[np.newaxis, :, 2, :]
+
+    step = max(1, _BATCH_PAIRS // max(m, 1))
+    for start in range(0, n, step):
+        end = min(start + step, n)
+        block = s[start:end, np.newaxis, :]
+        cp = closestPointsOnTriangles(block, a, b, t)
+        d = np.sqrt(np.sum((cp - block) ** 2, axis=2))
+        # Degenerate triangles produce NaN distances; never select them
+        d[np.isnan(d)] = np.inf
+        best = np.argmin(d, axis=1)
+        rows = np.arange(end - start)
+        c[start:end] = cp[rows, best]
+        dist[start:end] = d[rows, best]
+        inds[start:end] = best
+
+    return c, dist, inds
+
+
+def findClosestPointsNear(s, vCoords, vInd, near, adjacency):
+    """
+    Finds the closest point to each of a set of points on one triangle and the triangles around it, evaluating all
+    pairs at once.
+    :param s: Points to find the closest point to
+    :param vCoords: Coordinates of vertices on surface
+    :param vInd: Indices of vertices for each triangle on surface
+    :param near: Index of the triangle to search around for each point, or -1 to not search for that point
+    :param adjacency: Neighbours of each triangle, as returned by TriangleSet.vertexAdjacency
+
+    :type s: np.array([np.float64]) N x 3
+    :type vCoords: np.array([np.float64]) 3 x K
+    :type vInd: np.array([int]) 3 x M
+    :type near: np.array([int]) N
+    :type adjacency: (np.array([int]) M + 1, np.array([int]))
+
+    :return c: Closest point on the searched triangles to each point in s
+    :return dist: Distance from each point in s to its closest point, np.inf if it was not searched
+    :return inds: Index of the triangle each closest point lies on, -1 if it was not searched
+
+    :rtype c: np.array([np.float64]) N x 3
+    :rtype dist: np.array([np.float64]) N
+    :rtype inds: np.array([int]) N
+    """
+    offsets, neighbours = adjacency
+    n = s.shape[0]
+    c = np.zeros((n, 3))
+    dist = np.inf * np.ones(n)
+    inds = -np.ones(n, dtype=int)
+
+    queries = np.where(near >= 0)[0]
+    starts = offsets[near[queries]]
+    counts = offsets[near[queries] + 1] - starts
+    first = np.cumsum(counts) - counts
+    tris = neighbours[np.arange(np.sum(counts)) - np.repeat(first - starts, counts)]
+    queries = np.repeat(queries, counts)
+    if queries.size == 0:
+        return c, dist, inds
+
+    v = s[queries]
+    cp = closestPointsOnTriangles(v, *[vCoords[:, vInd[k, tris]].T for k in range(3)])
+    d = np.sqrt(np.sum((cp - v) ** 2, axis=1))
+    d[np.isnan(d)] = np.inf
+
+    # Keep the nearest triangle for each point. Every triangle neighbours itself, so no point has an empty range.
+    nearest = np.repeat(np.minimum.reduceat(d, first), counts) == d
+    best = np.maximum.reduceat(np.where(nearest, np.arange(d.size), -1), first)
+    c[queries[best]] = cp[best]
+    dist[queries[best]] = d[best]
+    inds[queries[best]] = tris[best]
+    return c, dist, inds
+
+
+def ICPmatch(s_i, vCoords, vInd, spheres=None, tree=None, oldpts=None, linear=False, usetree=True, workers=1,
+             triangles=False, oldtriangles=None, adjacency=None):
     """
     Finds the closest point on a given surface for each point in a given PointCloud
     :param s_i: PointCloud of points to find closest point
     :param vCoords: Coordinates of each vertex on surface
     :param vInd: Indices of vertices for each triangle on surface
     :param spheres: List of bounding spheres around triangles on surface.
-    :param tree: tree data strucutre to search from (optional)
+    :param tree: tree data strucutre to search from (optional), queried for all points at once if it supports it
     :param oldpts: old closest points (optional)
-    :param linear: true if linear search should be performed
+    :param linear: true if linear search should be performed (vectorized over all points and triangles at once)
     :param usetree: true if tree search should be used
+    :param workers: number of processes to split a tree search between, sharing the tree through shared memory. Only
+                    a FlatCovTree can be shared.
+    :param triangles: true to also return the index of the triangle each closest point lies on
+    :param oldtriangles: triangle each old closest point lies on (optional), -1 where unknown. With adjacency, a
+                         batched tree search first tries these triangles and their neighbours, so that it starts from
+                         a tight bound.
+    :param adjacency: neighbours of each triangle on surface, as returned by TriangleSet.vertexAdjacency (optional)
 
     :type s_i: PointCloud.PointCloud
     :type vCoords: np.array([np.float64]) 3 x N
     :type vInd: np.array([np.float64]) 3 x M
     :type spheres: [bs.BoundingSphere]
-    :type tree: tree.CovTreeNode
+    :type tree: CovTreeNode.CovTreeNode, FlatCovTree.FlatCovTree or UniformGrid.UniformGrid
     :type oldpts: pc.PointCloud
     :type linear: bool
     :type usetree: bool
+    :type workers: int
+    :type triangles: bool
+    :type oldtriangles: np.array(int) N
+    :type adjacency: (np.array([int]), np.array([int]))
 
     :return: closest point on surface to each point in s_i
+    :return: index of the triangle holding each closest point, only if triangles is true. Only linear and batched tree
+             searches find these; -1 is returned otherwise, and by tree searches where oldpts was not improved on and
+             oldtriangles does not give its triangle.
     :rtype: pc.PointCloud
+    :rtype: np.array(int) N
     """
+    if linear:
+        c, dist, inds = findClosestPointsBatch(s_i.data.T, meshTriangles(vCoords, vInd))
+        if triangles:
+            return pc.PointCloud(c.T), inds
+        return pc.PointCloud(c.T)
+
+    if usetree and hasattr(tree, 'find_closest_points'):
+        if workers > 1 and not isinstance(tree, fct.FlatCovTree):
+            # Workers attach to the arrays of a FlatCovTree in shared memory
+            raise ValueError('Splitting a search between ' + str(workers) + ' workers needs a FlatCovTree, not ' +
+                             type(tree).__name__)
+        bounds = np.linalg.norm(oldpts.data - s_i.data, axis=0)
+        closest = oldpts.data.T
+        if oldtriangles is not None and adjacency is not None:
+            # Start from the best point on or around each old triangle
+            c, dist, near = findClosestPointsNear(s_i.data.T, vCoords, vInd, oldtriangles, adjacency)
+            better = dist < bounds
+            bounds = np.where(better, dist, bounds)
+            closest = np.where(better[:, np.newaxis], c, closest)
+            oldtriangles = np.where(better, near, oldtriangles)
+
+        if workers > 1:
+            c, bounds, inds = sm.findClosestPointsParallel(tree, s_i.data.T, bounds, closest, workers)
+        else:
+            c, bounds, inds = tree.find_closest_points(s_i.data.T, bounds, closest)
+        if oldtriangles is not None:
+            inds = np.where(inds >= 0, inds, oldtriangles)
+        if triangles:
+            return pc.PointCloud(c.T), inds
+        return pc.PointCloud(c.T)
+
     c_ij = np.zeros([3, np.shape(s_i.data)[1]])
     old = None
     closest_pts = None
@@ -170,10 +426,7 @@ def ICPmatch(s_i, vCoords, vInd, spheres=None, tree=None, oldpts=None, linear=Fa
         old = oldpts
         closest_pts = old
     for i in range(np.shape(s_i.data)[1]):
-        if linear:
-            c = findClosestPointLinear(s_i.data[:, i], vCoords, vInd)
-            c_ij[:, i] = c[:]
-        elif usetree:
+        if usetree:
             old_i = closest_pts.data[:, i]
             dist = np.linalg.norm(old_i - s_i.data[:, i])
             closest = [old_i]
@@ -183,6 +436,8 @@ def ICPmatch(s_i, vCoords, vInd, spheres=None, tree=None, oldpts=None, linear=Fa
         else:
             c = findClosestPoint(s_i.data[:, i], vCoords, vInd, spheres)
             c_ij[:, i] = c[:]
+    if triangles:
+        return pc.PointCloud(c_ij), -np.ones(c_ij.shape[1], dtype=int)
     return pc.PointCloud(c_ij)
 
 
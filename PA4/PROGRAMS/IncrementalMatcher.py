@@ -0,0 +1,96 @@
+import numpy as np
+import ICPmatching as icpm
+import PointCloud as pc
+import TriangleSet as ts
+import SharedMesh as sm
+
+# Multiple of a point's last motion searched beyond its closest point for the next nearest triangle
+_MARGIN = 4.0
+
+
+class IncrementalMatcher:
+    """
+    Repeats closest point matching for a set of points that move a little between matches, as on successive ICP
+    iterations, giving the same result as matching every point from scratch. Each point remembers where it was last
+    searched from (its anchor), the triangle its closest point was on, and a lower bound on how much farther the
+    nearest other triangle was (the gap). A point that has moved by less than half its gap since its anchor is still
+    closest to the same triangle, since that triangle came at most that far closer and every other triangle at most
+    that far farther, so its closest point is found on that triangle alone. Only the other points search the tree.
+    """
+    def __init__(self, vCoords, vIndices, tree, workers=1):
+        """
+        :param vCoords: coordinates of all vertices on mesh
+        :param vIndices: indices of vertices for each triangle on mesh
+        :param tree: Covariance tree over the mesh
+        :param workers: number of processes to split each tree search between
+
+        :type vCoords: np.array([np.float64]) 3 x N
+        :type vIndices: np.array([int]) 3 x M
+        :type tree: fct.FlatCovTree
+        :type workers: int
+        """
+        self.vCoords = vCoords
+        self.vIndices = vIndices
+        self.tree = tree
+        self.workers = workers
+        self.triangles = ts.fromMesh(vCoords, vIndices)
+
+        self.anchors = None
+        self.closest = None
+        self.tri = None
+        self.gap = None
+
+        # Number of points matched, and how many of them searched the tree
+        self.matched = 0
+        self.searched = 0
+
+    def match(self, s_i):
+        """
+        Finds the closest point on the mesh to each point.
+        :param s_i: Points to match, the same points as on the last call after any motion
+        :type s_i: pc.PointCloud
+
+        :return: closest point on surface to each point in s_i
+        :return: index of the triangle holding each closest point
+
+        :rtype: pc.PointCloud
+        :rtype: np.array(int) N
+        """
+        s = s_i.data.T
+        n = s.shape[0]
+        if self.anchors is None:
+            c, tri = icpm.ICPmatch(s_i, self.vCoords, self.vIndices, tree=self.tree,
+                                   oldpts=pc.PointCloud(s_i.data + np.inf), usetree=True, workers=self.workers,
+                                   triangles=True)
+            self.anchors = s.copy()
+            self.closest = c.data.T
+            self.tri = tri
+            self.gap = np.zeros(n)
+            self.matched += n
+            self.searched += n
+            return c, tri.copy()
+
+        moved = np.sqrt(np.sum((s - self.anchors) ** 2, axis=1))
+        self.closest = self.triangles.ClosestPointsTo(s, self.tri)
+
+        search = np.where((2 * moved >= self.gap) & (moved > 0))[0]
+        if search.size:
+            # Start from the closest point on the old triangle
+            points = s[search]
+            closest = self.closest[search]
+            bounds = np.sqrt(np.sum((closest - points) ** 2, axis=1))
+            margins = _MARGIN * moved[search]
+            if self.workers > 1:
+                c, bounds, tri, gap = sm.findClosestPointsWithGapParallel(self.tree, points, bounds, closest,
+                                                                          self.tri[search], margins, self.workers)
+            else:
+                c, bounds, tri, gap = self.tree.find_closest_points_with_gap(points, bounds, closest, self.tri[search],
+                                                                             margins)
+            self.closest[search] = c
+            self.tri[search] = tri
+            self.gap[search] = gap
+            self.anchors[search] = points
+
+        self.matched += n
+        self.searched += search.size
+        return pc.PointCloud(self.closest.T), self.tri.copy()
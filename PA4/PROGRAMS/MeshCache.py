@@ -0,0 +1,207 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+import ICPfilereading as icpf
+import FlatCovTree as fct
+import Decimation as dc
+import DistanceField as df
+
+# Changed whenever the cached arrays or the way the tree is built change, so that older caches are rebuilt
+CACHE_VERSION = 4
+
+
+class MeshCache:
+    """
+    Binary cache of a surface mesh and its compiled covariance tree. The arrays are stored as .npy files in a directory
+    named after the content hash of the mesh file, and are memory mapped read-only the first time they are used, so a
+    mesh that has been seen before is neither parsed nor rebuilt. The distance field of the mesh is only sampled when
+    it is first asked for, and is then cached in a subdirectory in the same way.
+    """
+    def __init__(self, meshfile, cache_dir=None):
+        """
+        Locates the cache for a mesh file. Nothing is read or built until the mesh or tree is first used.
+        :param meshfile: path to file that defines surface mesh
+        :param cache_dir: Directory holding cached meshes (the directory of meshfile by default)
+
+        :type meshfile: str
+        :type cache_dir: str
+        """
+        if cache_dir is None:
+            cache_dir = os.path.dirname(os.path.abspath(meshfile))
+
+        self.meshfile = meshfile
+        self.key = meshKey(meshfile)
+        self.path = os.path.join(cache_dir, 'mesh-' + self.key[0:16])
+        self._arrays = None
+        self._tree = None
+        self._field = None
+        self._pyramids = {}
+
+    @property
+    def vCoords(self):
+        """
+        :return: Coordinates of vertices on mesh
+        :rtype: np.array([np.float64]) 3 x N
+        """
+        return self._Arrays()['vCoords']
+
+    @property
+    def vIndices(self):
+        """
+        :return: Indices of vertices for each triangle on mesh
+        :rtype: np.array([int]) 3 x M
+        """
+        return self._Arrays()['vIndices']
+
+    @property
+    def tree(self):
+        """
+        :return: Covariance tree over every triangle on mesh
+        :rtype: fct.FlatCovTree
+        """
+        if self._tree is None:
+            self._tree = fct.FlatCovTree.fromArrays(self._Arrays())
+        return self._tree
+
+    @property
+    def field(self):
+        """
+        :return: Closest points of the mesh sampled in a narrow band around it, sampled and cached if not already
+        :rtype: df.DistanceField
+        """
+        if self._field is None:
+            vCoords, vIndices = self.vCoords, self.vIndices
+            path = os.path.join(self.path, 'field')
+            if not _isValid(path, self.key):
+                print('Building distance field...')
+                _writeArrays(path, df.fromMesh(vCoords, vIndices).toArrays(), self.key)
+            self._field = df.DistanceField.fromArrays(vCoords, vIndices, _loadArrays(path))
+        return self._field
+
+    def pyramid(self, levels):
+        """
+        Decimates the mesh into coarser levels, building a tree for each. Pyramids are kept in memory, so each is only
+        built once per process.
+        :param levels: Number of coarse levels
+        :type levels: int
+
+        :return: Every level, coarsest first, ending with the full resolution mesh
+        :rtype: [dc.MeshLevel]
+        """
+        if levels not in self._pyramids:
+            self._pyramids[levels] = dc.meshPyramid(self.vCoords, self.vIndices, levels, tree=self.tree)
+        return self._pyramids[levels]
+
+    def _Arrays(self):
+        """
+        Memory maps every cached array, first building the cache if it is missing or was made from other contents.
+        :return: Cached arrays, by name
+        :rtype: dict
+        """
+        if self._arrays is None:
+            if not self._IsValid():
+                self._Build()
+            self._arrays = _loadArrays(self.path)
+        return self._arrays
+
+    def _IsValid(self):
+        """
+        :return: True if the cache directory exists and was built from a mesh file with the same hash
+        :rtype: bool
+        """
+        return _isValid(self.path, self.key)
+
+    def _Build(self):
+        """
+        Parses the mesh file, builds its tree and writes every array to the cache directory.
+        :return: None
+        """
+        print('Building mesh cache...')
+        vCoords, vIndices = icpf.meshDef(self.meshfile)
+        arrays = fct.fromMesh(vCoords, vIndices).toArrays()
+        arrays['vCoords'] = vCoords
+        arrays['vIndices'] = vIndices
+        _writeArrays(self.path, arrays, self.key)
+
+
+def _isValid(path, key):
+    """
+    :param path: A cache directory
+    :param key: Hash of the mesh file the directory should have been built from
+
+    :type path: str
+    :type key: str
+
+    :return: True if the directory exists and was built from a mesh file with the given hash
+    :rtype: bool
+    """
+    try:
+        with open(os.path.join(path, 'KEY'), 'r') as f:
+            return f.read().strip() == key
+    except IOError:
+        return False
+
+
+def _loadArrays(path):
+    """
+    Memory maps every array in a cache directory read-only.
+    :param path: The cache directory
+    :type path: str
+
+    :return: Cached arrays, by name
+    :rtype: dict
+    """
+    return dict((name[:-len('.npy')], np.load(os.path.join(path, name), mmap_mode='r'))
+                for name in os.listdir(path) if name.endswith('.npy'))
+
+
+def _writeArrays(path, arrays, key):
+    """
+    Writes arrays to a cache directory, replacing it if it exists. The arrays are written to a temporary directory that
+    is then renamed, so concurrent runs never see a partly written cache.
+    :param path: The cache directory
+    :param arrays: Arrays to write, by name
+    :param key: Hash of the mesh file the arrays were built from
+
+    :type path: str
+    :type arrays: dict
+    :type key: str
+
+    :return: None
+    """
+    parent = os.path.dirname(path)
+    tmp = tempfile.mkdtemp(prefix='.' + os.path.basename(path) + '-', dir=parent)
+    try:
+        for name, a in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(a))
+        with open(os.path.join(tmp, 'KEY'), 'w') as f:
+            f.write(key + '\n')
+
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Another process finished the same cache first
+            if not _isValid(path, key):
+                raise
+    finally:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def meshKey(meshfile):
+    """
+    Computes a hash identifying a mesh file by its contents and the cache version.
+    :param meshfile: path to file that defines surface mesh
+    :type meshfile: str
+
+    :return: hexadecimal SHA-1 digest
+    :rtype: str
+    """
+    h = hashlib.sha1(str(CACHE_VERSION).encode('ascii'))
+    with open(meshfile, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
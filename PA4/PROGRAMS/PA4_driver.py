@@ -1,9 +1,15 @@
 import numpy as np
 import sys, os
 import time
+import glob
+import multiprocessing
 import testICP as test
 import ICPcomplete as icp
 import ICPmatching as icpm
+import MeshCache as mc
+
+# Mesh and tree shared by every dataset run in a batch worker process
+_batchMesh = None
 
 
 def main():
@@ -19,32 +25,95 @@ def main():
             tolerance = float(sys.argv[2])
             # run tests with given tolerance
             test.testFindTipB(tolerance)
+            test.testRegisterMany(tolerance)
+            test.testFrameInverse(tolerance)
+            test.testFrameArray(tolerance)
+            test.testReadSampleArray(tolerance)
+            test.testRegisterToPlanes(tolerance)
+            test.testAnderson(tolerance)
+            test.testAndersonDebugSets()
             test.testProjectOnSegment(tolerance)
             test.testFindClosestPoint(tolerance)
             test.testICPMatchLinear(tolerance)
+            test.testClosestPointsBatch(tolerance)
             print('\nTest Bounding Spheres')
             test.testMakeSphere(tolerance)
             test.testICPSpherical(tolerance)
             test.testTriangle(tolerance)
+            test.testTriangleSet(tolerance)
             test.testICPTree(tolerance)
+            test.testFlatTree(tolerance)
+            test.testBatchedTree(tolerance)
+            test.testMeshCache(tolerance)
+            test.testSharedMesh(tolerance)
+            test.testDecimation(tolerance)
+            test.testWarmStart(tolerance)
+            test.testIncrementalMatch(tolerance)
+            test.testTreeBuild(tolerance)
+            test.testTreeFromTriangleSet(tolerance)
+            test.testTreeIterative(tolerance)
+            test.testBestFirst(tolerance)
+            test.testLeafBuckets(tolerance)
+            test.testUniformGrid(tolerance)
+            test.testDistanceField(tolerance)
         else:
             # run tests with no given tolerance
             test.testFindTipB()
+            test.testRegisterMany()
+            test.testFrameInverse()
+            test.testFrameArray()
+            test.testReadSampleArray()
+            test.testRegisterToPlanes()
+            test.testAnderson()
+            test.testAndersonDebugSets()
             test.testProjectOnSegment()
             test.testFindClosestPoint()
             test.testICPMatchLinear()
+            test.testClosestPointsBatch()
             print('\nTest Bounding Spheres')
             test.testMakeSphere()
             test.testICPSpherical()
             test.testTriangle()
+            test.testTriangleSet()
             test.testICPTree()
+            test.testFlatTree()
+            test.testBatchedTree()
+            test.testMeshCache()
+            test.testSharedMesh()
+            test.testDecimation()
+            test.testWarmStart()
+            test.testIncrementalMatch()
+            test.testTreeBuild()
+            test.testTreeFromTriangleSet()
+            test.testTreeIterative()
+            test.testBestFirst()
+            test.testLeafBuckets()
+            test.testUniformGrid()
+            test.testDistanceField()
 
         print('\nAll tests passed!')
         sys.exit(0)
 
+    args = sys.argv[1:]
+    mode = _popOption(args, '--mode', 'point')
+    anderson = int(_popOption(args, '--anderson', 0))
+    levels = int(_popOption(args, '--levels', 0))
+    incremental = _popFlag(args, '--incremental')
+    field = _popFlag(args, '--field')
+    workers = int(_popOption(args, '--workers', 1))
+
+    # Add 'batch' command line option
+    if str(args[0]) == 'batch':
+        jobs = int(_popOption(args, '--jobs', multiprocessing.cpu_count()))
+
+        batch(args[1], args[2:], jobs, mode, anderson, levels, incremental, field, workers)
+
+        print('runtime = ' + str(time.time() - stime))
+        sys.exit(0)
+
     # Parse arguments for regular execution
-    directory = sys.argv[1]
-    dataset = sys.argv[2]
+    directory = args[0]
+    dataset = args[1]
 
     surface = os.getcwd() + directory + '/Problem4MeshFile.sur'
     bodyA = os.getcwd() + directory + '/Problem4-BodyA.txt'
@@ -53,26 +122,182 @@ def main():
     os.chdir("..")
     outname = os.getcwd() + '/OUTPUT/PA4-' + dataset + '-Output.txt'
 
-    tofile(surface, bodyA, bodyB, testData, outname)
+    tofile(surface, bodyA, bodyB, testData, outname, mode, anderson, levels, incremental, field, workers)
+
+    print('runtime = ' + str(time.time() - stime))
+
+
+def _popOption(args, name, default):
+    """
+    Removes an option and its value from a list of command line arguments.
+    :param args: command line arguments, modified in place
+    :param name: name of the option, e.g. --jobs
+    :param default: value to return if the option is not given
+
+    :type args: [str]
+    :type name: str
+
+    :return: value of the option
+    :rtype: str
+    """
+    if name not in args:
+        return default
+    k = args.index(name)
+    value = args[k + 1]
+    del args[k:k + 2]
+    return value
+
+
+def _popFlag(args, name):
+    """
+    Removes a flag from a list of command line arguments.
+    :param args: command line arguments, modified in place
+    :param name: name of the flag, e.g. --incremental
+
+    :type args: [str]
+    :type name: str
+
+    :return: True if the flag was given
+    :rtype: bool
+    """
+    if name not in args:
+        return False
+    args.remove(name)
+    return True
+
+
+def batch(directory, datasets, jobs, mode='point', anderson=0, levels=0, incremental=False, field=False, workers=1):
+    """
+    Runs ICP on several data sets that share one surface mesh, in parallel. The mesh and its tree are loaded once into
+    the binary mesh cache before any worker starts, and every worker memory maps the same cache files read-only, so the
+    mesh is parsed and the tree built at most once and their pages are shared by all workers. Each output file is
+    written to OUTPUT as for a single data set. Worker processes cannot start processes of their own, so splitting
+    each closest point search between workers needs jobs = 1, which runs the data sets one after another in this
+    process.
+    :param directory: Directory containing the mesh, body and sample files
+    :param datasets: Names of the data sets (x-ddddd), or just their letters (x)
+    :param jobs: Number of worker processes
+    :param mode: 'point' for point-to-point ICP, or 'plane' for point-to-plane ICP
+    :param anderson: number of previous iterations used for Anderson acceleration, or 0 for none
+    :param levels: number of decimated meshes to register to before the full resolution mesh
+    :param incremental: true to only search the tree again for points whose closest triangle may have changed
+    :param field: true to match against the cached distance field of the mesh
+    :param workers: number of processes to split each closest point search between
+
+    :type directory: str
+    :type datasets: [str]
+    :type jobs: int
+    :type mode: str
+    :type anderson: int
+    :type levels: int
+    :type incremental: bool
+    :type field: bool
+    :type workers: int
+    """
+    if workers > 1 and jobs > 1:
+        raise ValueError('Splitting searches between ' + str(workers) + ' workers needs --jobs 1, not ' + str(jobs))
+
+    directory = os.path.abspath(directory)
+    surface = os.path.join(directory, 'Problem4MeshFile.sur')
+    outdir = os.path.join(os.path.dirname(os.path.abspath(os.getcwd())), 'OUTPUT')
+
+    # Build the cache (if needed) in this process so workers only map it
+    mesh = mc.MeshCache(surface)
+    mesh.tree
+    if field:
+        mesh.field
+
+    runs = []
+    for dataset in datasets:
+        if '-' not in dataset:
+            matches = glob.glob(os.path.join(directory, 'PA4-' + dataset + '-*-SampleReadingsTest.txt'))
+            if len(matches) != 1:
+                raise ValueError('Data set ' + dataset + ' does not name exactly one sample file in ' + directory)
+            dataset = os.path.basename(matches[0])[len('PA4-'):-len('-SampleReadingsTest.txt')]
+
+        runs.append((os.path.join(directory, 'PA4-' + dataset + '-SampleReadingsTest.txt'),
+                     os.path.join(outdir, 'PA4-' + dataset + '-Output.txt')))
+
+    bodyA = os.path.join(directory, 'Problem4-BodyA.txt')
+    bodyB = os.path.join(directory, 'Problem4-BodyB.txt')
+
+    runs = [(bodyA, bodyB, testData, outname, mode, anderson, levels, incremental, field, workers)
+            for testData, outname in runs]
+    if workers > 1:
+        _initBatchWorker(surface)
+        for run in runs:
+            print('Wrote ' + _runBatchDataset(run))
+        return
+
+    pool = multiprocessing.Pool(min(jobs, len(runs)), _initBatchWorker, (surface,))
+    try:
+        for outname in pool.map(_runBatchDataset, runs):
+            print('Wrote ' + outname)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _initBatchWorker(meshfile):
+    """
+    Opens the shared mesh cache in a batch worker process.
+    :param meshfile: path to file that defines surface mesh
+    :type meshfile: str
+    """
+    global _batchMesh
+    _batchMesh = mc.MeshCache(meshfile)
+
+
+def _runBatchDataset(run):
+    """
+    Runs ICP on one data set of a batch against the worker's shared mesh and writes its output file.
+    :param run: paths to the body A, body B, sample data and output files, the ICP mode, Anderson depth, number
+                of coarse mesh levels, whether to match incrementally, whether to match against the distance field
+                and the number of processes to split each closest point search between
+    :type run: (str, str, str, str, str, int, int, bool, bool, int)
+
+    :return: path of the output file written
+    :rtype: str
+    """
+    bodyA, bodyB, sampleData, outfile, mode, anderson, levels, incremental, field, workers = run
+    d_kPoints, c_kPoints, dist = icp.completeICP(_batchMesh.meshfile, bodyA, bodyB, sampleData, _batchMesh,
+                                                 workers=workers, mode=mode, anderson=anderson, levels=levels,
+                                                 incremental=incremental, field=field)
+    writefile(d_kPoints, c_kPoints, dist, outfile)
+    return outfile
 
-    print "runtime = " + str(time.time() - stime)
 
-def tofile(meshfile, bodyA, bodyB, sampleData, outfile):
+def tofile(meshfile, bodyA, bodyB, sampleData, outfile, mode='point', anderson=0, levels=0, incremental=False,
+           field=False, workers=1):
     """
     :param meshfile: path to file that defines surface mesh
     :param bodyA: path to file that defines rigid body A
     :param bodyB: path to file that defines rigid body B
     :param sampleData: path to file that contains frames of sample data
     :param outfile: path to file to write output to
+    :param mode: 'point' for point-to-point ICP, or 'plane' for point-to-plane ICP
+    :param anderson: number of previous iterations used for Anderson acceleration, or 0 for none
+    :param levels: number of decimated meshes to register to before the full resolution mesh
+    :param incremental: true to only search the tree again for points whose closest triangle may have changed
+    :param field: true to match against the cached distance field of the mesh
+    :param workers: number of processes to split each closest point search between
 
     :type meshfile: str
     :type bodyA: str
     :type bodyB: str
     :type sampleData: str
     :type outfile: str
+    :type mode: str
+    :type anderson: int
+    :type levels: int
+    :type incremental: bool
+    :type field: bool
+    :type workers: int
     """
 
-    d_kPoints, c_kPoints, dist = icp.completeICP(meshfile, bodyA, bodyB, sampleData)
+    d_kPoints, c_kPoints, dist = icp.completeICP(meshfile, bodyA, bodyB, sampleData, workers=workers, mode=mode,
+                                                 anderson=anderson, levels=levels, incremental=incremental,
+                                                 field=field)
 
     writefile(d_kPoints, c_kPoints, dist, outfile)
 
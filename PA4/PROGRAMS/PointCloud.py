@@ -51,7 +51,29 @@ class PointCloud:
         
         p = b_bar - r.dot(a_bar)
 
-        return Frame.Frame(r, p)
+        return Frame.Frame(r, p, rigid=True)
+
+    def registerToPlanes(self, b, normals):
+        """
+        Performs one Gauss-Newton step of point-to-plane registration: finds the small rigid motion that minimizes the
+        sum of squared distances from each point to the plane through the matching point of b with the given normal,
+        linearizing the rotation about the identity.
+        :param b: The points on the planes being mapped to
+        :param normals: Unit normal of the plane through each point of b, as column vectors (zero to ignore a point)
+
+        :type b: PointCloud
+        :type normals: numpy.array([numpy.float64][]), 3 x N
+
+        :return: The Frame transformation F = [r, p] from current frame towards the planes
+        :rtype: Frame.Frame
+        """
+        # Residual of each point is (a + w x a + t - b) . n, linear in [w, t] with rows [a x n, n]
+        jac = np.hstack((np.cross(self.data.T, normals.T), normals.T))
+        res = np.sum((b.data - self.data) * normals, axis=0)
+
+        x = scialg.lstsq(jac, res)[0]
+
+        return Frame.fromRotationVector(x[0:3], x[3:6])
 
     def transform(self, f):
         """
@@ -82,6 +104,59 @@ class PointCloud:
         return a
 
 
+def register_many(a, b):
+    """
+    Performs rigid-body registration for a stack of point cloud pairs at once, with one stacked SVD, and returns the
+    frame transformation from each cloud in a to the matching cloud in b.
+    :param a: The point clouds being mapped from, one per pair, or a single cloud shared by every pair
+    :param b: The point clouds being mapped to, one per pair
+
+    :type a: numpy.array([numpy.float64][][]), K x 3 x N (or 3 x N)
+    :type b: numpy.array([numpy.float64][][]), K x 3 x N
+
+    :return: The Frame transformations F_k = [r_k, p_k] from a_k to b_k
+    :rtype: Frame.FrameArray
+    """
+    b = np.asarray(b, dtype=np.float64)
+    a = np.broadcast_to(np.asarray(a, dtype=np.float64), b.shape)
+
+    a_bar = np.mean(a, axis=2, keepdims=True)
+    b_bar = np.mean(b, axis=2, keepdims=True)
+
+    a_tilde = a - a_bar
+    b_tilde = b - b_bar
+
+    H = np.einsum('kin,kjn->kij', a_tilde, b_tilde)
+
+    u, s, v_t = np.linalg.svd(H)
+
+    u = u.transpose((0, 2, 1))
+    v = v_t.transpose((0, 2, 1))
+
+    # Flip the last singular vector of any solution that is a reflection rather than a rotation
+    v[:, :, -1] *= np.linalg.det(np.matmul(v, u))[:, np.newaxis]
+
+    r = np.matmul(v, u)
+
+    p = b_bar[:, :, 0] - np.einsum('kij,kj->ki', r, a_bar[:, :, 0])
+
+    return Frame.FrameArray(r, p)
+
+
+def stack(clouds):
+    """
+    Stacks the data of equally sized point clouds into one array. Data that is already stacked is returned as is.
+    :param clouds: The point clouds to stack
+    :type clouds: [PointCloud] or numpy.array([numpy.float64][][]), K x 3 x N
+
+    :return: The data of every cloud, indexed as [cloud, coordinate, point]
+    :rtype: numpy.array([numpy.float64][][]), K x 3 x N
+    """
+    if isinstance(clouds, np.ndarray):
+        return clouds
+    return np.array([cloud.data for cloud in clouds])
+
+
 def fromfile(fpath):
     """
     Extract a list of PointClouds from a file.
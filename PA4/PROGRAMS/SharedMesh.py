@@ -0,0 +1,313 @@
+import atexit
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import FlatCovTree as fct
+import Decimation as dc
+
+# Byte alignment of each array within the shared block
+_ALIGN = 64
+
+# Pool of worker processes used for parallel matching: (tree, workers, published mesh or None, executor)
+_pool = None
+
+# Shared tree attached by each worker process of the pool
+_workerMesh = None
+
+
+class SharedMesh:
+    """
+    Mesh and compiled covariance tree whose arrays live in one block of shared memory. The process that publishes the
+    arrays owns the block; other processes reattach to it by its handle, getting views of the same memory rather than
+    copies, so any number of workers can search the tree with no additional memory per worker.
+    """
+    def __init__(self, shm, layout, owner=False):
+        """
+        Wraps a shared memory block. Use publish or attach rather than calling this directly.
+        :param shm: The shared memory block holding every array
+        :param layout: Name, dtype, shape and byte offset of each array in the block
+        :param owner: True if this process created the block and should unlink it
+
+        :type shm: shared_memory.SharedMemory
+        :type layout: [(str, str, tuple, int)]
+        :type owner: bool
+        """
+        self.shm = shm
+        self.layout = layout
+        self.owner = owner
+        self.arrays = dict((name, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset))
+                           for name, dtype, shape, offset in layout)
+        self._tree = None
+        self._pyramids = {}
+
+    @classmethod
+    def publish(cls, arrays):
+        """
+        Copies arrays into a new shared memory block.
+        :param arrays: Arrays to share, by name
+        :type arrays: dict
+
+        :return: The shared arrays, owned by this process
+        :rtype: SharedMesh
+        """
+        layout = []
+        size = 0
+        for name in sorted(arrays):
+            a = np.asarray(arrays[name])
+            layout.append((name, a.dtype.str, a.shape, size))
+            size += -(-a.nbytes // _ALIGN) * _ALIGN
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        mesh = cls(shm, layout, owner=True)
+        for name in arrays:
+            mesh.arrays[name][...] = arrays[name]
+        return mesh
+
+    @classmethod
+    def fromMesh(cls, mesh):
+        """
+        Publishes the mesh arrays and tree of a mesh cache.
+        :param mesh: The mesh to share
+        :type mesh: MeshCache.MeshCache
+
+        :return: The shared mesh, owned by this process
+        :rtype: SharedMesh
+        """
+        arrays = mesh.tree.toArrays()
+        arrays['vCoords'] = mesh.vCoords
+        arrays['vIndices'] = mesh.vIndices
+        return cls.publish(arrays)
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Attaches to arrays published by another process, without copying them.
+        :param handle: Handle of the shared arrays, from SharedMesh.handle
+        :type handle: (str, [(str, str, tuple, int)])
+
+        :return: The shared arrays
+        :rtype: SharedMesh
+        """
+        name, layout = handle
+        return cls(shared_memory.SharedMemory(name=name), layout)
+
+    @property
+    def handle(self):
+        """
+        :return: Picklable handle that other processes can attach with
+        :rtype: (str, [(str, str, tuple, int)])
+        """
+        return self.shm.name, self.layout
+
+    @property
+    def vCoords(self):
+        """
+        :return: Coordinates of vertices on mesh
+        :rtype: np.array([np.float64]) 3 x N
+        """
+        return self.arrays['vCoords']
+
+    @property
+    def vIndices(self):
+        """
+        :return: Indices of vertices for each triangle on mesh
+        :rtype: np.array([int]) 3 x M
+        """
+        return self.arrays['vIndices']
+
+    @property
+    def tree(self):
+        """
+        :return: Covariance tree over every triangle on mesh, backed by the shared arrays
+        :rtype: fct.FlatCovTree
+        """
+        if self._tree is None:
+            self._tree = fct.FlatCovTree.fromArrays(self.arrays)
+            self._tree.shared_handle = self.handle
+        return self._tree
+
+    def pyramid(self, levels):
+        """
+        Decimates the mesh into coarser levels, building a tree for each. Coarse levels are built in, and kept by, the
+        calling process; only the full resolution tree is shared.
+        :param levels: Number of coarse levels
+        :type levels: int
+
+        :return: Every level, coarsest first, ending with the full resolution mesh
+        :rtype: [dc.MeshLevel]
+        """
+        if levels not in self._pyramids:
+            self._pyramids[levels] = dc.meshPyramid(self.vCoords, self.vIndices, levels, tree=self.tree)
+        return self._pyramids[levels]
+
+    def close(self):
+        """
+        Detaches this process from the shared arrays, and frees them if this process published them. Arrays obtained
+        from this object must not be used afterwards.
+        :return: None
+        """
+        if self.owner:
+            self.shm.unlink()
+        self.arrays = None
+        self._tree = None
+        self._pyramids = {}
+        self.shm.close()
+
+
+def findClosestPointsParallel(tree, points, bounds, closest, workers):
+    """
+    Splits the queries of FlatCovTree.find_closest_points evenly between worker processes. The workers attach to the
+    tree through shared memory and are kept for later calls with the same tree, so only the query points are sent to
+    them on each call.
+    :param tree: The tree to search
+    :param points: Points to find the closest point to
+    :param bounds: Distance from each point to its current closest point (np.inf if there is no estimate)
+    :param closest: Current closest point or estimate for each point
+    :param workers: Number of worker processes
+
+    :type tree: fct.FlatCovTree
+    :type points: np.array(np.float64) N X 3
+    :type bounds: np.array(np.float64) N
+    :type closest: np.array(np.float64) N X 3
+    :type workers: int
+
+    :return closest: Closest point to each point
+    :return bounds: Distance from each point to its closest point
+    :return triangles: Index of the triangle each closest point lies on, or -1 where the estimate was not improved
+
+    :rtype closest: np.array(np.float64) N X 3
+    :rtype bounds: np.array(np.float64) N
+    :rtype triangles: np.array(int) N
+    """
+    executor = _matchPool(tree, workers)
+    chunks = [c for c in np.array_split(np.arange(points.shape[0]), workers) if c.size]
+    futures = [executor.submit(_findClosestPoints, points[c], bounds[c], closest[c]) for c in chunks]
+    results = [f.result() for f in futures]
+    return tuple(np.concatenate(r) for r in zip(*results))
+
+
+def _matchPool(tree, workers):
+    """
+    Returns the pool of workers searching a tree, replacing the current pool if it searches another tree or has a
+    different number of workers. Trees that are not already in shared memory are published first.
+    :param tree: The tree to search
+    :param workers: Number of worker processes
+
+    :type tree: fct.FlatCovTree
+    :type workers: int
+
+    :return: The pool of workers
+    :rtype: ProcessPoolExecutor
+    """
+    global _pool
+    if _pool is not None and _pool[0] is tree and _pool[1] == workers:
+        return _pool[3]
+
+    closeMatchPool()
+    published = None
+    handle = getattr(tree, 'shared_handle', None)
+    if handle is None:
+        published = SharedMesh.publish(tree.toArrays())
+        handle = published.handle
+
+    executor = ProcessPoolExecutor(workers, initializer=_attachWorker, initargs=(handle,))
+    _pool = (tree, workers, published, executor)
+    return executor
+
+
+def closeMatchPool():
+    """
+    Stops the pool of matching workers, if any, and frees any tree it published.
+    :return: None
+    """
+    global _pool
+    if _pool is not None:
+        tree, workers, published, executor = _pool
+        _pool = None
+        executor.shutdown()
+        if published is not None:
+            published.close()
+
+
+atexit.register(closeMatchPool)
+
+
+def _attachWorker(handle):
+    """
+    Attaches a worker process to the shared tree it searches.
+    :param handle: Handle of the shared tree arrays
+    :type handle: (str, [(str, str, tuple, int)])
+    """
+    global _workerMesh
+    _workerMesh = SharedMesh.attach(handle)
+
+
+def findClosestPointsWithGapParallel(tree, points, bounds, closest, triangles, margins, workers):
+    """
+    Splits the queries of FlatCovTree.find_closest_points_with_gap evenly between worker processes, in the same way as
+    findClosestPointsParallel.
+    :param tree: The tree to search
+    :param points: Points to find the closest point to
+    :param bounds: Distance from each point to its current closest point (np.inf if there is no estimate)
+    :param closest: Current closest point or estimate for each point
+    :param triangles: Index of the triangle each current estimate lies on, or -1 if it is not on a triangle
+    :param margins: Farthest beyond its closest point to look for another triangle, for each point
+    :param workers: Number of worker processes
+
+    :type tree: fct.FlatCovTree
+    :type points: np.array(np.float64) N X 3
+    :type bounds: np.array(np.float64) N
+    :type closest: np.array(np.float64) N X 3
+    :type triangles: np.array(int) N
+    :type margins: np.array(np.float64) N
+    :type workers: int
+
+    :return: closest points, distances, triangle indices and gaps, as returned by
+             FlatCovTree.find_closest_points_with_gap
+    :rtype: (np.array(np.float64) N X 3, np.array(np.float64) N, np.array(int) N, np.array(np.float64) N)
+    """
+    executor = _matchPool(tree, workers)
+    chunks = [c for c in np.array_split(np.arange(points.shape[0]), workers) if c.size]
+    futures = [executor.submit(_findClosestPointsWithGap, points[c], bounds[c], closest[c], triangles[c], margins[c])
+               for c in chunks]
+    results = [f.result() for f in futures]
+    return tuple(np.concatenate(r) for r in zip(*results))
+
+
+def _findClosestPoints(points, bounds, closest):
+    """
+    Searches the worker's shared tree for one chunk of queries.
+    :param points: Points to find the closest point to
+    :param bounds: Distance from each point to its current closest point
+    :param closest: Current closest point or estimate for each point
+
+    :type points: np.array(np.float64) K X 3
+    :type bounds: np.array(np.float64) K
+    :type closest: np.array(np.float64) K X 3
+
+    :return: closest points, distances and triangle indices, as returned by FlatCovTree.find_closest_points
+    :rtype: (np.array(np.float64) K X 3, np.array(np.float64) K, np.array(int) K)
+    """
+    return _workerMesh.tree.find_closest_points(points, bounds, closest)
+
+
+def _findClosestPointsWithGap(points, bounds, closest, triangles, margins):
+    """
+    Searches the worker's shared tree for one chunk of queries, also finding the gap to the nearest other triangle.
+    :param points: Points to find the closest point to
+    :param bounds: Distance from each point to its current closest point
+    :param closest: Current closest point or estimate for each point
+    :param triangles: Index of the triangle each current estimate lies on
+    :param margins: Farthest beyond its closest point to look for another triangle, for each point
+
+    :type points: np.array(np.float64) K X 3
+    :type bounds: np.array(np.float64) K
+    :type closest: np.array(np.float64) K X 3
+    :type triangles: np.array(int) K
+    :type margins: np.array(np.float64) K
+
+    :return: closest points, distances, triangle indices and gaps, as returned by
+             FlatCovTree.find_closest_points_with_gap
+    :rtype: (np.array(np.float64) K X 3, np.array(np.float64) K, np.array(int) K, np.array(np.float64) K)
+    """
+    return _workerMesh.tree.find_closest_points_with_gap(points, bounds, closest, triangles, margins)
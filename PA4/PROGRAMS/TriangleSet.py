@@ -0,0 +1,236 @@
+import numpy as np
+import ICPmatching as icpm
+
+# Arrays that fully describe a TriangleSet
+_ARRAYS = ('corners', 'edges', 'centroids', 'normals', 'centers', 'radii')
+
+
+class TriangleSet:
+    """
+    Class for a set of triangles stored as arrays, one row per triangle, with the edge vectors, normals, centroids and
+    bounding spheres that searches need computed once for the whole set.
+    """
+    def __init__(self, corners):
+        """
+        Initializes the set from the corners of each triangle.
+        :param corners: Corners of each triangle, indexed as [triangle, corner, coordinate]
+        :type corners: np.array(np.float64) M X 3 X 3
+        """
+        self.corners = np.ascontiguousarray(corners, dtype=np.float64)
+        a, b, c = self.corners[:, 0], self.corners[:, 1], self.corners[:, 2]
+
+        self.edges = np.ascontiguousarray(np.stack((b - a, c - a), axis=1))
+        self.centroids = np.mean(self.corners, axis=1)
+
+        n = np.cross(self.edges[:, 0], self.edges[:, 1])
+        length = np.sqrt(np.sum(n ** 2, axis=1, keepdims=True))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.normals = np.where(length > 0, n / length, 0)
+
+        self.centers, self.radii = calcCentersandRadii(a, b, c)
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        """
+        Recreates a set from arrays returned by toArrays, without recomputing anything. The arrays are used as given, so
+        read-only memory mapped arrays can be passed directly.
+        :param arrays: Arrays of the set, by attribute name
+        :type arrays: dict
+
+        :return: The set holding the given arrays
+        :rtype: TriangleSet
+        """
+        tset = cls.__new__(cls)
+        for name in _ARRAYS:
+            setattr(tset, name, arrays[name])
+        return tset
+
+    def toArrays(self):
+        """
+        :return: Every array of the set, by attribute name
+        :rtype: dict
+        """
+        return dict((name, getattr(self, name)) for name in _ARRAYS)
+
+    def __len__(self):
+        """
+        :return: The number of triangles in the set
+        :rtype: int
+        """
+        return self.corners.shape[0]
+
+    @property
+    def nbytes(self):
+        """
+        :return: Number of bytes used by the triangle arrays
+        :rtype: int
+        """
+        return sum(getattr(self, name).nbytes for name in _ARRAYS)
+
+    def Subset(self, inds):
+        """
+        Creates a new set from some of the triangles in this one, in the given order.
+        :param inds: Indices of the triangles to keep
+        :type inds: np.array(int) or slice
+
+        :return: The set of selected triangles
+        :rtype: TriangleSet
+        """
+        return TriangleSet(self.corners[inds])
+
+    def SortPoints(self, inds=slice(None)):
+        """
+        Returns the "sort point" (the mean of the corners) of each triangle in a range.
+        :param inds: Indices of the triangles, all triangles by default
+        :type inds: np.array(int) or slice
+
+        :return: The sort point of each triangle
+        :rtype: np.array(np.float64) K X 3
+        """
+        return self.centroids[inds]
+
+    def BoundingBox(self, frame, inds=slice(None)):
+        """
+        Finds the box, in a given frame, around all the triangles in a range.
+        :param frame: the frame that the bounding box should be in reference to
+        :param inds: Indices of the triangles, all triangles by default
+
+        :type frame: fr.Frame
+        :type inds: np.array(int) or slice
+
+        :return: the lower and upper bounds of the bounding box
+        :rtype: [np.array(np.float64) 3 X 1]
+        """
+        f_inv = frame.inv
+        local = self.corners[inds].reshape((-1, 3)).dot(f_inv.r.T) + f_inv.p.reshape(3)
+        return [np.amin(local, axis=0).reshape((3, 1)), np.amax(local, axis=0).reshape((3, 1))]
+
+    def ClosestPointsTo(self, v, inds=slice(None)):
+        """
+        Finds the closest point on each triangle in a range to v.
+        :param v: The point to find closest points to, or one point per selected triangle
+        :param inds: Indices of the triangles, all triangles by default
+
+        :type v: np.array(np.float64) 3 or K X 3
+        :type inds: np.array(int) or slice
+
+        :return: The closest point on each triangle
+        :rtype: np.array(np.float64) K X 3
+        """
+        return icpm.closestPointsFromEdges(v, self.corners[inds, 0], self.edges[inds, 0], self.edges[inds, 1])
+
+    def ClosestPoint(self, v, bound, inds=slice(None)):
+        """
+        Finds the closest point to v on any triangle in a range, only testing triangles whose bounding sphere is within
+        the current bound.
+        :param v: The point to find the closest point to
+        :param bound: distance from v to the current closest point
+        :param inds: Indices of the triangles, all triangles by default
+
+        :type v: np.array(np.float64) 3
+        :type bound: np.float64
+        :type inds: np.array(int) or slice
+
+        :return point: The closest point found, or None if no triangle is closer than bound
+        :return dist: The distance from v to the closest point, or bound if none was found
+        :return ind: Index of the triangle holding the closest point, or -1 if none was found
+
+        :rtype point: np.array(np.float64) 3
+        :rtype dist: np.float64
+        :rtype ind: int
+        """
+        inds = np.arange(len(self))[inds]
+        near = np.sqrt(np.sum((self.centers[inds] - v) ** 2, axis=1)) - self.radii[inds] <= bound
+        inds = inds[near]
+        if inds.size == 0:
+            return None, bound, -1
+
+        cp = self.ClosestPointsTo(v, inds)
+        dist = np.sqrt(np.sum((cp - v) ** 2, axis=1))
+        best = np.argmin(dist)
+        if dist[best] < bound:
+            return cp[best], dist[best], inds[best]
+        return None, bound, -1
+
+
+def calcCentersandRadii(a, b, c):
+    """
+    Calculates the center and radius of a bounding sphere around each triangle with vertices a, b, c, with the same
+    construction as BoundingSphere.calcCenterandRadius. The radius is taken as the distance to the farthest vertex, so
+    the sphere always contains the whole triangle.
+    :param a: First vertex of each triangle
+    :param b: Second vertex of each triangle
+    :param c: Third vertex of each triangle
+
+    :type a: np.array([np.float64]) M x 3
+    :type b: np.array([np.float64]) M x 3
+    :type c: np.array([np.float64]) M x 3
+
+    :return: center of each bounding sphere
+    :return: radius of each bounding sphere
+    :rtype: np.array([np.float64]) M x 3
+    :rtype: np.array([np.float64]) M
+    """
+    f = (a + b) / 2
+    u = a - f
+    v = c - f
+    d = np.cross(np.cross(u, v), u)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        l = (np.sum(v * v, axis=1) - np.sum(u * u, axis=1)) / np.sum(2 * d * (v - u), axis=1)
+    l = np.maximum(0, np.where(np.isfinite(l), l, 0))
+    q = f + l[:, np.newaxis] * d
+    # Degenerate triangles fall back to a sphere about the centroid
+    q = np.where(np.all(np.isfinite(q), axis=1, keepdims=True), q, (a + b + c) / 3)
+    r = np.sqrt(np.max([np.sum((q - a) ** 2, axis=1), np.sum((q - b) ** 2, axis=1), np.sum((q - c) ** 2, axis=1)],
+                       axis=0))
+    return q, r
+
+
+def vertexAdjacency(vInd):
+    """
+    Finds the neighbours of every triangle on a mesh, the triangles that share at least one vertex with it (including
+    the triangle itself), as a compressed sparse row structure: the neighbours of triangle k are
+    neighbours[offsets[k]:offsets[k + 1]].
+    :param vInd: Indices of vertices for each triangle on surface
+    :type vInd: np.array([int]), 3 x M
+
+    :return offsets: Start of each triangle's neighbours, followed by the total number of neighbours
+    :return neighbours: Indices of the neighbouring triangles of each triangle in turn, in increasing order
+
+    :rtype offsets: np.array([int]) M + 1
+    :rtype neighbours: np.array([int])
+    """
+    vInd = np.asarray(vInd, dtype=int)
+    m = vInd.shape[1]
+
+    # Triangles around each vertex
+    vertices = vInd.T.ravel()
+    order = np.argsort(vertices, kind='mergesort')
+    around = np.repeat(np.arange(m), 3)[order]
+    degree = np.bincount(vertices)
+    starts = np.cumsum(degree) - degree
+
+    # Every (triangle, triangle around one of its corners) pair, without repeats
+    counts = degree[vertices]
+    offsets = np.cumsum(counts) - counts
+    pairs = around[np.arange(np.sum(counts)) - np.repeat(offsets - starts[vertices], counts)]
+    keys = np.unique(np.repeat(np.repeat(np.arange(m), 3), counts) * m + pairs)
+
+    neighbours = keys % m
+    offsets = np.searchsorted(keys // m, np.arange(m + 1))
+    return offsets, neighbours
+
+
+def fromMesh(vCoords, vInd):
+    """
+    Creates the set of all triangles on a mesh.
+    :param vCoords: Coordinates of vertices on surface
+    :param vInd: Indices of vertices for each triangle on surface
+
+    :type vCoords: np.array([np.float64]), 3 x N
+    :type vInd: np.array([np.float64]), 3 x M
+
+    :return: The triangles of the mesh, in the order of vInd
+    :rtype: TriangleSet
+    """
+    return TriangleSet(icpm.meshTriangles(vCoords, vInd))
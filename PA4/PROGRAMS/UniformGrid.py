@@ -0,0 +1,266 @@
+import numpy as np
+import TriangleSet as ts
+
+# Largest number of (point, cell) pairs examined at once while searching a shell
+_SHELL_PAIRS = 1 << 20
+
+
+class UniformGrid:
+    """
+    Uniform grid of cubic cells over the bounding box of a mesh. Each cell lists every triangle whose bounding box
+    overlaps it, stored as one array of triangle indices with the list of cell k at cell_triangles[cell_start[k]:
+    cell_start[k + 1]]. A query searches the cell holding it, then shells of cells one further away at a time, until the
+    nearest a shell could hold a point is no nearer than the closest point found.
+    """
+    def __init__(self, triangles, cell_size):
+        """
+        Sorts the triangles of a set into the cells of a grid over them.
+        :param triangles: Triangles to search
+        :param cell_size: Edge length of the grid cells
+
+        :type triangles: ts.TriangleSet
+        :type cell_size: float
+        """
+        if not cell_size > 0:
+            raise ValueError('Cell size must be positive, not ' + str(cell_size))
+
+        self.triangles = triangles
+        self.cell_size = float(cell_size)
+
+        low = np.amin(triangles.corners, axis=1)
+        high = np.amax(triangles.corners, axis=1)
+        self.lower = np.amin(low, axis=0)
+        self.shape = np.floor((np.amax(high, axis=0) - self.lower) / self.cell_size).astype(int) + 1
+
+        # Every cell overlapped by the bounding box of each triangle
+        first = self._Cells(low)
+        last = np.minimum(self._Cells(high), self.shape - 1)
+        extent = last - first + 1
+        counts = np.prod(extent, axis=1)
+        offsets = np.cumsum(counts) - counts
+        k = np.arange(np.sum(counts)) - np.repeat(offsets, counts)
+        tris = np.repeat(np.arange(len(triangles)), counts)
+        extent = extent[tris]
+        cells = first[tris] + np.stack((k // (extent[:, 1] * extent[:, 2]), (k // extent[:, 2]) % extent[:, 1],
+                                        k % extent[:, 2]), axis=1)
+        cells = np.ravel_multi_index(cells.T, self.shape)
+
+        order = np.argsort(cells, kind='stable')
+        self.cell_triangles = tris[order]
+        self.cell_start = np.concatenate(([0], np.cumsum(np.bincount(cells, minlength=np.prod(self.shape)))))
+
+    @classmethod
+    def fromTriangleSet(cls, triangles, cell_size=None):
+        """
+        Builds a grid over a set of triangles.
+        :param triangles: Triangles to search
+        :param cell_size: Edge length of the grid cells, twice the mean edge length of the triangles if not given
+
+        :type triangles: ts.TriangleSet
+        :type cell_size: float
+
+        :return: The grid
+        :rtype: UniformGrid
+        """
+        if cell_size is None:
+            edges = np.concatenate((triangles.edges[:, 0], triangles.edges[:, 1],
+                                    triangles.edges[:, 1] - triangles.edges[:, 0]))
+            cell_size = 2 * np.mean(np.sqrt(np.sum(edges ** 2, axis=1)))
+        return cls(triangles, cell_size)
+
+    def CellStats(self):
+        """
+        Describes how the triangles fill the grid.
+
+        :return shape: Number of cells along each axis
+        :return entries: Number of (cell, triangle) entries, counting a triangle once for every cell it overlaps
+        :return cell_sizes: Histogram of cell sizes: the number of cells holding k triangles is cell_sizes[k]
+
+        :rtype shape: np.array(int) 3
+        :rtype entries: int
+        :rtype cell_sizes: np.array([int])
+        """
+        return self.shape.copy(), self.cell_triangles.size, np.bincount(np.diff(self.cell_start))
+
+    def find_closest_points(self, points, bounds, closest):
+        """
+        Finds the closest point on the mesh to every point at once. All queries search the same shell together: every
+        query still active is paired with every triangle of the grid cells in its shell, the pairs are tested
+        together, and a query stops once the nearest a point of its next shell could be is no nearer than its bound,
+        or no shell reaches the grid. A query outside the grid starts at the first shell that reaches it.
+        :param points: Points to find the closest point to
+        :param bounds: Distance from each point to its current closest point (np.inf if there is no estimate)
+        :param closest: Current closest point or estimate for each point
+
+        :type points: np.array(np.float64) N X 3
+        :type bounds: np.array(np.float64) N
+        :type closest: np.array(np.float64) N X 3
+
+        :return closest: Closest point to each point
+        :return bounds: Distance from each point to its closest point
+        :return triangles: Index of the triangle each closest point lies on, or -1 where the estimate was not improved
+
+        :rtype closest: np.array(np.float64) N X 3
+        :rtype bounds: np.array(np.float64) N
+        :rtype triangles: np.array(int) N
+        """
+        points = np.asarray(points, dtype=np.float64).reshape((-1, 3))
+        bounds = np.array(bounds, dtype=np.float64).reshape(-1)
+        closest = np.array(closest, dtype=np.float64).reshape((-1, 3))
+        triangles = -np.ones(points.shape[0], dtype=int)
+
+        scaled = (points - self.lower) / self.cell_size
+        cells = np.floor(scaled).astype(int)
+        # Distance from each point to the nearest face of its own cell, and the first and last shells that reach the
+        # grid
+        inner = self.cell_size * np.amin(np.minimum(scaled - cells, cells + 1 - scaled), axis=1)
+        first = np.amax(np.maximum(0, np.maximum(-cells, cells - (self.shape - 1))), axis=1)
+        last = np.amax(np.maximum(cells, self.shape - 1 - cells), axis=1)
+
+        # Queries yet to reach their first shell, in the order they do
+        waiting = np.argsort(first, kind='stable')
+        active = waiting[0:0]
+        while active.size or waiting.size:
+            if active.size == 0:
+                shell = first[waiting[0]]
+            starting = np.searchsorted(first[waiting], shell, side='right')
+            active = np.union1d(active, waiting[:starting])
+            waiting = waiting[starting:]
+
+            step = max(1, _SHELL_PAIRS // (6 * (2 * shell + 1) ** 2))
+            for start in range(0, active.size, step):
+                self._SearchShell(active[start:start + step], shell, cells, points, bounds, closest, triangles)
+
+            shell += 1
+            reach = (shell - 1) * self.cell_size + inner[active]
+            active = active[(reach < bounds[active]) & (shell <= last[active])]
+
+        return closest, bounds, triangles
+
+    def _Cells(self, points):
+        """
+        Finds the cell holding each point, which may lie outside the grid.
+        :param points: The points
+        :type points: np.array(np.float64) N X 3
+
+        :return: Cell coordinates of each point
+        :rtype: np.array(int) N X 3
+        """
+        return np.floor((points - self.lower) / self.cell_size).astype(int)
+
+    def _ShellCells(self, queries, shell, cells):
+        """
+        Lists the grid cells at a given Chebyshev distance from the cell of each query. The shell is split into six
+        faces, two across each axis, each a rectangle of cells clipped to the grid, so cells outside the grid cost
+        nothing however far the query is from it.
+        :param queries: Index of each query point, in increasing order
+        :param shell: The distance, in cells
+        :param cells: Cell holding each query point
+
+        :type queries: np.array(int) K
+        :type shell: int
+        :type cells: np.array(int) N X 3
+
+        :return owner: Query of each cell, grouped by query in increasing order
+        :return pairs: Index of each cell in the grid
+
+        :rtype owner: np.array(int) L
+        :rtype pairs: np.array(int) L
+        """
+        c = cells[queries]
+        owners = []
+        pairs = []
+        for axis in range(3):
+            # Faces across earlier axes already hold the cells at either end of this one
+            free = [j for j in range(3) if j != axis]
+            low = np.stack([c[:, j] - shell + (j < axis) for j in free], axis=1)
+            high = np.stack([c[:, j] + shell - (j < axis) for j in free], axis=1)
+            low = np.maximum(low, 0)
+            high = np.minimum(high, self.shape[free] - 1)
+            extent = np.maximum(high - low + 1, 0)
+
+            for side in ((1,) if shell == 0 else (-1, 1)):
+                fixed = c[:, axis] + side * shell
+                counts = np.where((fixed >= 0) & (fixed < self.shape[axis]), np.prod(extent, axis=1), 0)
+                offsets = np.cumsum(counts) - counts
+                k = np.arange(np.sum(counts)) - np.repeat(offsets, counts)
+                face = np.repeat(np.arange(queries.size), counts)
+                coords = np.empty((k.size, 3), dtype=int)
+                coords[:, axis] = fixed[face]
+                coords[:, free[0]] = low[face, 0] + k // extent[face, 1]
+                coords[:, free[1]] = low[face, 1] + k % extent[face, 1]
+                owners.append(face)
+                pairs.append(np.ravel_multi_index(coords.T, self.shape))
+            if shell == 0:
+                break
+
+        owner = np.concatenate(owners)
+        order = np.argsort(owner, kind='stable')
+        return queries[owner[order]], np.concatenate(pairs)[order]
+
+    def _SearchShell(self, queries, shell, cells, points, bounds, closest, triangles):
+        """
+        Tests some queries against every triangle in one shell of cells around them, updating their closest points.
+        :param queries: Index of each query point to search, in increasing order
+        :param shell: Distance of the shell from the cell holding each query, in cells
+        :param cells: Cell holding each query point
+        :param points: All query points
+        :param bounds: Distance from each query point to its closest point so far, updated in place
+        :param closest: Closest point so far to each query point, updated in place
+        :param triangles: Index of the triangle each closest point lies on, updated in place
+
+        :type queries: np.array(int) K
+        :type shell: int
+        :type cells: np.array(int) N X 3
+        :type points: np.array(np.float64) N X 3
+        :type bounds: np.array(np.float64) N
+        :type closest: np.array(np.float64) N X 3
+        :type triangles: np.array(int) N
+
+        :return: None
+        """
+        owner, pairs = self._ShellCells(queries, shell, cells)
+
+        counts = self.cell_start[pairs + 1] - self.cell_start[pairs]
+        first = np.cumsum(counts) - counts
+        tris = self.cell_triangles[np.arange(np.sum(counts)) - np.repeat(first - self.cell_start[pairs], counts)]
+        owner = np.repeat(owner, counts)
+
+        v = points[owner]
+        near = (np.sqrt(np.sum((self.triangles.centers[tris] - v) ** 2, axis=1)) - self.triangles.radii[tris] <=
+                bounds[owner])
+        owner, tris, v = owner[near], tris[near], v[near]
+        if owner.size == 0:
+            return
+
+        cp = self.triangles.ClosestPointsTo(v, tris)
+        d = np.sqrt(np.sum((cp - v) ** 2, axis=1))
+        d[np.isnan(d)] = np.inf
+
+        # Keep the nearest pair of each query; pairs are grouped by query, as queries are in increasing order
+        starts = np.concatenate(([0], np.where(np.diff(owner))[0] + 1))
+        best = np.minimum.reduceat(d, starts)
+        nearest = np.repeat(best, np.diff(np.append(starts, d.size))) == d
+        pick = np.maximum.reduceat(np.where(nearest, np.arange(d.size), -1), starts)
+        better = d[pick] < bounds[owner[pick]]
+        pick = pick[better]
+        bounds[owner[pick]] = d[pick]
+        closest[owner[pick]] = cp[pick]
+        triangles[owner[pick]] = tris[pick]
+
+
+def fromMesh(vCoords, vInd, cell_size=None):
+    """
+    Builds a uniform grid over every triangle on a mesh.
+    :param vCoords: Coordinates of vertices on surface
+    :param vInd: Indices of vertices for each triangle on surface
+    :param cell_size: Edge length of the grid cells, twice the mean edge length of the mesh if not given
+
+    :type vCoords: np.array([np.float64]), 3 x N
+    :type vInd: np.array([int]), 3 x M
+    :type cell_size: float
+
+    :return: The grid, reporting triangle indices in the order of vInd
+    :rtype: UniformGrid
+    """
+    return UniformGrid.fromTriangleSet(ts.fromMesh(vCoords, vInd), cell_size)
@@ -0,0 +1,487 @@
+import numpy as np
+import scipy.linalg as scialg
+import sys, os
+import time
+import collections
+import ICPfilereading as icpf
+import ICPmatching as icpm
+import Frame as fr
+import PointCloud as pc
+import Triangle as tr
+import CovTreeNode as ctn
+import FlatCovTree as fct
+import TriangleSet as ts
+import IncrementalMatcher as im
+import UniformGrid as ug
+import DistanceField as df
+
+
+class _UncachedNode(ctn.CovTreeNode):
+    """
+    CovTreeNode that inverts its frame on every access, reproducing the cost of searching before node inverses were
+    cached. Only used to benchmark against.
+    """
+    @property
+    def inv_frame(self):
+        r_inv = scialg.inv(self.frame.r)
+        return fr.Frame(r_inv, -r_inv.dot(self.frame.p))
+
+    @inv_frame.setter
+    def inv_frame(self, value):
+        pass
+
+
+def loadProblem(directory, dataset):
+    """
+    Reads the mesh and computes the pointer tip positions for one PA4 data set.
+    :param directory: Directory containing the mesh, body and sample files
+    :param dataset: Name of the data set, e.g. A-Debug
+
+    :type directory: str
+    :type dataset: str
+
+    :return vCoords: coordinates of all vertices on mesh
+    :return vIndices: indices of vertices for each triangle on mesh
+    :return d_kPoints: positions of the pointer tip with respect to rigid body B
+
+    :rtype vCoords: np.array([np.float64]) 3 x N
+    :rtype vIndices: np.array([int]) 3 x M
+    :rtype d_kPoints: pc.PointCloud
+    """
+    vCoords, vIndices = icpf.meshDef(os.path.join(directory, 'Problem4MeshFile.sur'))
+    nledA, ledA, tipA = icpf.bodyDef(os.path.join(directory, 'Problem4-BodyA.txt'))
+    nledB, ledB, tipB = icpf.bodyDef(os.path.join(directory, 'Problem4-BodyB.txt'))
+    aFrames, bFrames = icpf.readSample(os.path.join(directory, 'PA4-' + dataset + '-SampleReadingsTest.txt'),
+                                       nledA, nledB)
+    return vCoords, vIndices, icpm.findTipB(aFrames, bFrames, ledA, tipA, ledB)
+
+
+def buildTree(vCoords, vIndices):
+    """
+    Builds the covariance tree over every triangle of a mesh.
+    :param vCoords: coordinates of all vertices on mesh
+    :param vIndices: indices of vertices for each triangle on mesh
+
+    :type vCoords: np.array([np.float64]) 3 x N
+    :type vIndices: np.array([int]) 3 x M
+
+    :return: Root of the covariance tree
+    :rtype: ctn.CovTreeNode
+    """
+    triangles = np.array([tr.Triangle(pc.PointCloud(vCoords[:, vIndices[:, i]])) for i in range(vIndices.shape[1])])
+    return ctn.CovTreeNode(triangles, vIndices.shape[1])
+
+
+def timeQueries(tree, points, repeats=3):
+    """
+    Times closest point queries of every point against a tree, starting each query from an infinite bound.
+    :param tree: Tree to search
+    :param points: Points to query
+    :param repeats: Number of times to repeat the queries, keeping the fastest
+
+    :type tree: ctn.CovTreeNode
+    :type points: pc.PointCloud
+    :type repeats: int
+
+    :return: Fastest time per query, in seconds
+    :rtype: float
+    """
+    best = np.inf
+    for k in range(repeats):
+        stime = time.time()
+        icpm.ICPmatch(points, None, None, tree=tree, oldpts=pc.PointCloud(points.data + np.inf), usetree=True)
+        best = min(best, time.time() - stime)
+    return best / points.data.shape[1]
+
+
+def _setNodeClass(tree, cls):
+    """
+    Changes the class of every node in a tree.
+    :param tree: Root of the tree
+    :param cls: Class to give every node
+
+    :type tree: ctn.CovTreeNode
+    :type cls: type
+
+    :return: None
+    """
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        node.__class__ = cls
+        if node.has_subtrees:
+            stack.extend(node.subtrees)
+
+
+def benchmarkInverseFrames(directory, datasets):
+    """
+    Compares the time per closest point query with per-node inverse frames cached against inverting every node frame
+    on each visit, for the first ICP iteration of each data set.
+    :param directory: Directory containing the PA4 data
+    :param datasets: Names of the data sets to query
+
+    :type directory: str
+    :type datasets: [str]
+
+    :return: None
+    """
+    print('\nBenchmark: cached node inverse frames')
+    tree = None
+    for dataset in datasets:
+        vCoords, vIndices, d_kPoints = loadProblem(directory, dataset)
+        if tree is None:
+            tree = buildTree(vCoords, vIndices)
+
+        _setNodeClass(tree, _UncachedNode)
+        uncached = timeQueries(tree, d_kPoints)
+        _setNodeClass(tree, ctn.CovTreeNode)
+        cached = timeQueries(tree, d_kPoints)
+
+        print('{0:>12}: uncached {1:.3f} ms/query, cached {2:.3f} ms/query, speedup {3:.2f}x'.format(
+            dataset, 1000 * uncached, 1000 * cached, uncached / cached))
+
+
+def benchmarkWarmStart(directory, datasets, shift=0.1, repeats=5):
+    """
+    Compares rematching after a small motion of the points, as in late ICP iterations, starting the batched tree search
+    from the previous closest points alone against also searching first around the previously matched triangles.
+    :param directory: Directory containing the PA4 data
+    :param datasets: Names of the data sets to query
+    :param shift: Distance every point is moved by between the two matches
+    :param repeats: Number of times to repeat each match, keeping the fastest
+
+    :type directory: str
+    :type datasets: [str]
+    :type shift: float
+    :type repeats: int
+
+    :return: None
+    """
+    print('\nBenchmark: warm started rematching')
+    tree = None
+    for dataset in datasets:
+        vCoords, vIndices, d_kPoints = loadProblem(directory, dataset)
+        if tree is None:
+            tree = fct.fromMesh(vCoords, vIndices)
+            adjacency = ts.vertexAdjacency(vIndices)
+
+        c_old, t_old = icpm.ICPmatch(d_kPoints, vCoords, vIndices, tree=tree,
+                                     oldpts=pc.PointCloud(d_kPoints.data + np.inf), usetree=True, triangles=True)
+        direction = np.random.normal(size=d_kPoints.data.shape)
+        moved = pc.PointCloud(d_kPoints.data + shift * direction / np.linalg.norm(direction, axis=0))
+
+        times = []
+        for warm in (None, t_old):
+            best = np.inf
+            for k in range(repeats):
+                stime = time.time()
+                icpm.ICPmatch(moved, vCoords, vIndices, tree=tree, oldpts=c_old, usetree=True, triangles=True,
+                              oldtriangles=warm, adjacency=adjacency)
+                best = min(best, time.time() - stime)
+            times.append(best / d_kPoints.data.shape[1])
+
+        print('{0:>12}: old points {1:.3f} ms/query, old triangles {2:.3f} ms/query, speedup {3:.2f}x'.format(
+            dataset, 1000 * times[0], 1000 * times[1], times[0] / times[1]))
+
+
+def benchmarkIncremental(directory, datasets, iterations=30, repeats=3):
+    """
+    Records the points matched on each iteration of point-to-point ICP, then times matching that sequence with a
+    batched tree search of every point each time against incremental matching.
+    :param directory: Directory containing the PA4 data
+    :param datasets: Names of the data sets to query
+    :param iterations: Number of ICP iterations to record
+    :param repeats: Number of times to repeat each sequence of matches, keeping the fastest
+
+    :type directory: str
+    :type datasets: [str]
+    :type iterations: int
+    :type repeats: int
+
+    :return: None
+    """
+    print('\nBenchmark: incremental matching over ' + str(iterations) + ' ICP iterations')
+    tree = None
+    for dataset in datasets:
+        vCoords, vIndices, d_kPoints = loadProblem(directory, dataset)
+        if tree is None:
+            tree = fct.fromMesh(vCoords, vIndices)
+
+        sequence = []
+        F_reg = fr.Frame(np.identity(3), np.zeros([3, 1]))
+        for k in range(iterations):
+            s_i = d_kPoints.transform(F_reg)
+            c_kPoints = icpm.ICPmatch(s_i, vCoords, vIndices, tree=tree, oldpts=pc.PointCloud(s_i.data + np.inf),
+                                      usetree=True)
+            sequence.append(s_i)
+            F_reg = s_i.register(c_kPoints).compose(F_reg)
+
+        full = np.inf
+        for k in range(repeats):
+            stime = time.time()
+            old_pts = pc.PointCloud(sequence[0].data + np.inf)
+            for s_i in sequence:
+                old_pts = icpm.ICPmatch(s_i, vCoords, vIndices, tree=tree, oldpts=old_pts, usetree=True)
+            full = min(full, time.time() - stime)
+
+        incremental = np.inf
+        for k in range(repeats):
+            stime = time.time()
+            matcher = im.IncrementalMatcher(vCoords, vIndices, tree)
+            for s_i in sequence:
+                matcher.match(s_i)
+            incremental = min(incremental, time.time() - stime)
+
+        print('{0:>12}: full {1:.1f} ms, incremental {2:.1f} ms, speedup {3:.2f}x, {4:.0%} of queries searched'.format(
+            dataset, 1000 * full, 1000 * incremental, full / incremental, float(matcher.searched) / matcher.matched))
+
+
+def benchmarkTreeSplit(directory, datasets, repeats=3):
+    """
+    Compares build time, shape and batched query time of compiled trees split at the sign change of the centroids
+    against trees split at their median with several leaf sizes, querying from infinite bounds.
+    :param directory: Directory containing the PA4 data
+    :param datasets: Names of the data sets to query
+    :param repeats: Number of times to repeat the queries, keeping the fastest
+
+    :type directory: str
+    :type datasets: [str]
+    :type repeats: int
+
+    :return: None
+    """
+    print('\nBenchmark: tree split rule')
+    vCoords, vIndices, d_kPoints = loadProblem(directory, datasets[0])
+    points = np.hstack([loadProblem(directory, dataset)[2].data for dataset in datasets]).T
+    for split, leaf_size in (('sign', 1), ('median', 1), ('median', 4), ('median', 8), ('median', 16)):
+        stime = time.time()
+        tree = fct.fromMesh(vCoords, vIndices, split, leaf_size)
+        build = time.time() - stime
+        depth, num_nodes, leaf_sizes = tree.BuildStats()
+
+        best = np.inf
+        for k in range(repeats):
+            stime = time.time()
+            tree.find_closest_points(points, np.inf * np.ones(points.shape[0]), points + np.inf)
+            best = min(best, time.time() - stime)
+
+        print('{0:>6} {1:>2}: build {2:.2f} s, depth {3}, {4} nodes, largest leaf {5}, {6:.3f} ms/query'.format(
+            split, leaf_size, build, depth, num_nodes, len(leaf_sizes) - 1, 1000 * best / points.shape[0]))
+
+
+def benchmarkBuild(directory, dataset, leaf_size=8):
+    """
+    Compares building a median split tree as CovTreeNodes and compiling it against building it directly into arrays.
+    :param directory: Directory containing the PA4 data
+    :param dataset: Name of a data set using the mesh
+    :param leaf_size: Most triangles a leaf may hold
+
+    :type directory: str
+    :type dataset: str
+    :type leaf_size: int
+
+    :return: None
+    """
+    print('\nBenchmark: median split tree build')
+    vCoords, vIndices, d_kPoints = loadProblem(directory, dataset)
+
+    stime = time.time()
+    triangles = np.array([tr.Triangle(pc.PointCloud(vCoords[:, vIndices[:, i]])) for i in range(vIndices.shape[1])])
+    fct.FlatCovTree(ctn.CovTreeNode(triangles, vIndices.shape[1], 'median', leaf_size), triangles)
+    nodes = time.time() - stime
+
+    stime = time.time()
+    fct.FlatCovTree.fromTriangleSet(ts.fromMesh(vCoords, vIndices), leaf_size)
+    arrays = time.time() - stime
+
+    print('{0} triangles: tree nodes {1:.3f} s, arrays {2:.3f} s, speedup {3:.1f}x'.format(
+        vIndices.shape[1], nodes, arrays, nodes / arrays))
+
+
+def benchmarkSearchOrder(directory, datasets, leaf_size=8):
+    """
+    Compares the nodes measured, triangles searched and time per query of a covariance tree searched in stored child
+    order, nearer child first, and best first, querying every point of the data sets from infinite bounds.
+    :param directory: Directory containing the PA4 data
+    :param datasets: Names of the data sets to query
+    :param leaf_size: Most triangles a leaf may hold
+
+    :type directory: str
+    :type datasets: [str]
+    :type leaf_size: int
+
+    :return: None
+    """
+    print('\nBenchmark: tree search order')
+    vCoords, vIndices, d_kPoints = loadProblem(directory, datasets[0])
+    points = np.hstack([loadProblem(directory, dataset)[2].data for dataset in datasets]).T
+    triangles = np.array([tr.Triangle(pc.PointCloud(vCoords[:, vIndices[:, i]])) for i in range(vIndices.shape[1])])
+    tree = ctn.CovTreeNode(triangles, vIndices.shape[1], 'median', leaf_size)
+
+    for order in ('fixed', 'near', 'best'):
+        counts = collections.Counter()
+        stime = time.time()
+        for v in points:
+            tree.FindClosestPoint(v, [np.inf], [v + np.inf], order, counts)
+        elapsed = time.time() - stime
+        print('{0:>12}: {1:.1f} nodes/query, {2:.1f} triangles/query, {3:.3f} ms/query'.format(
+            order, counts['nodes'] / points.shape[0], counts['triangles'] / points.shape[0],
+            1000 * elapsed / points.shape[0]))
+
+
+def benchmarkLeafSize(directory, datasets, repeats=3):
+    """
+    Compares build time, number of nodes and query time of covariance trees with several leaf sizes, searching whole
+    leaves at once, querying every point of the data sets from infinite bounds.
+    :param directory: Directory containing the PA4 data
+    :param datasets: Names of the data sets to query
+    :param repeats: Number of times to repeat the queries, keeping the fastest
+
+    :type directory: str
+    :type datasets: [str]
+    :type repeats: int
+
+    :return: None
+    """
+    print('\nBenchmark: tree leaf size')
+    vCoords, vIndices, d_kPoints = loadProblem(directory, datasets[0])
+    points = pc.PointCloud(np.hstack([loadProblem(directory, dataset)[2].data for dataset in datasets]))
+    triangles = np.array([tr.Triangle(pc.PointCloud(vCoords[:, vIndices[:, i]])) for i in range(vIndices.shape[1])])
+    for split in ('sign', 'median'):
+        for leaf_size in (1, 8, 32):
+            stime = time.time()
+            tree = ctn.CovTreeNode(triangles, vIndices.shape[1], split, leaf_size)
+            build = time.time() - stime
+            print('{0:>6} {1:>2}: build {2:.2f} s, {3} nodes, {4:.3f} ms/query'.format(
+                split, leaf_size, build, tree.BuildStats()[1], 1000 * timeQueries(tree, points, repeats)))
+
+
+def benchmarkGrid(directory, datasets, iterations=30, repeats=3):
+    """
+    Compares a uniform grid against a compiled median split tree: their build times, then the time to match the points
+    of the first and of the last of a run of point-to-point ICP iterations from infinite bounds, where the first are
+    far from the mesh and the last are on it.
+    :param directory: Directory containing the PA4 data
+    :param datasets: Names of the data sets to query
+    :param iterations: Number of ICP iterations to run
+    :param repeats: Number of times to repeat the queries, keeping the fastest
+
+    :type directory: str
+    :type datasets: [str]
+    :type iterations: int
+    :type repeats: int
+
+    :return: None
+    """
+    print('\nBenchmark: uniform grid against tree')
+    vCoords, vIndices, d_kPoints = loadProblem(directory, datasets[0])
+    stime = time.time()
+    tree = fct.fromMesh(vCoords, vIndices)
+    tree_build = time.time() - stime
+    stime = time.time()
+    grid = ug.fromMesh(vCoords, vIndices)
+    grid_build = time.time() - stime
+    shape, entries, cell_sizes = grid.CellStats()
+    print('build: tree {0:.3f} s, grid {1:.3f} s, {2} cells, {3:.1f} triangles per cell'.format(
+        tree_build, grid_build, np.prod(shape), float(entries) / np.prod(shape)))
+
+    for dataset in datasets:
+        vCoords, vIndices, d_kPoints = loadProblem(directory, dataset)
+        F_reg = fr.Frame(np.identity(3), np.zeros([3, 1]))
+        sequence = []
+        for k in range(iterations):
+            s_i = d_kPoints.transform(F_reg)
+            c_kPoints = icpm.ICPmatch(s_i, vCoords, vIndices, tree=tree, oldpts=pc.PointCloud(s_i.data + np.inf),
+                                      usetree=True)
+            sequence.append(s_i.data.T)
+            F_reg = s_i.register(c_kPoints).compose(F_reg)
+
+        times = []
+        for points in (sequence[0], sequence[-1]):
+            for engine in (tree, grid):
+                best = np.inf
+                for k in range(repeats):
+                    stime = time.time()
+                    engine.find_closest_points(points, np.inf * np.ones(points.shape[0]), points + np.inf)
+                    best = min(best, time.time() - stime)
+                times.append(1000 * best / points.shape[0])
+
+        print('{0:>12}: first tree {1:.3f} ms/query, grid {2:.3f} ms/query; last tree {3:.3f} ms/query, grid {4:.3f} '
+              'ms/query'.format(dataset, *times))
+
+
+def benchmarkField(directory, datasets, iterations=30, repeats=3):
+    """
+    Compares matching the points of every iteration of point-to-point ICP with a compiled tree, from infinite bounds,
+    against matching them with a distance field, interpolated and refined, and reports how far the refined matches
+    are from the tree matches.
+    :param directory: Directory containing the PA4 data
+    :param datasets: Names of the data sets to query
+    :param iterations: Number of ICP iterations to run
+    :param repeats: Number of times to repeat the matches, keeping the fastest
+
+    :type directory: str
+    :type datasets: [str]
+    :type iterations: int
+    :type repeats: int
+
+    :return: None
+    """
+    print('\nBenchmark: distance field against tree')
+    vCoords, vIndices, d_kPoints = loadProblem(directory, datasets[0])
+    tree = fct.fromMesh(vCoords, vIndices)
+    stime = time.time()
+    field = df.fromMesh(vCoords, vIndices)
+    build = time.time() - stime
+    print('build: {0:.2f} s, {1} nodes, {2:.0%} in band and stored'.format(build, np.prod(field.shape),
+                                                                           field.nodes.size / np.prod(field.shape)))
+
+    for dataset in datasets:
+        vCoords, vIndices, d_kPoints = loadProblem(directory, dataset)
+        F_reg = fr.Frame(np.identity(3), np.zeros([3, 1]))
+        sequence = []
+        for k in range(iterations):
+            s_i = d_kPoints.transform(F_reg)
+            c_kPoints = icpm.ICPmatch(s_i, vCoords, vIndices, tree=tree, oldpts=pc.PointCloud(s_i.data + np.inf),
+                                      usetree=True)
+            sequence.append((s_i, c_kPoints))
+            F_reg = s_i.register(c_kPoints).compose(F_reg)
+
+        times = []
+        for match in (lambda s_i: tree.find_closest_points(s_i.data.T, np.inf * np.ones(s_i.data.shape[1]),
+                                                           s_i.data.T + np.inf),
+                      lambda s_i: field.match(s_i, tree, refine=False),
+                      lambda s_i: field.match(s_i, tree)):
+            best = np.inf
+            for k in range(repeats):
+                stime = time.time()
+                for s_i, c_kPoints in sequence:
+                    match(s_i)
+                best = min(best, time.time() - stime)
+            times.append(1000 * best / len(sequence))
+
+        error = max(np.amax(np.abs(field.match(s_i, tree)[0].data - c_kPoints.data)) for s_i, c_kPoints in sequence)
+        print('{0:>12}: tree {1:.2f} ms, interpolated {2:.2f} ms, refined {3:.2f} ms per match, refined off by at '
+              'most {4:.1e}'.format(dataset, times[0], times[1], times[2], error))
+
+
+def main():
+    """
+    Runs the benchmarks on the given data sets, e.g. python benchmarkICP.py "PA234 - Student Data" A-Debug B-Debug
+    """
+    directory = sys.argv[1]
+    datasets = sys.argv[2:]
+
+    benchmarkInverseFrames(directory, datasets)
+    benchmarkWarmStart(directory, datasets)
+    benchmarkIncremental(directory, datasets)
+    benchmarkTreeSplit(directory, datasets)
+    benchmarkBuild(directory, datasets[0])
+    benchmarkSearchOrder(directory, datasets)
+    benchmarkLeafSize(directory, datasets)
+    benchmarkGrid(directory, datasets)
+    benchmarkField(directory, datasets)
+
+
+if __name__ == '__main__':
+    main()
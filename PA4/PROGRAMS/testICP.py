@@ -1,10 +1,27 @@
 import numpy as np
+import os
+import sys
+import time
+import inspect
+import tempfile
+import ICPfilereading as icpf
 import PointCloud as pc
 import ICPmatching as icpm
 import Frame as fr
 import BoundingSphere as bs
 import Triangle as tr
+import TriangleSet as ts
 import CovTreeNode as ctn
+import FlatCovTree as fct
+import ICPcomplete as icp
+import collections
+import MeshCache as mc
+import SharedMesh as sm
+import Decimation as dc
+import IncrementalMatcher as im
+import UniformGrid as ug
+import DistanceField as df
+import shutil
 
 
 def testFindTipB(tolerance=1e-4):
@@ -56,6 +73,273 @@ def testFindTipB(tolerance=1e-4):
     print('Find d_k test passed!')
 
 
+def testRegisterMany(tolerance=1e-4):
+    """
+    Tests batched registration of a random point cloud to several randomly rotated and translated copies of it, by
+    comparing each result to the generated transformation and to registering the pair on its own.
+
+    :param tolerance: The minimum error between created and computed values for the test to pass.
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting batched registration...')
+    a = np.random.uniform(0, 10, (3, 10))
+    rs = np.array([_rotation(np.random.uniform(0, 2 * np.pi, (3,))) for k in range(5)])
+    ps = np.random.uniform(0, 10, (5, 3))
+    b = np.einsum('kij,jn->kin', rs, a) + ps[:, :, np.newaxis]
+
+    fs = pc.register_many(a, b)
+
+    print('\nAre calculated R and p within tolerance of each generated frame?')
+    passed = np.all(np.abs(fs.r - rs) <= tolerance) and np.all(np.abs(fs.p - ps) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nDo they match registering each pair separately?')
+    for k in range(len(fs)):
+        f = pc.PointCloud(a).register(pc.PointCloud(b[k]))
+        assert np.all(np.abs(fs[k].r - f.r) <= tolerance) and np.all(np.abs(fs[k].p - f.p) <= tolerance)
+    print(True)
+
+    print('\nBatched registration tests passed!')
+
+
+def testFrameInverse(tolerance=1e-4):
+    """
+    Tests that frame inverses are computed correctly, both by transposing rigid frames and by general inversion, and that
+    the inverse is only computed once.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting frame inverses...')
+    r = _rotation(np.random.uniform(0, 2 * np.pi, (3,)))
+    p = np.random.uniform(0, 10, (3, 1))
+
+    for rigid in (False, True):
+        f = fr.Frame(r, p, rigid)
+        identity = f.inv.compose(f)
+        print('\nRigid = {}: inverse composed with frame is identity?'.format(rigid))
+        passed = np.all(np.abs(identity.r - np.eye(3)) <= tolerance) and np.all(np.abs(identity.p) <= tolerance)
+        assert passed
+        print(passed)
+
+        print('Inverse reused on second access?')
+        assert f.inv is f.inv and f.inv.inv is f
+        print(True)
+
+    print('\nFrame inverse tests passed!')
+
+
+def testFrameArray(tolerance=1e-4):
+    """
+    Tests composition, inversion and application of a FrameArray against the same operations on each Frame.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting stacks of frames...')
+    rs = np.array([_rotation(np.random.uniform(0, 2 * np.pi, (3,))) for k in range(4)])
+    f = fr.FrameArray(rs, np.random.uniform(0, 10, (4, 3)))
+    g = fr.FrameArray(rs[::-1].copy(), np.random.uniform(0, 10, (4, 3)))
+    v = np.random.uniform(0, 10, (4, 3))
+    cloud = np.random.uniform(0, 10, (3, 5))
+
+    fg = f.inv.compose(g)
+    single = f.compose(g[0])
+    pts = fg.apply(v)
+    clouds = fg.transform(cloud)
+
+    print('\nEach frame matches composing, inverting and applying single frames?')
+    for k in range(len(f)):
+        fg_k = f[k].inv.compose(g[k])
+        assert np.all(np.abs(fg[k].r - fg_k.r) <= tolerance) and np.all(np.abs(fg[k].p - fg_k.p) <= tolerance)
+        assert np.all(np.abs(single[k].p - f[k].compose(g[0]).p) <= tolerance)
+        assert np.all(np.abs(pts[k] - (fg_k.r.dot(v[k]) + fg_k.p.reshape(3))) <= tolerance)
+        assert np.all(np.abs(clouds[k] - pc.PointCloud(cloud).transform(fg_k).data) <= tolerance)
+    print(True)
+
+    print('\nFrame array tests passed!')
+
+
+def testReadSampleArray(tolerance=1e-4):
+    """
+    Tests reading a sample readings file written from random marker positions, checking the parsed array, the marker
+    views of each body and that the PointCloud reader agrees with them.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting bulk sample reading...')
+    nA, nB, nD, nSamples = 3, 4, 2, 5
+    data = np.random.uniform(-100, 100, (nSamples, nA + nB + nD, 3))
+
+    fd, fpath = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(fd, 'w') as f:
+        f.write('{0}, {1}, test-SampleReadings.txt 0\n'.format(nA + nB + nD, nSamples))
+        for row in data.reshape((-1, 3)):
+            f.write('{0:.2f},   {1:.2f},   {2:.2f}\n'.format(*row))
+
+    try:
+        samples, aData, bData, dummy = icpf.readSampleArray(fpath, nA, nB)
+        aFrames, bFrames = icpf.readSample(fpath, nA, nB)
+    finally:
+        os.remove(fpath)
+
+    print('\nParsed positions match written positions?')
+    passed = samples.shape == data.shape and np.all(np.abs(samples - data) <= max(tolerance, 0.005))
+    assert passed
+    print(passed)
+
+    print('\nBody views match marker positions and share memory with them?')
+    passed = (np.array_equal(aData, samples[:, 0:nA].transpose((0, 2, 1))) and
+              np.array_equal(bData, samples[:, nA:nA + nB].transpose((0, 2, 1))) and
+              np.array_equal(dummy, samples[:, nA + nB:].transpose((0, 2, 1))) and
+              np.shares_memory(aData, samples) and np.shares_memory(bData, samples))
+    assert passed
+    print(passed)
+
+    print('\nPointCloud frames match the views?')
+    passed = all(np.array_equal(a.data, aData[k]) and np.array_equal(b.data, bData[k])
+                 for k, (a, b) in enumerate(zip(aFrames, bFrames)))
+    assert passed
+    print(passed)
+
+    print('\nBulk sample reading tests passed!')
+
+
+def testRegisterToPlanes(tolerance=1e-4):
+    """
+    Tests that repeated point-to-plane registration steps recover a rigid motion of points lying on known planes, and
+    that frames made from rotation vectors are the expected rotations.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting point-to-plane registration...')
+    print('\nRotation vector about z gives rotation about z?')
+    f = fr.fromRotationVector(np.array([0, 0, np.pi / 6]), np.zeros(3))
+    passed = np.all(np.abs(f.r - _rotation(np.array([0, 0, np.pi / 6]))) <= tolerance)
+    assert passed
+    print(passed)
+
+    # Points on random planes, moved off them by a small rigid motion
+    b = np.random.uniform(-10, 10, (3, 50))
+    normals = np.random.uniform(-1, 1, (3, 50))
+    normals /= np.linalg.norm(normals, axis=0)
+    motion = fr.fromRotationVector(np.random.uniform(-0.1, 0.1, 3), np.random.uniform(-1, 1, 3))
+    a = pc.PointCloud(b).transform(motion)
+
+    f_reg = fr.Frame(np.identity(3), np.zeros((3, 1)), rigid=True)
+    for i in range(10):
+        f_reg = a.transform(f_reg).registerToPlanes(pc.PointCloud(b), normals).compose(f_reg)
+
+    print('\nRegistration undoes the motion?')
+    undone = f_reg.compose(motion)
+    passed = np.all(np.abs(undone.r - np.identity(3)) <= tolerance) and np.all(np.abs(undone.p) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nPoint-to-plane registration tests passed!')
+
+
+def testAnderson(tolerance=1e-4):
+    """
+    Tests that frame parameters convert back to the same frame, and that Anderson acceleration finds the fixed point of
+    a linear contraction far sooner than plain fixed point iteration.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting Anderson acceleration...')
+    print('\nFrame parameters give back the same frame?')
+    passed = True
+    for angle in (0, 0.5, 3, np.pi):
+        axis = np.random.uniform(-1, 1, 3)
+        f = fr.fromRotationVector(angle * axis / np.linalg.norm(axis), np.random.uniform(-10, 10, 3))
+        x = icp.frameParameters(f)
+        g = fr.fromRotationVector(x[0:3], x[3:6])
+        passed = passed and np.all(np.abs(f.r - g.r) <= tolerance) and np.all(np.abs(f.p - g.p) <= tolerance)
+    assert passed
+    print(passed)
+
+    # Linear contraction with fixed point x_star
+    a = 0.95 * _rotation(np.random.uniform(0, 2 * np.pi, 3))
+    x_star = np.random.uniform(-1, 1, 3)
+
+    def update(x):
+        return x_star + a.dot(x - x_star)
+
+    x_plain = np.zeros(3)
+    x_accel = np.zeros(3)
+    history = collections.deque(maxlen=4)
+    for i in range(10):
+        x_plain = update(x_plain)
+        history.append((x_accel, update(x_accel)))
+        x_accel = icp.andersonStep(history) if len(history) > 1 else history[-1][1]
+
+    print('\nAccelerated iteration reaches the fixed point when plain iteration does not?')
+    passed = np.all(np.abs(x_accel - x_star) <= tolerance) and not np.all(np.abs(x_plain - x_star) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nAnderson acceleration tests passed!')
+
+
+def testAndersonDebugSets(tolerance=0.05):
+    """
+    Tests that ICP with Anderson acceleration ends where plain ICP does on the debug data sets: every match within the
+    accuracy plain ICP stops at, and a mean match distance no more than 1% above that of plain ICP.
+
+    :param tolerance: Maximum distance between matches of plain and accelerated runs
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting Anderson acceleration on the debug data sets...')
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PA234 - Student Data')
+    bodyA = os.path.join(directory, 'Problem4-BodyA.txt')
+    bodyB = os.path.join(directory, 'Problem4-BodyB.txt')
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        mesh = mc.MeshCache(os.path.join(directory, 'Problem4MeshFile.sur'), cache_dir)
+        passed = True
+        for dataset in ('A', 'B', 'C', 'D', 'E', 'F'):
+            sampleData = os.path.join(directory, 'PA4-' + dataset + '-Debug-SampleReadingsTest.txt')
+            s_plain, c_plain, dist_plain = icp.completeICP(None, bodyA, bodyB, sampleData, mesh=mesh)
+            for anderson in (3, 5):
+                s_k, c_k, dist = icp.completeICP(None, bodyA, bodyB, sampleData, mesh=mesh, anderson=anderson)
+                passed = (passed and np.all(np.abs(s_k.data - s_plain.data) <= tolerance) and
+                          np.all(np.abs(c_k.data - c_plain.data) <= tolerance) and
+                          np.mean(dist) <= 1.01 * np.mean(dist_plain))
+    finally:
+        shutil.rmtree(cache_dir)
+
+    print('\nAccelerated and plain ICP end together?')
+    assert passed
+    print(passed)
+
+    print('\nAnderson debug data set tests passed!')
+
+
 def testProjectOnSegment(tolerance=1e-4):
     """
     Tests projection of a point onto a line segment.
@@ -305,6 +589,43 @@ def testICPMatchLinear(tolerance=1e-4):
     print('\nLinear ICP tests passed!')
 
 
+def testClosestPointsBatch(tolerance=1e-4):
+    """
+    Tests the vectorized closest point kernel against the single point search, for points scattered around a set of
+    random triangles. The closed-form kernel must never be farther from a point than the least squares method.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting vectorized closest points on a mesh of random triangles...')
+    v_coords, tri_inds, _ = _randomMesh(10)
+    s = np.random.uniform(-15, 15, (3, 50))
+
+    c, dist, inds = icpm.findClosestPointsBatch(s.T, icpm.meshTriangles(v_coords, tri_inds))
+
+    print('\nDistances reported match closest points?')
+    assert np.all(np.abs(np.linalg.norm(c - s.T, axis=1) - dist) <= tolerance)
+    print(True)
+
+    print('\nEach closest point lies on its triangle?')
+    for i in range(s.shape[1]):
+        corners = v_coords[:, tri_inds[:, inds[i]]]
+        on_tri = icpm.minPointonTriangle(c[i], corners[:, 0], corners[:, 1], corners[:, 2])
+        assert np.all(np.abs(on_tri - c[i]) <= tolerance)
+    print(True)
+
+    print('\nNo farther than the single point search?')
+    for i in range(s.shape[1]):
+        c_lin = icpm.findClosestPointLinear(s[:, i], v_coords, tri_inds)
+        assert dist[i] <= np.linalg.norm(c_lin - s[:, i]) + tolerance
+    print(True)
+
+    print('\nVectorized closest point tests passed!')
+
+
 def testMakeSphere(tolerance=1e-6):
     """
     Tests the proper creation of bounding spheres using known triangles.
@@ -542,6 +863,52 @@ def testTriangle(tolerance=1e-4):
     print('\nTriangle tests passed!')
 
 
+def testTriangleSet(tolerance=1e-4):
+    """
+    Tests the bulk methods of a TriangleSet against the same methods on individual Triangles.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting TriangleSet against individual Triangles...')
+    v_coords, tri_inds, triangles = _randomMesh(10)
+    tri_set = ts.fromMesh(v_coords, tri_inds)
+
+    print('\nSort points match?')
+    c_exp = np.hstack([t.SortPoint() for t in triangles]).T
+    assert np.all(np.abs(tri_set.SortPoints() - c_exp) <= tolerance)
+    print(True)
+
+    print('\nBounding box of triangles 2 to 6 in a rotated frame matches?')
+    f = fr.Frame(_rotation(np.random.uniform(0, 2 * np.pi, (3,))), np.random.uniform(0, 10, (3, 1)), rigid=True)
+    b_exp = triangles[2].BoundingBox(f)
+    for t in triangles[3:7]:
+        b_exp = t.EnlargeBounds(f, b_exp)
+    b = tri_set.BoundingBox(f, slice(2, 7))
+    passed = np.all(np.abs(b[0] - b_exp[0]) <= tolerance) and np.all(np.abs(b[1] - b_exp[1]) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nBounding spheres contain every corner?')
+    reach = np.linalg.norm(tri_set.corners - tri_set.centers[:, np.newaxis, :], axis=2)
+    assert np.all(reach <= tri_set.radii[:, np.newaxis] + tolerance)
+    print(True)
+
+    print('\nClosest points match?')
+    s = np.random.uniform(-15, 15, (3,))
+    cp = tri_set.ClosestPointsTo(s)
+    for i, t in enumerate(triangles):
+        assert np.linalg.norm(cp[i] - s) <= np.linalg.norm(t.ClosestPointTo(s) - s) + tolerance
+    point, dist, ind = tri_set.ClosestPoint(s, np.inf)
+    assert ind == np.argmin(np.linalg.norm(cp - s, axis=1)) and np.abs(dist - np.linalg.norm(point - s)) <= tolerance
+    print(True)
+
+    print('\nTriangleSet tests passed!')
+
+
 def testICPTree(tolerance=1e-4):
     """
     Test covariance tree ICP performance by comparing to the search with Bounding Spheres
@@ -606,6 +973,808 @@ def testICPTree(tolerance=1e-4):
     print('\nTree ICP tests passed!')
 
 
+def testFlatTree(tolerance=1e-4):
+    """
+    Tests that the array-backed covariance tree finds the same closest points as the CovTreeNode it was compiled from.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting array-backed covariance tree against the node tree...')
+    v_coords, tri_inds, triangles = _randomMesh(20)
+    tree = ctn.CovTreeNode(triangles, tri_inds.shape[1])
+    flat = fct.FlatCovTree(tree, triangles)
+
+    s = np.random.uniform(-15, 15, (3, 40))
+    old_pts = pc.PointCloud(s + np.inf)
+
+    c_tree = icpm.ICPmatch(pc.PointCloud(s), v_coords, tri_inds, tree=tree, oldpts=old_pts, usetree=True)
+    c_flat = icpm.ICPmatch(pc.PointCloud(s), v_coords, tri_inds, tree=flat, oldpts=old_pts, usetree=True)
+    c_lin = icpm.ICPmatch(pc.PointCloud(s), v_coords, tri_inds, linear=True)
+
+    print('\nMatch exact search within tolerance?')
+    passed = np.all(np.abs(c_lin.data - c_flat.data) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nMatch the node tree within tolerance?')
+    passed = np.all(np.abs(c_tree.data - c_flat.data) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nEvery triangle stored in exactly one leaf?')
+    assert np.array_equal(np.sort(flat.tri_ids), np.arange(tri_inds.shape[1]))
+    print(True)
+
+    print('\nArray-backed tree tests passed!')
+
+
+def testMeshCache(tolerance=1e-4):
+    """
+    Tests that a cached mesh and tree are written once, memory mapped on later use, give the same closest points as a
+    freshly built tree, and are not reused once the mesh file changes.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting binary mesh cache...')
+    v_coords, tri_inds, _ = _randomMesh(20)
+
+    directory = tempfile.mkdtemp()
+    meshfile = os.path.join(directory, 'mesh.sur')
+
+    def writeMesh():
+        with open(meshfile, 'w') as f:
+            f.write('{0}\n'.format(v_coords.shape[1]))
+            for v in v_coords.T:
+                f.write('{0:.6f} {1:.6f} {2:.6f}\n'.format(*v))
+            f.write('{0}\n'.format(tri_inds.shape[1]))
+            for t in tri_inds.T:
+                f.write('{0} {1} {2} -1 -1 -1\n'.format(*t))
+
+    try:
+        writeMesh()
+        first = mc.MeshCache(meshfile)
+        first.tree
+        second = mc.MeshCache(meshfile)
+
+        print('\nCache written once and memory mapped on later use?')
+        passed = (os.listdir(directory).count(os.path.basename(second.path)) == 1 and
+                  isinstance(second.vCoords, np.memmap) and isinstance(second.tree.triangles.corners, np.memmap))
+        assert passed
+        print(passed)
+
+        print('\nCached mesh matches mesh file?')
+        passed = (np.all(np.abs(second.vCoords - v_coords) <= max(tolerance, 1e-6)) and
+                  np.array_equal(second.vIndices, tri_inds))
+        assert passed
+        print(passed)
+
+        print('\nCached tree matches freshly built tree?')
+        s = np.random.uniform(-15, 15, (40, 3))
+        bounds = np.inf * np.ones(40)
+        c_new, d_new, t_new = fct.fromMesh(second.vCoords, second.vIndices).find_closest_points(s, bounds, s)
+        c_cached, d_cached, t_cached = second.tree.find_closest_points(s, bounds, s)
+        passed = np.all(np.abs(c_new - c_cached) <= tolerance)
+        assert passed
+        print(passed)
+
+        print('\nChanged mesh file gets a new cache?')
+        v_coords = v_coords + 1
+        writeMesh()
+        third = mc.MeshCache(meshfile)
+        passed = third.key != second.key and np.all(np.abs(third.vCoords - v_coords) <= max(tolerance, 1e-6))
+        assert passed
+        print(passed)
+    finally:
+        shutil.rmtree(directory)
+
+    print('\nMesh cache tests passed!')
+
+
+def testBatchedTree(tolerance=1e-4):
+    """
+    Tests the batched tree search against the single point tree search and the vectorized linear search, both from
+    infinite bounds and from finite starting estimates.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting batched tree search...')
+    v_coords, tri_inds, triangles = _randomMesh(30)
+    flat = fct.FlatCovTree(ctn.CovTreeNode(triangles, tri_inds.shape[1]), triangles)
+
+    s = np.random.uniform(-15, 15, (40, 3))
+    c_lin, d_lin, t_lin = icpm.findClosestPointsBatch(s, icpm.meshTriangles(v_coords, tri_inds))
+
+    print('\nFrom infinite bounds, match linear search within tolerance?')
+    c, d, t = flat.find_closest_points(s, np.inf * np.ones(40), s + np.inf)
+    passed = np.all(np.abs(c - c_lin) <= tolerance) and np.all(np.abs(d - d_lin) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nTriangle indices give the same distances?')
+    c_tri = icpm.closestPointsOnTriangles(s, *[icpm.meshTriangles(v_coords, tri_inds)[t, k] for k in range(3)])
+    assert np.all(np.abs(np.linalg.norm(c_tri - s, axis=1) - d) <= tolerance)
+    print(True)
+
+    print('\nFrom a vertex of the mesh as the first guess, match single point search?')
+    guess = v_coords[:, :40].T.copy()
+    c, d, t = flat.find_closest_points(s, np.linalg.norm(guess - s, axis=1), guess)
+    for i in range(40):
+        bound = [np.linalg.norm(guess[i] - s[i])]
+        closest = [guess[i]]
+        flat.FindClosestPoint(s[i], bound, closest)
+        assert np.all(np.abs(closest[0] - c[i]) <= tolerance)
+    print(True)
+
+    print('\nBatched tree search tests passed!')
+
+
+def testSharedMesh(tolerance=1e-4):
+    """
+    Tests that a tree published to shared memory is seen unchanged by an attached copy, and that matching split between
+    worker processes finds the same closest points as matching in one process.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting shared memory tree and parallel matching...')
+    v_coords, tri_inds, _ = _randomMesh(20)
+    tree = fct.fromMesh(v_coords, tri_inds)
+
+    published = sm.SharedMesh.publish(tree.toArrays())
+    attached = sm.SharedMesh.attach(published.handle)
+    try:
+        print('\nAttached arrays match published arrays?')
+        passed = all(np.array_equal(a, attached.arrays[name]) for name, a in tree.toArrays().items())
+        assert passed
+        print(passed)
+
+        print('\nAttached arrays see changes to the published arrays?')
+        published.arrays['lower'][0, 0] -= 1
+        passed = attached.arrays['lower'][0, 0] == tree.lower[0, 0] - 1
+        assert passed
+        print(passed)
+    finally:
+        attached.close()
+        published.close()
+
+    s = pc.PointCloud(np.random.uniform(-15, 15, (3, 40)))
+    old_pts = pc.PointCloud(s.data + np.inf)
+    c_serial = icpm.ICPmatch(s, v_coords, tri_inds, tree=tree, oldpts=old_pts, usetree=True)
+    c_parallel = icpm.ICPmatch(s, v_coords, tri_inds, tree=tree, oldpts=old_pts, usetree=True, workers=2)
+    sm.closeMatchPool()
+
+    print('\nParallel match within tolerance of serial match?')
+    passed = np.all(np.abs(c_serial.data - c_parallel.data) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nShared memory tests passed!')
+
+
+def testDecimation(tolerance=1e-4):
+    """
+    Tests that decimating a planar grid mesh keeps every vertex on the plane while removing triangles, that a mesh
+    pyramid gets finer from level to level and ends with the original mesh, that ICP on a coarse level brings a
+    far-off start closer while leaving a start it cannot improve on unchanged, and that ICP on the full resolution mesh
+    converges on a perfect fit.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting mesh decimation...')
+    n = 20
+    x, y = np.meshgrid(np.arange(n, dtype=np.float64), np.arange(n, dtype=np.float64))
+    v_coords = np.array([x.ravel(), y.ravel(), 0.3 * x.ravel() + 0.2 * y.ravel() + 1])
+    corner = (np.arange(n - 1)[:, np.newaxis] * n + np.arange(n - 1)).ravel()
+    tri_inds = np.hstack((np.array([corner, corner + 1, corner + n]), np.array([corner + 1, corner + n + 1, corner + n])))
+
+    coarse_coords, coarse_inds = dc.decimate(v_coords, tri_inds, 3.0)
+
+    print('\nFewer triangles, all using valid vertices?')
+    passed = (0 < coarse_inds.shape[1] < tri_inds.shape[1] and np.amax(coarse_inds) < coarse_coords.shape[1] and
+              np.array_equal(np.unique(coarse_inds), np.arange(coarse_coords.shape[1])))
+    assert passed
+    print(passed)
+
+    print('\nDecimated vertices stay on the plane?')
+    height = coarse_coords[2] - (0.3 * coarse_coords[0] + 0.2 * coarse_coords[1] + 1)
+    passed = np.all(np.abs(height) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nPyramid goes from coarse to the original mesh?')
+    tree = fct.fromMesh(v_coords, tri_inds)
+    pyramid = dc.meshPyramid(v_coords, tri_inds, 2, tree=tree)
+    counts = [level.vIndices.shape[1] for level in pyramid]
+    passed = (len(pyramid) == 3 and counts[0] < counts[1] < counts[2] and pyramid[-1].tree is tree and
+              pyramid[-1].error == 0 and all(level.error <= 1 for level in pyramid))
+    assert passed
+    print(passed)
+
+    # Curved surface, so that a registration to it is unique
+    v_coords = np.array([x.ravel(), y.ravel(), 3 * np.sin(x.ravel() / 3) * np.cos(y.ravel() / 4)])
+    tree = fct.fromMesh(v_coords, tri_inds)
+    coarse = dc.meshPyramid(v_coords, tri_inds, 2, tree=tree)[0]
+
+    def rms(s):
+        c = icpm.ICPmatch(s, v_coords, tri_inds, tree=tree, oldpts=pc.PointCloud(s.data + np.inf), usetree=True)
+        return np.sqrt(np.mean(np.sum((s.data - c.data) ** 2, axis=0)))
+
+    pts = np.vstack((np.random.uniform(4, 15, (2, 100)), 10 * np.ones((1, 100))))
+    on_surface = icpm.ICPmatch(pc.PointCloud(pts), v_coords, tri_inds, tree=tree, oldpts=pc.PointCloud(pts + np.inf),
+                               usetree=True)
+    far = on_surface.transform(fr.Frame(_rotation(np.array([0.1, -0.1, 0.15])), np.array([[2.0], [-1.5], [2.0]])))
+
+    print('\nCoarse level brings a far-off start closer to the full resolution mesh?')
+    c_k, F_reg = icp.iterativeFramePointFinder(coarse.vCoords, coarse.vIndices, far, tree=coarse.tree, levels=[coarse])
+    passed = rms(far.transform(F_reg)) < rms(far) / 2
+    assert passed
+    print(passed)
+
+    print('\nCoarse level leaves a start on the full resolution mesh where it is?')
+    c_k, F_reg = icp.iterativeFramePointFinder(coarse.vCoords, coarse.vIndices, on_surface, tree=coarse.tree,
+                                               levels=[coarse])
+    passed = np.all(np.abs(F_reg.r - np.identity(3)) <= tolerance) and np.all(np.abs(F_reg.p) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nFull resolution mesh reports convergence on a perfect fit?')
+    # Integer heights, so that every vertex matches itself exactly
+    v_coords = np.array([x.ravel(), y.ravel(), (x.ravel() * y.ravel()) % 3])
+    level = dc.MeshLevel(v_coords, tri_inds)
+    c_k, F_reg, converged, nIters, nPasses = icp._levelICP(level, pc.PointCloud(v_coords),
+                                                           fr.Frame(np.identity(3), np.zeros([3, 1])), 1, 'point', 0)
+    passed = converged and nIters == 1 and np.all(np.abs(c_k.data - v_coords) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nMesh decimation tests passed!')
+
+
+def testWarmStart(tolerance=1e-4):
+    """
+    Tests the triangle neighbours found from shared vertices, and that starting a tree match from the triangles matched
+    before a small motion finds the same closest points as a match started from infinite bounds.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting warm started matching...')
+    n = 12
+    x, y = np.meshgrid(np.arange(n, dtype=np.float64), np.arange(n, dtype=np.float64))
+    v_coords = np.array([x.ravel(), y.ravel(), np.random.uniform(-1, 1, n * n)])
+    corner = (np.arange(n - 1)[:, np.newaxis] * n + np.arange(n - 1)).ravel()
+    tri_inds = np.hstack((np.array([corner, corner + 1, corner + n]), np.array([corner + 1, corner + n + 1, corner + n])))
+    adjacency = ts.vertexAdjacency(tri_inds)
+
+    print('\nNeighbours are exactly the triangles sharing a vertex?')
+    offsets, neighbours = adjacency
+    passed = True
+    for k in range(tri_inds.shape[1]):
+        expected = np.where(np.any(np.isin(tri_inds, tri_inds[:, k]), axis=0))[0]
+        passed = passed and np.array_equal(neighbours[offsets[k]:offsets[k + 1]], expected)
+    assert passed
+    print(passed)
+
+    tree = fct.fromMesh(v_coords, tri_inds)
+    s = pc.PointCloud(np.vstack((np.random.uniform(0, n - 1, (2, 50)), np.random.uniform(-3, 3, (1, 50)))))
+    c_old, t_old = icpm.ICPmatch(s, v_coords, tri_inds, tree=tree, oldpts=pc.PointCloud(s.data + np.inf), usetree=True,
+                                 triangles=True)
+
+    moved = pc.PointCloud(s.data + np.random.uniform(-0.5, 0.5, s.data.shape))
+    c_cold, t_cold = icpm.ICPmatch(moved, v_coords, tri_inds, tree=tree, oldpts=pc.PointCloud(moved.data + np.inf),
+                                   usetree=True, triangles=True)
+    c_warm, t_warm = icpm.ICPmatch(moved, v_coords, tri_inds, tree=tree, oldpts=c_old, usetree=True, triangles=True,
+                                   oldtriangles=t_old, adjacency=adjacency)
+
+    print('\nWarm started match within tolerance of match from infinite bounds?')
+    passed = np.all(np.abs(c_warm.data - c_cold.data) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nEvery point given the triangle its closest point lies on?')
+    c_tri = icpm.closestPointsOnTriangles(moved.data.T, *[icpm.meshTriangles(v_coords, tri_inds)[t_warm, k]
+                                                          for k in range(3)])
+    passed = np.all(t_warm >= 0) and np.all(np.abs(c_tri - c_warm.data.T) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nWarm started matching tests passed!')
+
+
+def testIncrementalMatch(tolerance=1e-4):
+    """
+    Tests the gap to the second nearest triangle found by the tree against a search of every triangle, and that
+    incremental matching of points moving in shrinking steps finds the same closest points as searching every triangle
+    each time, while searching the tree for fewer points.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting incremental matching...')
+    v_coords, tri_inds, _ = _randomMesh(30)
+    corners = icpm.meshTriangles(v_coords, tri_inds)
+    tree = fct.fromMesh(v_coords, tri_inds)
+
+    s = np.random.uniform(-15, 15, (40, 3))
+    dist = np.linalg.norm(icpm.closestPointsOnTriangles(s[:, np.newaxis], corners[:, 0], corners[:, 1],
+                                                        corners[:, 2]) - s[:, np.newaxis], axis=2)
+    order = np.argsort(dist, axis=1)
+    margins = np.random.uniform(0, 5, 40)
+
+    print('\nGap matches the two nearest triangles, up to the margin?')
+    c, d, t, gap = tree.find_closest_points_with_gap(s, np.inf * np.ones(40), s + np.inf, -np.ones(40, dtype=int),
+                                                     margins)
+    expected = np.minimum(dist[np.arange(40), order[:, 1]] - dist[np.arange(40), order[:, 0]], margins)
+    passed = np.all(t == order[:, 0]) and np.all(np.abs(gap - expected) <= tolerance)
+    assert passed
+    print(passed)
+
+    matcher = im.IncrementalMatcher(v_coords, tri_inds, tree)
+    direction = np.random.normal(size=(3, 40))
+    direction /= np.linalg.norm(direction, axis=0)
+    s_i = pc.PointCloud(s.T)
+    passed = True
+    for k in range(10):
+        c, t = matcher.match(s_i)
+        c_lin, d_lin, t_lin = icpm.findClosestPointsBatch(s_i.data.T, corners)
+        passed = passed and np.all(np.abs(c.data.T - c_lin) <= tolerance)
+        s_i = pc.PointCloud(s_i.data + direction * 0.5 ** k)
+
+    print('\nIncremental matches within tolerance of searching every triangle?')
+    assert passed
+    print(passed)
+
+    print('\nFewer tree searches than points matched?')
+    passed = matcher.searched < matcher.matched
+    assert passed
+    print(passed)
+
+    print('\nIncremental matching tests passed!')
+
+
+def testTreeBuild(tolerance=1e-4):
+    """
+    Tests that median split trees are balanced, respect the leaf size and report their shape the same way before and
+    after compiling, and that their search matches a search of every triangle.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting median split tree build...')
+    v_coords, tri_inds, triangles = _randomMesh(100)
+
+    for leaf_size in (1, 3, 8):
+        tree = ctn.CovTreeNode(triangles, tri_inds.shape[1], 'median', leaf_size)
+        depth, num_nodes, leaf_sizes = tree.BuildStats()
+
+        print('\nLeaf size ' + str(leaf_size) + ': depth within log2(n / leaf size) and no leaf too large?')
+        passed = (depth <= np.ceil(np.log2(100.0 / leaf_size)) and len(leaf_sizes) - 1 <= leaf_size and
+                  np.sum(leaf_sizes * np.arange(len(leaf_sizes))) == 100 and leaf_sizes[0] == 0)
+        assert passed
+        print(passed)
+
+        print('\nCompiled tree reports the same shape?')
+        flat = fct.FlatCovTree(tree, triangles)
+        flat_stats = flat.BuildStats()
+        passed = flat_stats[0] == depth and flat_stats[1] == num_nodes and np.array_equal(flat_stats[2], leaf_sizes)
+        assert passed
+        print(passed)
+
+        print('\nSearch matches linear search within tolerance?')
+        s = np.random.uniform(-15, 15, (30, 3))
+        c_lin, d_lin, t_lin = icpm.findClosestPointsBatch(s, icpm.meshTriangles(v_coords, tri_inds))
+        c, d, t = flat.find_closest_points(s, np.inf * np.ones(30), s + np.inf)
+        passed = np.all(np.abs(d - d_lin) <= tolerance)
+        assert passed
+        print(passed)
+
+    print('\nMedian split tree build tests passed!')
+
+
+def testTreeFromTriangleSet(tolerance=1e-4):
+    """
+    Tests that trees built directly into arrays hold every triangle once, in a leaf whose box contains it, are balanced
+    and respect the leaf size, and that their search matches a search of every triangle.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting tree built from a triangle set...')
+    v_coords, tri_inds, _ = _randomMesh(100)
+    triangles = ts.fromMesh(v_coords, tri_inds)
+
+    for leaf_size in (1, 3, 8):
+        flat = fct.FlatCovTree.fromTriangleSet(triangles, leaf_size)
+        depth, num_nodes, leaf_sizes = flat.BuildStats()
+
+        print('\nLeaf size ' + str(leaf_size) + ': every triangle once, depth within log2(n / leaf size)?')
+        passed = (np.array_equal(np.sort(flat.tri_ids), np.arange(100)) and
+                  depth <= np.ceil(np.log2(100.0 / leaf_size)) and len(leaf_sizes) - 1 <= leaf_size and
+                  np.array_equal(flat.triangles.corners, triangles.corners[flat.tri_ids]))
+        assert passed
+        print(passed)
+
+        print('\nEach leaf box contains its triangles?')
+        passed = True
+        for k in np.where(flat.children[:, 0] < 0)[0]:
+            corners = flat.triangles.corners[flat.leaf_start[k]:flat.leaf_end[k]].reshape((-1, 3))
+            local = (corners - flat.translations[k]).dot(flat.rotations[k])
+            passed = (passed and np.all(local >= flat.lower[k] - tolerance) and
+                      np.all(local <= flat.upper[k] + tolerance))
+        assert passed
+        print(passed)
+
+        print('\nSearch matches linear search within tolerance?')
+        s = np.random.uniform(-15, 15, (30, 3))
+        c_lin, d_lin, t_lin = icpm.findClosestPointsBatch(s, icpm.meshTriangles(v_coords, tri_inds))
+        c, d, t = flat.find_closest_points(s, np.inf * np.ones(30), s + np.inf)
+        passed = np.all(np.abs(d - d_lin) <= tolerance) and np.all(np.abs(c - c_lin) <= tolerance)
+        assert passed
+        print(passed)
+
+    print('\nTree built from a triangle set tests passed!')
+
+
+def testTreeIterative(tolerance=1e-4):
+    """
+    Tests that covariance trees build and search under a recursion limit far below their depth times the frames a
+    recursive build needs per level, and that the search still matches a search of every triangle.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting iterative tree build and search...')
+    v_coords, tri_inds, triangles = _randomMesh(1200)
+    s = np.random.uniform(-15, 15, (3, 20))
+
+    # Frames allowed beyond those of this test
+    budget = 20
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(len(inspect.stack()) + budget)
+    try:
+        tree = ctn.CovTreeNode(triangles, tri_inds.shape[1], 'median', 1)
+        c_tree = icpm.ICPmatch(pc.PointCloud(s), v_coords, tri_inds, tree=tree, oldpts=pc.PointCloud(s + np.inf),
+                               usetree=True)
+    finally:
+        sys.setrecursionlimit(limit)
+
+    print('\nTree deeper than a recursive build could reach within the recursion limit?')
+    # A recursive build needs two frames per level, for the constructor and _ConstructSubtrees
+    passed = 2 * tree.BuildStats()[0] > budget
+    assert passed
+    print(passed)
+
+    print('\nSearch matches linear search within tolerance?')
+    c_lin, d_lin, t_lin = icpm.findClosestPointsBatch(s.T, icpm.meshTriangles(v_coords, tri_inds))
+    passed = np.all(np.abs(c_tree.data - c_lin.T) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nIterative tree build and search tests passed!')
+
+
+def testBestFirst(tolerance=1e-4):
+    """
+    Tests that every search order of a covariance tree finds the same closest points, that best first search measures
+    no more nodes than it could have pushed, and that an unknown search order is rejected.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting search orders of the covariance tree...')
+    v_coords, tri_inds, triangles = _randomMesh(200)
+    tree = ctn.CovTreeNode(triangles, tri_inds.shape[1], 'median', 4)
+    num_nodes = tree.BuildStats()[1]
+    s = np.random.uniform(-15, 15, (3, 20))
+
+    found = {}
+    counts = {}
+    for order in ('fixed', 'near', 'best'):
+        found[order] = np.zeros((3, s.shape[1]))
+        counts[order] = collections.Counter()
+        for i in range(s.shape[1]):
+            bound = [np.inf]
+            closest = [s[:, i] + np.inf]
+            tree.FindClosestPoint(s[:, i], bound, closest, order, counts[order])
+            found[order][:, i] = closest[0].reshape(3)
+
+    print('\nEvery search order matches linear search within tolerance?')
+    c_lin, d_lin, t_lin = icpm.findClosestPointsBatch(s.T, icpm.meshTriangles(v_coords, tri_inds))
+    passed = all(np.all(np.abs(found[order] - c_lin.T) <= tolerance) for order in found)
+    assert passed
+    print(passed)
+
+    print('\nNodes and triangles counted for every search?')
+    passed = True
+    for order in counts:
+        print(order + ': ' + str(counts[order]['nodes']) + ' nodes, ' + str(counts[order]['triangles']) + ' triangles')
+        passed = passed and 0 < counts[order]['nodes'] <= num_nodes * s.shape[1]
+        passed = passed and 0 < counts[order]['triangles'] <= tri_inds.shape[1] * s.shape[1]
+    assert passed
+    print(passed)
+
+    print('\nUnknown search order rejected?')
+    try:
+        tree.FindClosestPoint(s[:, 0], [np.inf], [s[:, 0]], 'widest')
+        passed = False
+    except ValueError:
+        passed = True
+    assert passed
+    print(passed)
+
+    print('\nSearch order tests passed!')
+
+
+def testLeafBuckets(tolerance=1e-4):
+    """
+    Tests that sign split trees respect the leaf size, that the triangles below every node are a contiguous range of
+    the tree's triangle set, and that searching whole leaves at once matches a search of every triangle.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting leaf buckets...')
+    v_coords, tri_inds, triangles = _randomMesh(200)
+    s = np.random.uniform(-15, 15, (3, 20))
+    c_lin, d_lin, t_lin = icpm.findClosestPointsBatch(s.T, icpm.meshTriangles(v_coords, tri_inds))
+
+    for leaf_size in (1, 8, 32):
+        tree = ctn.CovTreeNode(triangles, tri_inds.shape[1], 'sign', leaf_size)
+        depth, num_nodes, leaf_sizes = tree.BuildStats()
+
+        print('\nLeaf size ' + str(leaf_size) + ': no leaf split below the leaf size?')
+        passed = True
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if node.has_subtrees:
+                passed = passed and node.num_tri > leaf_size
+                stack.extend(node.subtrees)
+        assert passed
+        print(passed)
+
+        print('\nTriangles below each node are a contiguous range of the triangle set?')
+        passed = tree.start == 0 and tree.end == tri_inds.shape[1] and len(tree.triangle_set) == tri_inds.shape[1]
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            passed = passed and node.triangle_set is tree.triangle_set and node.end - node.start == node.num_tri
+            if node.has_subtrees:
+                passed = (passed and node.subtrees[0].start == node.start and
+                          node.subtrees[0].end == node.subtrees[1].start and node.subtrees[1].end == node.end)
+                stack.extend(node.subtrees)
+            else:
+                corners = np.array([t.corners.data.T for t in node.triangle_list[0:node.num_tri]])
+                passed = passed and np.array_equal(corners, tree.triangle_set.corners[node.start:node.end])
+        assert passed
+        print(passed)
+
+        print('\nSearch matches linear search within tolerance?')
+        c_tree = icpm.ICPmatch(pc.PointCloud(s), v_coords, tri_inds, tree=tree, oldpts=pc.PointCloud(s + np.inf),
+                               usetree=True)
+        passed = np.all(np.abs(c_tree.data - c_lin.T) <= tolerance)
+        assert passed
+        print(passed)
+
+    print('\nLeaf bucket tests passed!')
+
+
+def testUniformGrid(tolerance=1e-4):
+    """
+    Tests that a uniform grid lists every triangle in some cell and finds the same closest points as a search of every
+    triangle, for points inside and far outside the grid, with and without a starting bound, and that points very far
+    from the grid are matched quickly.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting uniform grid...')
+    v_coords, tri_inds, _ = _randomMesh(100)
+    s = np.vstack((np.random.uniform(-12, 12, (30, 3)), np.random.uniform(-60, 60, (10, 3))))
+    c_lin, d_lin, t_lin = icpm.findClosestPointsBatch(s, icpm.meshTriangles(v_coords, tri_inds))
+
+    for cell_size in (None, 1.0, 4.0):
+        grid = ug.UniformGrid.fromTriangleSet(ts.fromMesh(v_coords, tri_inds), cell_size)
+        shape, entries, cell_sizes = grid.CellStats()
+
+        print('\nCell size ' + str(grid.cell_size) + ': every triangle in some cell?')
+        passed = (np.array_equal(np.unique(grid.cell_triangles), np.arange(tri_inds.shape[1])) and
+                  entries == np.sum(cell_sizes * np.arange(len(cell_sizes))))
+        assert passed
+        print(passed)
+
+        print('\nSearch matches linear search within tolerance?')
+        c, d, t = grid.find_closest_points(s, np.inf * np.ones(s.shape[0]), s + np.inf)
+        passed = np.all(np.abs(c - c_lin) <= tolerance) and np.array_equal(t, t_lin)
+        assert passed
+        print(passed)
+
+        print('\nStarting bounds respected?')
+        bounds = d_lin * np.where(np.arange(s.shape[0]) % 2, 0.5, 2.0)
+        c, d, t = grid.find_closest_points(s, bounds, s)
+        passed = np.all(np.abs(d - np.minimum(bounds, d_lin)) <= tolerance) and np.all((t >= 0) == (d_lin < bounds))
+        assert passed
+        print(passed)
+
+    print('\nGrid usable as an ICPmatch tree?')
+    c_grid = icpm.ICPmatch(pc.PointCloud(s.T), v_coords, tri_inds, tree=grid, oldpts=pc.PointCloud(s.T + np.inf))
+    passed = np.all(np.abs(c_grid.data - c_lin.T) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nPoints far outside the grid matched exactly, without searching the empty shells up to it?')
+    direction = np.random.uniform(-1, 1, (5, 3))
+    far = 1000 * direction / np.linalg.norm(direction, axis=1)[:, np.newaxis]
+    c_lin, d_lin, t_lin = icpm.findClosestPointsBatch(far, icpm.meshTriangles(v_coords, tri_inds))
+    grid = ug.fromMesh(v_coords, tri_inds, 1.0)
+    start = time.time()
+    c, d, t = grid.find_closest_points(far, np.inf * np.ones(5), far + np.inf)
+    passed = np.all(np.abs(d - d_lin) <= tolerance) and time.time() - start < 1.0
+    assert passed
+    print(passed)
+
+    print('\nNon-positive cell size rejected?')
+    try:
+        ug.UniformGrid(ts.fromMesh(v_coords, tri_inds), 0.0)
+        passed = False
+    except ValueError:
+        passed = True
+    assert passed
+    print(passed)
+
+    print('\nParallel search over a grid rejected?')
+    try:
+        icpm.ICPmatch(pc.PointCloud(s.T), v_coords, tri_inds, tree=grid, oldpts=pc.PointCloud(s.T + np.inf), workers=2)
+        passed = False
+    except ValueError:
+        passed = True
+    assert passed
+    print(passed)
+
+    print('\nUniform grid tests passed!')
+
+
+def testDistanceField(tolerance=1e-4):
+    """
+    Tests that a distance field stores the exact closest point at each node in its band, that interpolated matches are
+    exact at the nodes, that refined matches near the surface and tree matches outside the band are exact, that ICP
+    matching from a field ends on exact matches, that point-to-plane ICP can match from a field, that incremental
+    matching cannot, and that the field is cached with its mesh and memory mapped on later use.
+
+    :param tolerance: Maximum tolerance between expected and calculated results
+
+    :type tolerance: float
+
+    :return: None
+    """
+    print('\nTesting distance field...')
+    # Smooth height field surface, two triangles per grid square
+    x, y = np.meshgrid(np.arange(12.0), np.arange(12.0), indexing='ij')
+    v_coords = np.vstack((x.reshape(-1), y.reshape(-1), 2 * np.sin(x / 3).reshape(-1) * np.cos(y / 4).reshape(-1)))
+    k = (12 * x[0:11, 0:11] + y[0:11, 0:11]).reshape(-1).astype(int)
+    tri_inds = np.hstack((np.vstack((k, k + 12, k + 13)), np.vstack((k, k + 13, k + 1))))
+    triangles = icpm.meshTriangles(v_coords, tri_inds)
+    tree = fct.fromMesh(v_coords, tri_inds)
+    field = df.fromMesh(v_coords, tri_inds)
+
+    print('\nOnly nodes in the band stored, each with its exact closest point?')
+    nodes = field.lower + field.spacing * np.array(np.unravel_index(field.nodes, field.shape)).T
+    c_lin, d_lin, t_lin = icpm.findClosestPointsBatch(nodes, triangles)
+    passed = (0 < field.nodes.size < np.prod(field.shape) and np.all(np.diff(field.nodes) > 0) and
+              np.all(np.abs(field.closest - c_lin) <= tolerance) and np.all(d_lin <= 4 * field.spacing + tolerance))
+    assert passed
+    print(passed)
+
+    print('\nInterpolated matches exact at the nodes?')
+    c, tri = field.match(pc.PointCloud(nodes.T), tree, refine=False)
+    passed = np.all(np.abs(c.data - c_lin.T) <= tolerance)
+    assert passed
+    print(passed)
+
+    print('\nRefined matches near the surface and matches outside the band exact?')
+    s = np.random.uniform(1, 10, (40, 3))
+    s[:, 2] = 2 * np.sin(s[:, 0] / 3) * np.cos(s[:, 1] / 4) + np.random.uniform(-1, 1, 40)
+    s[30:] = np.random.uniform(-40, 40, (10, 3))
+    c_lin, d_lin, t_lin = icpm.findClosestPointsBatch(s, triangles)
+    c, tri = field.match(pc.PointCloud(s.T), tree)
+    passed = np.all(np.abs(c.data - c_lin.T) <= tolerance) and np.all(tri >= 0)
+    assert passed
+    print(passed)
+
+    print('\nICP ends on exact matches even where a coarse field refines to the wrong triangle?')
+    coarse = df.fromMesh(v_coords, tri_inds, spacing=3.0)
+    c_k, F_reg = icp.iterativeFramePointFinder(v_coords, tri_inds, pc.PointCloud(s[:30].T), tree=tree, field=coarse)
+    c_lin, d_lin, t_lin = icpm.findClosestPointsBatch(pc.PointCloud(s[:30].T).transform(F_reg).data.T, triangles)
+    # Matched from the frame before the last, converged, registration update
+    passed = np.all(np.abs(c_k.data - c_lin.T) <= 0.05)
+    assert passed
+    print(passed)
+
+    print('\nPoint-to-plane ICP registers a displaced copy of the surface from the field?')
+    on_surface = c.data[:, :30]
+    d_k = pc.PointCloud(on_surface).transform(fr.Frame(_rotation(np.array([0.02, -0.01, 0.02])),
+                                                       np.array([[0.2], [-0.1], [0.2]])))
+    c_k, F_reg = icp.iterativeFramePointFinder(v_coords, tri_inds, d_k, tree=tree, mode='plane', field=field)
+    passed = np.all(np.abs(d_k.transform(F_reg).data - on_surface) <= 1e-2)
+    assert passed
+    print(passed)
+
+    print('\nIncremental matching with a field rejected?')
+    try:
+        icp.iterativeFramePointFinder(v_coords, tri_inds, d_k, tree=tree, incremental=True, field=field)
+        passed = False
+    except ValueError:
+        passed = True
+    assert passed
+    print(passed)
+
+    directory = tempfile.mkdtemp()
+    meshfile = os.path.join(directory, 'mesh.sur')
+    try:
+        with open(meshfile, 'w') as f:
+            f.write('{0}\n'.format(v_coords.shape[1]))
+            for v in v_coords.T:
+                f.write('{0:.6f} {1:.6f} {2:.6f}\n'.format(*v))
+            f.write('{0}\n'.format(tri_inds.shape[1]))
+            for t in tri_inds.T:
+                f.write('{0} {1} {2} -1 -1 -1\n'.format(*t))
+        mc.MeshCache(meshfile).field
+        second = mc.MeshCache(meshfile)
+
+        print('\nField cached with its mesh and memory mapped on later use?')
+        passed = (os.path.isdir(os.path.join(second.path, 'field')) and isinstance(second.field.closest, np.memmap) and
+                  np.all(np.abs(second.field.match(pc.PointCloud(s.T), second.tree)[0].data - c.data) <= tolerance))
+        assert passed
+        print(passed)
+    finally:
+        shutil.rmtree(directory)
+
+    print('\nDistance field tests passed!')
+
+
 def _rotation(angles):
     """
     Helper method for generating a 3d rotation matrix
@@ -633,3 +1802,24 @@ def _rotation(angles):
                    [0, 0, 1]])
 
     return rx.dot(ry.dot(rz))
+
+
+def _randomMesh(n):
+    """
+    Helper method for generating a mesh of random triangles, none sharing a vertex
+
+    :param n: The number of triangles
+    :type n: int
+
+    :return v_coords: Coordinates of the vertices, uniform in [-10, 10]
+    :return tri_inds: Indices of the vertices of each triangle
+    :return triangles: Each triangle of the mesh
+
+    :rtype v_coords: numpy.array([numpy.float64][]) 3 x 3n
+    :rtype tri_inds: numpy.array([int][]) 3 x n
+    :rtype triangles: numpy.array([Triangle.Triangle]) n
+    """
+    v_coords = np.random.uniform(-10, 10, (3, 3 * n))
+    tri_inds = np.arange(3 * n).reshape((n, 3)).T
+    triangles = np.array([tr.Triangle(pc.PointCloud(v_coords[:, tri_inds[:, i]])) for i in range(n)])
+    return v_coords, tri_inds, triangles